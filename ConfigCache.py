@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+CACHE_VERSION = 1
+
+def validate_config(config: dict) -> None:
+    """Checks that the sections and keys used at startup exist, raises an Exception otherwise"""
+    if not isinstance(config, dict):
+        raise Exception("config must be an object")
+    for section, keys in (("vbus", ("serialport", "baudrate", "vsf")), ("mqtt", ("host", "port", "user", "pass", "topic_prefix"))):
+        if not isinstance(config.get(section), dict):
+            raise Exception(f"config section '{section}' is missing")
+        for key in keys:
+            if key not in config[section]:
+                raise Exception(f"config key '{section}.{key}' is missing")
+    for section in ("plugins", "transfers"):
+        if not isinstance(config.get(section), list):
+            raise Exception(f"config section '{section}' must be a list")
+        for i, entry in enumerate(config[section]):
+            if not isinstance(entry, dict):
+                raise Exception(f"entry {i} of config section '{section}' must be an object")
+    for i, transfer in enumerate(config["transfers"]):
+        for key in ("mqtt", "trigger", "type"):
+            if key not in transfer:
+                raise Exception(f"config key '{key}' of transfer {i} is missing")
+
+def load_config(filename: str, cache_file: str = None) -> dict:
+    """Loads a json5 config, the parsed and validated config is cached as plain JSON
+
+    Parsing json5 is slow in pure Python and the parser is only imported if needed. The cache is valid as
+    long as modification time and size of the config are unchanged, if they differ, the SHA-256 of the
+    content decides. The cache is written next to the config with the same permissions, as it contains
+    the credentials as well. Failures to write it are ignored.
+
+    Args:
+        filename (str): json5 config file
+        cache_file (str, optional): cache file. Defaults to None (".<name>.cache" in the directory of the config).
+
+    Returns:
+        dict: config
+    """
+    if cache_file is None:
+        directory, name = os.path.split(os.path.abspath(filename))
+        cache_file = os.path.join(directory, f".{name}.cache")
+
+    stat = os.stat(filename)
+    cache = None
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+    # a cache of another version or shape, e.g. truncated or edited by hand, is a cache miss
+    if not isinstance(cache, dict) or cache.get("version") != CACHE_VERSION or not isinstance(cache.get("config"), dict):
+        cache = None
+
+    if cache is not None and cache.get("mtime_ns") == stat.st_mtime_ns and cache.get("size") == stat.st_size:
+        try:
+            # caches written by older versions or after a chmod of the config
+            if os.stat(cache_file).st_mode & 0o777 & ~stat.st_mode:
+                os.chmod(cache_file, stat.st_mode & 0o777)
+        except OSError:
+            pass
+        return cache["config"]
+
+    with open(filename, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+
+    if cache is not None and cache.get("sha256") == digest:
+        config = cache["config"]
+    else:
+        import json5
+        config = json5.loads(content.decode("utf-8"))
+        validate_config(config)
+
+    try:
+        tmp_file = cache_file + ".tmp"
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        # private until it gets the permissions of the config, e.g. 0600
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        os.chmod(tmp_file, stat.st_mode & 0o777)
+        with os.fdopen(fd, "w") as f:
+            json.dump({ "version": CACHE_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest, "config": config }, f)
+        os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError):
+        pass
+    return config
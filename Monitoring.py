@@ -0,0 +1,540 @@
+from abc import ABC, abstractmethod
+import bisect
+from collections import deque, OrderedDict
+import os
+import threading
+import time
+from typing import Union
+from JsonHelper import *
+
+class MemoryMonitor:
+    """Process memory metrics, sampled at an interval and cached
+
+    RSS is read from /proc/self/statm, PSS from /proc/self/smaps_rollup (Linux only). Optionally,
+    tracemalloc is started to list the top allocating source lines. Taking a tracemalloc snapshot
+    is slow, so it is done by a background thread at the sampling interval.
+    """
+    def __init__(self, config: dict = None) -> None:
+        if config is None:
+            config = {}
+
+        self.interval = json_get_or_default(config, "interval", 30)
+        self.tracemalloc_enabled = json_get_or_default(config, "tracemalloc", False)
+        self.tracemalloc_top = json_get_or_default(config, "tracemalloc_top", 10)
+
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.rss = None
+        self.pss = None
+        self.sampled = None
+
+        self.top_allocations = None
+        self.top_allocations_sampled = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+        if self.tracemalloc_enabled:
+            import tracemalloc
+            tracemalloc.start(json_get_or_default(config, "tracemalloc_frames", 1))
+            self.top_allocations = []
+            self.thread = threading.Thread(target=self.run_tracemalloc, name="tracemalloc", daemon=True)
+            self.thread.start()
+
+    def _read_rss(self) -> Union[None, int]:
+        try:
+            with open("/proc/self/statm", "rb") as f:
+                return int(f.read().split()[1]) * self.page_size
+        except (OSError, ValueError, IndexError):
+            pass
+
+        try:
+            import resource
+            # peak instead of current usage, but better than nothing
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except (ImportError, OSError):
+            return None
+
+    def _read_pss(self) -> Union[None, int]:
+        try:
+            with open("/proc/self/smaps_rollup", "rb") as f:
+                for line in f:
+                    if line.startswith(b"Pss:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def sample(self, now: float = None) -> float:
+        """Samples the memory usage, can be used as a scheduler callback
+
+        Args:
+            now (float, optional): current time.monotonic(). Defaults to None.
+
+        Returns:
+            float: time.monotonic() based time of the next sample
+        """
+        if now is None:
+            now = time.monotonic()
+        self.rss = self._read_rss()
+        self.pss = self._read_pss()
+        self.sampled = now
+        return now + self.interval
+
+    def get_rss(self) -> Union[None, int]:
+        if self.sampled is None:
+            self.sample()
+        return self.rss
+
+    def get_pss(self) -> Union[None, int]:
+        if self.sampled is None:
+            self.sample()
+        return self.pss
+
+    def get_top_allocations(self) -> Union[None, list]:
+        """Top allocating source lines according to tracemalloc, as sampled by the background thread
+
+        Returns:
+            Union[None, list]: list of dicts with "source", "size" and "count", None if tracemalloc is disabled
+        """
+        return self.top_allocations
+
+    def sample_top_allocations(self) -> None:
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.statistics("lineno")[:self.tracemalloc_top]
+        # replaced as a whole, readers never see a partial list
+        self.top_allocations = [{
+            "source": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size": stat.size,
+            "count": stat.count,
+        } for stat in stats]
+        self.top_allocations_sampled = time.monotonic()
+
+    def run_tracemalloc(self) -> None:
+        timeout = 0
+        while not self.stopping.wait(timeout):
+            self.sample_top_allocations()
+            timeout = self.interval
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(5)
+
+class MetricsHistogramChild:
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsCounterChild:
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount = 1) -> None:
+        self.value += amount
+
+class _MetricsFamily(ABC):
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.children = {}
+
+    def labels(self, *labelvalues):
+        """Returns the child for the given label values, keep it to avoid the lookup on every observation"""
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self._new_child()
+            self.children[labelvalues] = child
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """Creates the child holding the values of one combination of label values"""
+
+    def _format_labels(self, labelvalues: tuple, extra: str = None) -> str:
+        labels = [f'{name}="{_escape_label(str(value))}"' for name, value in zip(self.labelnames, labelvalues)]
+        if extra is not None:
+            labels.append(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(labels) + "}"
+
+class MetricsCounter(_MetricsFamily):
+    TYPE = "counter"
+
+    def _new_child(self):
+        return MetricsCounterChild()
+
+    def inc(self, amount = 1) -> None:
+        self.labels().inc(amount)
+
+    def render(self, lines: list) -> None:
+        for labelvalues, child in list(self.children.items()):
+            lines.append(f"{self.name}{self._format_labels(labelvalues)} {child.value}")
+
+class MetricsHistogram(_MetricsFamily):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = None) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) if buckets is not None else self.DEFAULT_BUCKETS
+
+    def _new_child(self):
+        return MetricsHistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self, lines: list) -> None:
+        for labelvalues, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = 'le="' + le + '"'
+                lines.append(f"{self.name}_bucket{self._format_labels(labelvalues, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labelvalues)} {child.sum}")
+            lines.append(f"{self.name}_count{self._format_labels(labelvalues)} {child.count}")
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text format
+
+    Values owned by other components (e.g. the reader's counters) are added with collectors, which are
+    only called when the metrics are rendered.
+    """
+    def __init__(self) -> None:
+        self.families = {}
+        self.collectors = []
+
+    def _get_family(self, cls, name, help, labelnames, **kwargs):
+        family = self.families.get(name)
+        if family is None:
+            family = cls(name, help, tuple(labelnames), **kwargs)
+            self.families[name] = family
+        elif not isinstance(family, cls):
+            raise Exception(f"metric '{name}' is already registered as {family.TYPE}")
+        return family
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> MetricsCounter:
+        return self._get_family(MetricsCounter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = None) -> MetricsHistogram:
+        return self._get_family(MetricsHistogram, name, help, labelnames, buckets = buckets)
+
+    def add_collector(self, collector) -> None:
+        """Adds a collector
+
+        Args:
+            collector (Callable[[], list]): returns a list of (name, type, help, samples) with samples
+                being a list of (labels dict, value)
+        """
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.TYPE}")
+            family.render(lines)
+
+        for collector in self.collectors:
+            for name, type, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    label_str = ""
+                    if labels:
+                        label_str = "{" + ",".join(f'{k}="{_escape_label(str(v))}"' for k, v in labels.items()) + "}"
+                    lines.append(f"{name}{label_str} {value}")
+
+        lines.append("")
+        return "\n".join(lines)
+
+# default registry, used by all components of vbus2mqtt
+metrics = MetricsRegistry()
+
+class MetricsServer:
+    """Serves a metrics registry via HTTP (GET /metrics) in a background thread"""
+    def __init__(self, registry: MetricsRegistry, config: dict = None) -> None:
+        if config is None:
+            config = {}
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        bind = json_get_or_default(config, "bind", "127.0.0.1")
+        port = json_get_or_default(config, "port", 9105)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # no access log
+
+        self.httpd = ThreadingHTTPServer((bind, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class LatencyTracer:
+    """Per-transfer latency of received data from its first byte on the bus until it is published
+
+    The timestamps of a message are carried through decoding, the mailbox, the dispatcher and the
+    transfer. For each transfer, the stage durations of the last samples are kept to calculate percentiles.
+    The completion of the publish is reported by the MQTT client's on_publish callback.
+    """
+    STAGES = ("frame", "decode", "queue", "dispatch", "render", "publish")
+
+    def __init__(self, config: dict = None) -> None:
+        if config is None:
+            config = {}
+
+        self.samples = json_get_or_default(config, "samples", 1000)
+        self.pending_max = json_get_or_default(config, "pending", 1000)
+
+        self.latencies = {} # transfer name -> deque of (total, *stages)
+        self.completions = {} # transfer name -> deque of latencies until on_publish
+
+        # published message ids, accessed by the dispatcher and the MQTT client thread
+        self.lock = threading.Lock()
+        self.pending = OrderedDict() # mid -> (transfer name, first byte time)
+        self.completed_early = OrderedDict() # mid -> completion time, for callbacks faster than record()
+
+        self.metrics_latency = metrics.histogram("vbus2mqtt_e2e_latency_seconds", "Latency from the first received byte of a message", ("transfer", "until"))
+        self.metrics_children = {}
+
+    def _observe(self, name: str, until: str, value: float) -> None:
+        child = self.metrics_children.get((name, until))
+        if child is None:
+            child = self.metrics_latency.labels(name, until)
+            self.metrics_children[(name, until)] = child
+        child.observe(value)
+
+    def record(self, name: str, timestamps: tuple, mid: int = None) -> None:
+        """Records the stages of a published message
+
+        Args:
+            name (str): name of the transfer (topic)
+            timestamps (tuple): time.time() of first byte, frame end, decoded, update start, transmit start, rendered and published
+            mid (int, optional): message id of the MQTT client to wait for the completion. Defaults to None.
+        """
+        deltas = tuple(timestamps[i + 1] - timestamps[i] for i in range(len(timestamps) - 1))
+        total = timestamps[-1] - timestamps[0]
+
+        latencies = self.latencies.get(name)
+        if latencies is None:
+            latencies = deque(maxlen=self.samples)
+            self.latencies[name] = latencies
+        latencies.append((total,) + deltas)
+        self._observe(name, "publish", total)
+
+        if mid is None:
+            return
+
+        with self.lock:
+            completed = self.completed_early.pop(mid, None)
+            if completed is None:
+                self.pending[mid] = (name, timestamps[0])
+                while len(self.pending) > self.pending_max:
+                    self.pending.popitem(last=False)
+                return
+
+        self._record_completion(name, completed - timestamps[0])
+
+    def published(self, mid: int) -> None:
+        """Reports the completion of a publish, called from the MQTT client thread"""
+        now = time.time()
+        with self.lock:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                self.completed_early[mid] = now
+                while len(self.completed_early) > self.pending_max:
+                    self.completed_early.popitem(last=False)
+                return
+
+        name, first_byte = entry
+        self._record_completion(name, now - first_byte)
+
+    def _record_completion(self, name: str, latency: float) -> None:
+        completions = self.completions.get(name)
+        if completions is None:
+            completions = deque(maxlen=self.samples)
+            self.completions[name] = completions
+        completions.append(latency)
+        self._observe(name, "complete", latency)
+
+    @staticmethod
+    def _percentiles(values: list) -> dict:
+        values = sorted(values)
+        count = len(values)
+        if count == 0:
+            return None
+        def percentile(p):
+            return round(values[min(count - 1, int(p * count))], 6)
+        return { "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99), "max": round(values[-1], 6) }
+
+    def get_stats(self) -> dict:
+        """Latency percentiles in seconds per transfer, in total and for each stage"""
+        retval = {}
+        for name, latencies in list(self.latencies.items()):
+            samples = list(latencies)
+            stats = {
+                "count": len(samples),
+                "total": self._percentiles([sample[0] for sample in samples]),
+            }
+            for i, stage in enumerate(self.STAGES):
+                stats[stage] = self._percentiles([sample[i + 1] for sample in samples])
+
+            completions = self.completions.get(name)
+            if completions is not None:
+                stats["complete"] = self._percentiles(list(completions))
+            retval[name] = stats
+        return retval
+
+class SamplingProfiler:
+    """Statistical profiler of all threads, started and stopped with a signal
+
+    A background thread samples the stacks of all other threads in an interval. In mode "cpu", a
+    stack is weighted with the CPU time (in microseconds) its thread used since the previous sample,
+    so waiting threads don't show up. In mode "wall", each sample counts 1. The result is written in
+    the collapsed stack format (one line per stack: frames separated by ';' and the count), e.g.
+    for flamegraph.pl or speedscope.
+    """
+    def __init__(self, config: dict = None) -> None:
+        if config is None:
+            config = {}
+
+        import signal
+        self.signum = getattr(signal, json_get_or_default(config, "signal", "SIGUSR1"))
+        self.interval = json_get_or_default(config, "interval", 0.01)
+        self.duration = json_get_or_default(config, "duration", 60)
+        self.mode = json_get_or_default(config, "mode", "cpu")
+        self.filename = json_get_or_default(config, "file", "vbus2mqtt-{pid}-{time}.folded")
+        self.directory = json_get_or_default(config, "directory", None)
+
+        self.thread = None
+        self.stopping = threading.Event()
+        self.labels = {} # code object -> frame label
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def toggle(self, signum = None, frame = None) -> None:
+        """Starts or stops profiling, can be used as signal handler"""
+        if self.running:
+            # the handler runs on the main thread, the profiler thread writes the result on its own
+            self.stopping.set()
+        else:
+            self.start()
+
+    def start(self, duration: float = None) -> None:
+        if self.running:
+            return
+        if duration is None:
+            duration = self.duration
+
+        import tempfile
+        directory = self.directory if self.directory is not None else tempfile.gettempdir()
+        filename = os.path.join(directory, self.filename.format(pid=os.getpid(), time=time.strftime("%Y%m%d-%H%M%S")))
+
+        print(f"Profiler started, writing to {filename} after {duration} s or on the next signal")
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, args=(filename, duration), name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops profiling and waits until the result is written"""
+        self.stopping.set()
+        if self.running and threading.current_thread() is not self.thread:
+            self.thread.join(5)
+
+    def _label(self, code) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = f"{os.path.basename(code.co_filename)}:{name}".replace(";", ":")
+            self.labels[code] = label
+        return label
+
+    def _stack(self, thread_name: str, frame) -> str:
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread_name.replace(";", ":"))
+        labels.reverse()
+        return ";".join(labels)
+
+    def _thread_cpu(self, ident: int) -> Union[None, float]:
+        try:
+            return time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (AttributeError, OSError):
+            return None
+
+    def run(self, filename: str, duration: float) -> None:
+        import sys
+
+        counts = {} # collapsed stack -> count
+        cpu_last = {} # thread ident -> CPU time at the previous sample
+        samples = 0
+        own_ident = threading.get_ident()
+        end = time.monotonic() + duration
+        cpu_mode = self.mode == "cpu"
+
+        while not self.stopping.wait(self.interval) and time.monotonic() < end:
+            names = { thread.ident: thread.name for thread in threading.enumerate() }
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+
+                weight = 1
+                if cpu_mode:
+                    cpu = self._thread_cpu(ident)
+                    if cpu is not None:
+                        previous = cpu_last.get(ident)
+                        cpu_last[ident] = cpu
+                        weight = round((cpu - previous) * 1e6) if previous is not None else 0
+                        if weight <= 0:
+                            continue
+
+                stack = self._stack(names.get(ident, str(ident)), frame)
+                counts[stack] = counts.get(stack, 0) + weight
+            frame = None # don't keep the frame alive until the next sample
+            samples += 1
+
+        try:
+            with open(filename, "w") as f:
+                for stack, count in sorted(counts.items()):
+                    f.write(f"{stack} {count}\n")
+            print(f"Profiler stopped after {samples} samples, written to {filename}")
+        except OSError as e:
+            print(f"Profiler stopped, could not write {filename}: {e}")
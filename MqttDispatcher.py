@@ -1,11 +1,21 @@
-from typing import Union
+from typing import Callable, Union
+from abc import ABC, abstractmethod
+from array import array
+import bisect
+from collections import deque
+import fnmatch
+import heapq
+import itertools
 import json
-import gc
+import math
 import os
-import sys
+import threading
 import time
 from datetime import datetime
 from JsonHelper import *
+from Monitoring import MemoryMonitor, metrics
+from PluginWorker import tick_deadline
+from MsgpackHelper import msgpack_array_header, msgpack_map_header, msgpack_str, msgpack_pack
 import importlib
 
 def dt_to_iso8601(timestamp: datetime):
@@ -20,6 +30,18 @@ class MqttDispatcherField:
         self.updated = True
         self.changed = True
         self.transfers = [] # transfers the field is being used in
+        self.plugins = [] # plugins with update or change callbacks subscribed to the field
+        self.aggregates = [] # windowed aggregates of the values
+        self.history = None # optional MqttDispatcherFieldHistory
+
+    def get_aggregate(self, mode: str, window: float) -> "MqttDispatcherAggregate":
+        """Aggregate of the field, aggregates with the same mode and window are shared"""
+        for aggregate in self.aggregates:
+            if aggregate.MODE == mode and aggregate.window == window:
+                return aggregate
+        aggregate = MqttDispatcherAggregate.construct(mode, window)
+        self.aggregates.append(aggregate)
+        return aggregate
 
     def update(self, value, timestamp: datetime = None) -> bool:
         """Updates the field with a newer value
@@ -34,44 +56,907 @@ class MqttDispatcherField:
         self.updated = True
         self.timestamp = timestamp
 
+        if self.aggregates and isinstance(value, (int, float)):
+            now = time.time()
+            for aggregate in self.aggregates:
+                aggregate.add(value, now)
+
+        if self.history is not None and isinstance(value, (int, float)):
+            self.history.append(value, time.monotonic())
+
         if self.value != value:
             self.changed = True
             self.value = value
             return True
         return False
 
+class MqttDispatcherFieldHistory:
+    """Ring buffer of the last values of a field with their time.monotonic() timestamps
+
+    Values and timestamps are stored in two preallocated arrays of doubles, so a history takes
+    16 bytes per entry regardless of how many values were added.
+    """
+    __slots__ = ("capacity", "values", "times", "start", "size")
+
+    def __init__(self, capacity: int) -> None:
+        if capacity <= 0:
+            raise Exception("history capacity must be positive")
+        self.capacity = capacity
+        self.values = array("d", bytes(8 * capacity))
+        self.times = array("d", bytes(8 * capacity))
+        self.start = 0 # index of the oldest entry
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, value: Union[int, float], now: float) -> None:
+        index = self.start + self.size
+        if index >= self.capacity:
+            index -= self.capacity
+        self.values[index] = value
+        self.times[index] = now
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = index + 1 if index + 1 < self.capacity else 0
+
+    def _index(self, i: int) -> int:
+        index = self.start + i
+        return index - self.capacity if index >= self.capacity else index
+
+    def time_at(self, i: int) -> float:
+        return self.times[self._index(i)]
+
+    def value_at(self, i: int) -> float:
+        return self.values[self._index(i)]
+
+    def _bisect(self, timestamp: float, right: bool = False) -> int:
+        """Position of the first entry not older than the timestamp, or newer than it if right is True"""
+        # the entries are sorted in two contiguous parts: start..end of the arrays and 0..start
+        tail = min(self.size, self.capacity - self.start)
+        if right:
+            if tail > 0 and timestamp < self.times[self.start + tail - 1]:
+                return bisect.bisect_right(self.times, timestamp, self.start, self.start + tail) - self.start
+            return tail + bisect.bisect_right(self.times, timestamp, 0, self.size - tail)
+        if tail > 0 and timestamp <= self.times[self.start + tail - 1]:
+            return bisect.bisect_left(self.times, timestamp, self.start, self.start + tail) - self.start
+        return tail + bisect.bisect_left(self.times, timestamp, 0, self.size - tail)
+
+    def range(self, since: float = None, until: float = None) -> "MqttDispatcherHistoryRange":
+        """Entries with since <= timestamp <= until (time.monotonic() based), all by default"""
+        first = self._bisect(since) if since is not None else 0
+        end = self._bisect(until, True) if until is not None else self.size
+        return MqttDispatcherHistoryRange(self, first, max(0, end - first))
+
+class MqttDispatcherHistoryRange:
+    """View of consecutive entries of a history without copying them
+
+    The view refers to positions in the ring buffer, it should be used right away as new values
+    overwrite the oldest entries.
+    """
+    def __init__(self, history: MqttDispatcherFieldHistory, first: int, count: int) -> None:
+        self.history = history
+        self.first = first
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> tuple:
+        """(timestamp, value) of the i-th entry, negative indices count from the end"""
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("history index out of range")
+        return (self.history.time_at(self.first + i), self.history.value_at(self.first + i))
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def segments(self) -> list:
+        """The entries as up to two contiguous parts of (timestamps, values) memoryviews"""
+        history = self.history
+        if self.count == 0:
+            return []
+        first = history._index(self.first)
+        last = first + self.count
+        times = memoryview(history.times)
+        values = memoryview(history.values)
+        if last <= history.capacity:
+            return [(times[first:last], values[first:last])]
+        last -= history.capacity
+        return [(times[first:], values[first:]), (times[:last], values[:last])]
+
+    def rate(self) -> Union[None, float]:
+        """Change per second between the first and the last entry"""
+        if self.count < 2:
+            return None
+        t0, v0 = self[0]
+        t1, v1 = self[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else None
+
+    def slope(self) -> Union[None, float]:
+        """Change per second as least squares fit of all entries, less sensitive to noise than rate()"""
+        if self.count < 2:
+            return None
+        t_ref = self[0][0]
+        n = sum_t = sum_v = sum_tt = sum_tv = 0.0
+        for times, values in self.segments():
+            for t, v in zip(times, values):
+                t -= t_ref
+                n += 1
+                sum_t += t
+                sum_v += v
+                sum_tt += t * t
+                sum_tv += t * v
+        denominator = n * sum_tt - sum_t * sum_t
+        return (n * sum_tv - sum_t * sum_v) / denominator if denominator > 0 else None
+
+class MqttDispatcherAggregate(ABC):
+    """Streaming aggregates (min, max, mean, count, integral) of a field over a time window
+
+    The integral assumes a value is held until the next one (in value * seconds, e.g. J for W).
+    Times are time.time() based, so tumbling windows are aligned to the clock.
+    """
+    FUNCTIONS = ("min", "max", "mean", "count", "integral")
+    MODE = None
+
+    @staticmethod
+    def construct(mode: str, window: float) -> "MqttDispatcherAggregate":
+        if mode == "tumbling":
+            return MqttDispatcherAggregateTumbling(window)
+        if mode == "sliding":
+            return MqttDispatcherAggregateSliding(window)
+        raise Exception(f"unknown aggregate mode '{mode}'")
+
+    def __init__(self, window: float) -> None:
+        if window <= 0:
+            raise Exception("aggregate window must be positive")
+        self.window = window
+        self.last_value = None
+        self.last_time = None
+
+    @abstractmethod
+    def add(self, value: Union[int, float], now: float) -> None:
+        """Adds a sample received at now (time.time())"""
+
+    @abstractmethod
+    def get(self, now: float = None) -> dict:
+        """Aggregates by function name, min, max and mean are None if there was no sample in the window"""
+
+    @abstractmethod
+    def get_state(self) -> dict:
+        """State of the aggregate as JSON serializable dict, e.g. for a snapshot"""
+
+    @abstractmethod
+    def set_state(self, state: dict) -> None:
+        """Restores a state returned by get_state()"""
+
+class MqttDispatcherAggregateTumbling(MqttDispatcherAggregate):
+    """Aggregates of the last completed window, windows don't overlap"""
+    MODE = "tumbling"
+
+    def __init__(self, window: float) -> None:
+        super().__init__(window)
+        self.window_start = None
+        self.completed = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.integral = 0.0
+
+    def _hold(self, until: float) -> None:
+        # integral of the last value from its time (or the window start) until the given time
+        if self.last_value is not None:
+            since = max(self.last_time, self.window_start)
+            if until > since:
+                self.integral += self.last_value * (until - since)
+
+    def _roll(self, now: float) -> None:
+        start = now - now % self.window
+        if self.window_start is None:
+            self.window_start = start
+            return
+        if start == self.window_start:
+            return
+
+        end = self.window_start + self.window
+        self._hold(end)
+        if start > end:
+            # the last completed window didn't have any samples, only the held value
+            self.completed = { "min": None, "max": None, "mean": None, "count": 0,
+                "integral": self.last_value * self.window if self.last_value is not None else 0.0 }
+        else:
+            self.completed = { "min": self.min, "max": self.max, "mean": self.sum / self.count if self.count else None,
+                "count": self.count, "integral": self.integral }
+        self.window_start = start
+        self._reset()
+
+    def add(self, value: Union[int, float], now: float) -> None:
+        self._roll(now)
+        self._hold(now)
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last_value = value
+        self.last_time = now
+
+    def get(self, now: float = None) -> dict:
+        self._roll(time.time() if now is None else now)
+        if self.completed is None:
+            return { "min": None, "max": None, "mean": None, "count": 0, "integral": None }
+        return self.completed
+
+    def get_state(self) -> dict:
+        return { "window_start": self.window_start, "completed": self.completed, "count": self.count, "sum": self.sum,
+            "min": self.min, "max": self.max, "integral": self.integral, "last_value": self.last_value, "last_time": self.last_time }
+
+    def set_state(self, state: dict) -> None:
+        for key in ("window_start", "completed", "count", "sum", "min", "max", "integral", "last_value", "last_time"):
+            setattr(self, key, state[key])
+
+class MqttDispatcherAggregateSliding(MqttDispatcherAggregate):
+    """Aggregates of the samples within the last window seconds
+
+    Min and max are kept in monotonic queues, so each sample is added and removed once.
+    """
+    MODE = "sliding"
+
+    def __init__(self, window: float) -> None:
+        super().__init__(window)
+        self.samples = deque() # (time, value)
+        self.sum = 0.0
+        self.min_queue = deque() # (time, value), increasing values
+        self.max_queue = deque() # (time, value), decreasing values
+        self.segments = deque() # (start, end, value) of held values
+        self.segments_sum = 0.0
+
+    def _expire(self, now: float) -> None:
+        start = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] < start:
+            self.sum -= samples.popleft()[1]
+        if not samples:
+            self.sum = 0.0 # no accumulated rounding errors
+        while self.min_queue and self.min_queue[0][0] < start:
+            self.min_queue.popleft()
+        while self.max_queue and self.max_queue[0][0] < start:
+            self.max_queue.popleft()
+        segments = self.segments
+        while segments and segments[0][1] <= start:
+            seg_start, seg_end, value = segments.popleft()
+            self.segments_sum -= value * (seg_end - seg_start)
+        if not segments:
+            self.segments_sum = 0.0
+
+    def add(self, value: Union[int, float], now: float) -> None:
+        if self.last_value is not None and now > self.last_time:
+            self.segments.append((self.last_time, now, self.last_value))
+            self.segments_sum += self.last_value * (now - self.last_time)
+
+        self.samples.append((now, value))
+        self.sum += value
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((now, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((now, value))
+
+        self.last_value = value
+        self.last_time = now
+        self._expire(now)
+
+    def get(self, now: float = None) -> dict:
+        if now is None:
+            now = time.time()
+        self._expire(now)
+        start = now - self.window
+
+        integral = self.segments_sum
+        if self.segments and self.segments[0][0] < start:
+            # the oldest segment started before the window
+            seg_start, _, value = self.segments[0]
+            integral -= value * (start - seg_start)
+        if self.last_value is not None:
+            integral += self.last_value * max(0.0, now - max(self.last_time, start))
+
+        count = len(self.samples)
+        return {
+            "min": self.min_queue[0][1] if self.min_queue else None,
+            "max": self.max_queue[0][1] if self.max_queue else None,
+            "mean": self.sum / count if count else None,
+            "count": count,
+            "integral": integral,
+        }
+
+    def get_state(self) -> dict:
+        return { "samples": list(self.samples), "min_queue": list(self.min_queue), "max_queue": list(self.max_queue),
+            "segments": list(self.segments), "last_value": self.last_value, "last_time": self.last_time }
+
+    def set_state(self, state: dict) -> None:
+        self.samples = deque(tuple(sample) for sample in state["samples"])
+        self.min_queue = deque(tuple(sample) for sample in state["min_queue"])
+        self.max_queue = deque(tuple(sample) for sample in state["max_queue"])
+        self.segments = deque(tuple(segment) for segment in state["segments"])
+        self.sum = math.fsum(value for _, value in self.samples)
+        self.segments_sum = math.fsum(value * (end - start) for start, end, value in self.segments)
+        self.last_value = state["last_value"]
+        self.last_time = state["last_time"]
+        self._expire(time.time())
+
+class MqttDispatcherFieldIndex:
+    """Sorted field ids, matched against patterns like 00_0010_7321_10_0100_* by their fixed prefix
+
+    The prefix before the first wildcard is looked up with bisect, only the ids within that range are
+    matched against the rest of the pattern (fnmatch syntax: *, ? and [...]).
+    """
+    WILDCARDS = "*?["
+
+    def __init__(self, field_ids) -> None:
+        self.ids = sorted(set(field_ids))
+
+    @classmethod
+    def is_pattern(cls, item: str) -> bool:
+        return isinstance(item, str) and any(c in item for c in cls.WILDCARDS)
+
+    @classmethod
+    def prefix(cls, pattern: str) -> str:
+        end = len(pattern)
+        for c in cls.WILDCARDS:
+            pos = pattern.find(c)
+            if pos >= 0:
+                end = min(end, pos)
+        return pattern[:end]
+
+    def match(self, pattern: str) -> list:
+        """Field ids matching the pattern in sorted order (i.e. by packet and offset)"""
+        prefix = self.prefix(pattern)
+        ids = self.ids
+        start = bisect.bisect_left(ids, prefix)
+        end = start
+        while end < len(ids) and ids[end].startswith(prefix):
+            end += 1
+        if pattern == prefix + "*":
+            return ids[start:end]
+        return [field_id for field_id in ids[start:end] if fnmatch.fnmatchcase(field_id, pattern)]
+
+class MqttDispatcherScheduler:
+    """Priority queue of deadlines based on time.monotonic()
+
+    Each entry holds a callback which is called with the current (monotonic) time once its
+    deadline is due. The callback returns its next deadline or None if it doesn't want to be
+    called again. A deadline that is already due is postponed by MIN_STEP, so each callback
+    runs at most once per run_due().
+    """
+    MIN_STEP = 0.01 # seconds
+    def __init__(self) -> None:
+        self.queue = []
+        self.sequence = itertools.count() # tie breaker, callbacks are not comparable
+
+    def schedule(self, deadline: float, callback: Callable[[float], Union[None, float]]) -> list:
+        """Adds a callback to the queue
+
+        Args:
+            deadline (float): time.monotonic() based time the callback is due
+            callback (Callable[[float], Union[None, float]]): called with the current time, returns the next deadline
+
+        Returns:
+            list: queue entry, can be used to cancel the callback
+        """
+        entry = [deadline, next(self.sequence), callback]
+        heapq.heappush(self.queue, entry)
+        return entry
+
+    def cancel(self, entry: list) -> None:
+        # lazy removal, the entry is dropped once it reaches the head of the queue
+        entry[2] = None
+
+    def next_deadline(self) -> Union[None, float]:
+        queue = self.queue
+        while queue and queue[0][2] is None:
+            heapq.heappop(queue)
+        if queue:
+            return queue[0][0]
+        return None
+
+    def run_due(self, now: float = None) -> Union[None, float]:
+        """Runs all callbacks that are due
+
+        Args:
+            now (float, optional): current time.monotonic(). Defaults to None.
+
+        Returns:
+            Union[None, float]: deadline of the head of the queue, None if nothing is scheduled
+        """
+        if now is None:
+            now = time.monotonic()
+
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            entry = queue[0]
+            callback = entry[2]
+            if callback is None:
+                heapq.heappop(queue)
+                continue
+
+            next_deadline = callback(now)
+            if next_deadline is None or entry[2] is None:
+                heapq.heappop(queue)
+            else:
+                # reuse the entry so previously returned handles stay valid
+                entry[0] = max(next_deadline, now + self.MIN_STEP)
+                entry[1] = next(self.sequence)
+                heapq.heapreplace(queue, entry)
+
+        return self.next_deadline()
+
+class _MqttDispatcherPublisherEntry:
+    __slots__ = ("topic", "payload", "qos", "retain", "expiry", "enqueued", "alive")
+
+    def __init__(self, topic, payload, qos, retain, expiry, enqueued) -> None:
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.expiry = expiry
+        self.enqueued = enqueued
+        self.alive = True
+
+class MqttDispatcherPublisher:
+    """Publishes messages to the MQTT client and buffers them while the broker is unreachable
+
+    The buffer is bounded by message count and payload bytes. The offline policy of each message
+    decides what is kept per topic: "latest" (default) keeps the newest message only, a number keeps
+    the newest N messages and "drop" discards messages while offline. After a reconnect, the buffer is
+    flushed with a limited rate.
+
+    With MQTT v5, topics are replaced by topic aliases as far as the broker allows and messages can
+    carry a message expiry interval.
+    """
+    FLUSH_PERIOD = 0.1 # seconds between flushed batches
+    MQTT_ERR_NO_CONN = 4 # paho.mqtt.client.MQTT_ERR_NO_CONN, not imported to keep the dispatcher independent of paho
+
+    def __init__(self, dispatcher: "MqttDispatcher", mqtt_client, config: dict = None, mqtt_v5: bool = False) -> None:
+        if config is None:
+            config = {}
+
+        self.dispatcher = dispatcher
+        self.mqtt_client = mqtt_client
+        self.mqtt_v5 = mqtt_v5
+
+        self.max_messages = json_get_or_default(config, "max_messages", 1000)
+        self.max_bytes = json_get_or_default(config, "max_bytes", 1024 * 1024)
+        self.flush_rate = json_get_or_default(config, "flush_rate", 50) # messages per second
+        self.default_policy = self.check_policy(json_get_or_default(config, "policy", "latest"))
+
+        self.connected = False
+        self.reconnected = False # set by the client thread, handled by the dispatcher thread
+
+        # topic aliases are only valid for one connection
+        self.connection_id = 0
+        self.alias_connection_id = 0
+        self.alias_max = 0
+        self.aliases = {} # topic -> alias
+
+        # entries in order of publishing, the per-topic deques reference the same entries to enforce the topic policies
+        self.queue = deque()
+        self.topics = {}
+        self.queue_depth = 0
+        self.queue_bytes = 0
+        self.flushing = False
+
+        self.last_info = None # message info of the last publish handed over to the client, None if buffered
+
+        self.stats_dropped = 0
+        self.stats_bytes = {} # topic -> bytes sent (estimated size of the PUBLISH packets)
+        self.stats_first_sent = None # time.monotonic() of the first message handed over to the client since the start or reset_first_sent()
+
+        if mqtt_v5:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+            self._properties = lambda: Properties(PacketTypes.PUBLISH)
+
+    @staticmethod
+    def check_policy(policy):
+        """Returns the offline policy if it is valid, raises an Exception otherwise"""
+        if policy is None or policy in ("latest", "drop"):
+            return policy
+        if isinstance(policy, int) and not isinstance(policy, bool) and policy > 0:
+            return policy
+        raise Exception(f"invalid offline policy '{policy}', must be 'latest', 'drop' or a count of messages")
+
+    def set_connected(self, connected: bool, topic_alias_max: int = 0) -> None:
+        """Updates the connection state, can be called from the MQTT client thread
+
+        Args:
+            connected (bool): True if the client is connected
+            topic_alias_max (int, optional): topic alias maximum granted by the broker (MQTT v5). Defaults to 0.
+        """
+        if connected:
+            self.alias_max = topic_alias_max
+            self.connection_id += 1
+        if connected and not self.connected:
+            self.reconnected = True
+            self.dispatcher.notify()
+        self.connected = connected
+
+    def reset_first_sent(self) -> None:
+        """Restarts the recording of the first message handed over to the client, e.g. to ignore status messages"""
+        self.stats_first_sent = None
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False, policy = None, expiry: int = None) -> None:
+        """Publishes a message or buffers it if the broker is unreachable
+
+        Args:
+            topic (str): full topic
+            payload (Any): message payload
+            qos (int, optional): quality of service. Defaults to 0.
+            retain (bool, optional): retain flag. Defaults to False.
+            policy (Union[None, str, int], optional): offline policy, None for the default policy. Defaults to None.
+            expiry (int, optional): message expiry interval in seconds (MQTT v5 only). Defaults to None.
+        """
+        self.last_info = None
+
+        # as long as buffered messages are pending, new messages are queued behind them to keep the order
+        if self.connected and self.queue_depth == 0:
+            if self._send(topic, payload, qos, retain, expiry):
+                return
+            self.connected = False
+
+        self._enqueue(topic, payload, qos, retain, policy, expiry)
+
+    def _send(self, topic, payload, qos, retain, expiry) -> bool:
+        """Hands the message over to the client, returns False if the client is not connected"""
+        # paho keeps messages with qos > 0 published while disconnected in its own unbounded queue
+        # and resends them after a reconnect, so they aren't handed over before the client is connected
+        if not self.mqtt_client.is_connected():
+            return False
+
+        if self.mqtt_v5:
+            info, wire_topic, properties_len = self._send_v5(topic, payload, qos, retain, expiry)
+        else:
+            info = self.mqtt_client.publish(topic, payload, qos = qos, retain = retain)
+            wire_topic, properties_len = topic, 0
+        self.last_info = info
+
+        if info is None or info.rc == 0:
+            if self.stats_first_sent is None:
+                self.stats_first_sent = time.monotonic()
+            self._count_bytes(topic, len(wire_topic.encode()), payload, qos, properties_len)
+            return True
+        if info.rc == self.MQTT_ERR_NO_CONN:
+            if qos > 0:
+                # the connection was lost in the meantime, paho already queued the message for a resend
+                self.connected = False
+                return True
+            return False
+        # other errors (e.g. the client's own queue is full) can't be fixed by buffering
+        self.stats_dropped += 1
+        return True
+
+    def _send_v5(self, topic, payload, qos, retain, expiry):
+        if self.alias_connection_id != self.connection_id:
+            self.alias_connection_id = self.connection_id
+            self.aliases = {}
+
+        properties = None
+        wire_topic = topic
+        alias = None
+        new_alias = False
+        # paho resends messages with qos > 0 after a reconnect as they were packed, an alias of the
+        # previous connection would be a protocol error, so they always carry the full topic
+        if qos == 0:
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                # the broker already knows the alias, the topic can be omitted
+                wire_topic = ""
+            elif len(self.aliases) < self.alias_max:
+                alias = len(self.aliases) + 1
+                new_alias = True
+
+        if alias is not None or expiry:
+            properties = self._properties()
+            if alias is not None:
+                properties.TopicAlias = alias
+            if expiry:
+                properties.MessageExpiryInterval = expiry
+
+        info = self.mqtt_client.publish(wire_topic, payload, qos = qos, retain = retain, properties = properties)
+        if new_alias and (info is None or info.rc == 0):
+            # the broker only knows the alias once the message was sent
+            self.aliases[topic] = alias
+
+        properties_len = 1 # zero length properties
+        if properties is not None:
+            properties_len = len(properties.pack())
+        return info, wire_topic, properties_len
+
+    def _count_bytes(self, topic, topic_len, payload, qos, properties_len) -> None:
+        remaining = 2 + topic_len + properties_len + self._payload_len(payload)
+        if qos > 0:
+            remaining += 2 # packet identifier
+
+        header = 2
+        while remaining >= 128 ** (header - 1):
+            header += 1
+
+        self.stats_bytes[topic] = self.stats_bytes.get(topic, 0) + header + remaining
+
+    def _enqueue(self, topic, payload, qos, retain, policy, expiry) -> None:
+        if policy is None:
+            policy = self.default_policy
+        if policy == "drop":
+            self.stats_dropped += 1
+            return
+
+        keep = 1 if policy == "latest" else int(policy)
+
+        entry = _MqttDispatcherPublisherEntry(topic, payload, qos, retain, expiry, time.monotonic())
+        topic_entries = self.topics.get(topic)
+        if topic_entries is None:
+            topic_entries = deque()
+            self.topics[topic] = topic_entries
+        topic_entries.append(entry)
+        self.queue.append(entry)
+        self.queue_depth += 1
+        self.queue_bytes += self._payload_len(payload)
+
+        while len(topic_entries) > keep:
+            self._discard(topic_entries.popleft())
+
+        # evict the oldest messages of any topic to stay within the memory bounds
+        queue = self.queue
+        while self.queue_depth > self.max_messages or self.queue_bytes > self.max_bytes:
+            oldest = queue.popleft()
+            if oldest.alive:
+                self._discard(oldest)
+                self._forget(oldest)
+
+        # collapsed entries stay in the queue until they reach its head, compact it once they dominate
+        if len(queue) > 2 * self.queue_depth + 16:
+            self.queue = deque(entry for entry in queue if entry.alive)
+
+    @staticmethod
+    def _payload_len(payload) -> int:
+        if payload is None:
+            return 0
+        if isinstance(payload, (bytes, bytearray)):
+            return len(payload)
+        if isinstance(payload, str):
+            return len(payload.encode())
+        return len(str(payload))
+
+    def _remove(self, entry) -> None:
+        entry.alive = False
+        self.queue_depth -= 1
+        self.queue_bytes -= self._payload_len(entry.payload)
+        entry.payload = None
+
+    def _discard(self, entry) -> None:
+        self._remove(entry)
+        self.stats_dropped += 1
+
+    def _forget(self, entry) -> None:
+        topic_entries = self.topics[entry.topic]
+        topic_entries.remove(entry)
+        if not topic_entries:
+            del self.topics[entry.topic]
+
+    def tick(self, now: float) -> None:
+        if self.reconnected:
+            self.reconnected = False
+            if self.queue_depth > 0 and not self.flushing:
+                self.flushing = True
+                self.dispatcher.scheduler.schedule(now, self.flush)
+
+    def flush(self, now: float) -> Union[None, float]:
+        """Sends a batch of buffered messages, called by the dispatcher's scheduler"""
+        batch = max(1, round(self.flush_rate * self.FLUSH_PERIOD))
+        queue = self.queue
+        while batch > 0 and queue and self.connected:
+            entry = queue[0]
+            if entry.alive:
+                expiry = entry.expiry
+                if expiry:
+                    # the time spent in the buffer counts towards the expiry interval
+                    expiry -= int(now - entry.enqueued)
+                    if expiry <= 0:
+                        self._discard(entry)
+                        self._forget(entry)
+                        queue.popleft()
+                        continue
+
+                if not self._send(entry.topic, entry.payload, entry.qos, entry.retain, expiry):
+                    self.connected = False
+                    break
+                self._forget(entry)
+                self._remove(entry)
+                batch -= 1
+            queue.popleft()
+
+        if self.queue_depth == 0:
+            queue.clear()
+        elif self.connected:
+            return now + self.FLUSH_PERIOD
+
+        # stops flushing, the next reconnect restarts it
+        self.flushing = False
+        return None
+
 class MqttDispatcherPlugin:
     def __init__(self, dispatcher: "MqttDispatcher", cfg_plugin: dict) -> None:
         self.dispatcher = dispatcher
         self.name = json_get_or_fail(cfg_plugin, "name")
 
         module_name, module_classname = json_get_or_fail(cfg_plugin, "module").split(":")
+        plugin_cfg = json_get_or_default(cfg_plugin, "config", None)
 
-        module = importlib.import_module(module_name)
-        cls = getattr(module, module_classname)
+        # plugins run in the dispatcher thread (inline), a worker thread or a worker process
+        cfg_execution = json_get_or_default(cfg_plugin, "execution", {})
+        self.mode = json_get_or_default(cfg_execution, "mode", "inline")
+        self.worker = None
+        self.collect = None # results stored with set_value() while a worker runs the plugin
+
+        if self.mode == "process":
+            from PluginWorker import PluginWorker, PluginProcessExecutor
+            self.plugin_obj = None
+            self.worker = PluginWorker(self.name, PluginProcessExecutor(self.name, module_name, module_classname, plugin_cfg), cfg_execution)
+            self.subscriptions = self.worker.subscriptions
+        elif self.mode in ("inline", "thread"):
+            module = importlib.import_module(module_name)
+            cls = getattr(module, module_classname)
+            self.plugin_obj = cls(self, plugin_cfg)
+            self.subscriptions = getattr(self.plugin_obj, "subscriptions", [])
+
+            if self.mode == "thread":
+                from PluginWorker import PluginWorker, PluginThreadExecutor
+                self.worker = PluginWorker(self.name, PluginThreadExecutor(self), cfg_execution)
+        else:
+            raise Exception(f"unknown execution mode '{self.mode}' of plugin '{self.name}'")
 
-        plugin_cfg = json_get_or_default(cfg_plugin, "config", None)
-        self.plugin_obj = cls(self, plugin_cfg)
+        # plugins opt in to get the values of their subscribed fields pushed, batched per message.
+        # Workers always get them, their results are computed after each message.
+        self.on_update = getattr(self.plugin_obj, "update", None)
+        self.on_change = getattr(self.plugin_obj, "change", None)
+        self.push = self.worker is not None or callable(self.on_update) or callable(self.on_change)
+
+        # results stored with set_value(), valid until the next delivery or tick
+        self.values = {}
+
+        if self.worker is None:
+            # plugins get their first tick right away and return their next time.time() deadline
+            self.dispatcher.scheduler.schedule(time.monotonic(), self.tick)
+
+    def tick(self, now: float = None) -> Union[None, float]:
+        self.values.clear()
+        return tick_deadline(self.plugin_obj.tick())
 
-    def tick(self):
-        return self.plugin_obj.tick()
+    def deliver(self, updated: dict, changed: dict) -> None:
+        """Passes the values of subscribed fields of a message to the plugin
+
+        Args:
+            updated (dict): values by field id of all subscribed fields in the message
+            changed (dict): values by field id of the subscribed fields that changed
+        """
+        if self.worker is not None:
+            self.worker.submit(updated, changed)
+            return
+
+        self.values.clear()
+        try:
+            if callable(self.on_update):
+                self.on_update(updated)
+            if changed and callable(self.on_change):
+                self.on_change(changed)
+        except:
+            import traceback
+            traceback.print_exc()
+
+    def get_function(self, function: str) -> Union[None, Callable]:
+        """Method plugin_<function> of the plugin, None if the plugin runs in a worker
+
+        Raises:
+            Exception: the plugin doesn't have the method
+        """
+        if self.worker is not None:
+            self.worker.require(function)
+            if self.plugin_obj is None:
+                return None # checked by the worker process
+
+        func_name = "plugin_" + function
+        plugin_function = getattr(self.plugin_obj, func_name, None)
+        if not callable(plugin_function):
+            raise Exception(f"method '{func_name}' of plugin '{self.name}' is not callable")
+        return plugin_function
+
+    def set_value(self, function: str, value) -> None:
+        """Stores the result of a plugin function, e.g. computed in update(), so it isn't called on publish"""
+        if self.collect is not None:
+            self.collect[function] = value
+        else:
+            self.values[function] = value
+
+    def get_value(self, function: str, plugin_function: Callable):
+        """Result of a plugin function, the value stored with set_value() if there is one"""
+        if self.worker is not None:
+            return self.worker.get_value(function)
+
+        values = self.values
+        if function in values:
+            return values[function]
+        # functions without a stored value might depend on time or other state, they are called on each publish
+        return plugin_function()
+
+    def stop(self) -> None:
+        if self.worker is not None:
+            self.worker.stop()
 
 class MqttDispatcher:
-    def __init__(self, mqtt_client, plugin_cfgs = None, transfer_cfgs = None, mqtt_topic_prefix="") -> None:
+    SNAPSHOT_VERSION = 1
+    def __init__(self, mqtt_client, plugin_cfgs = None, transfer_cfgs = None, mqtt_topic_prefix="", publisher_cfg = None, mqtt_v5 = False, memory_cfg = None, history_cfg = None, snapshot_cfg = None, vbus_spec = None) -> None:
         self.mqtt_client = mqtt_client
+        self.vbus_spec = vbus_spec # to expand field patterns of transfers
+        self.field_index = None
+        self.spec_fields = None # field id -> VbusPacketField
         self.mqtt_topic_prefix = mqtt_topic_prefix
         self.plugins = {}
         self.fields = {}
+        self.sinks = [] # e.g. SqliteSink, get the values of each message, must not block
+        self.scheduler = MqttDispatcherScheduler()
+        self.wakeup = threading.Event() # set to interrupt the wait for the next tick
+        self.publisher = MqttDispatcherPublisher(self, mqtt_client, publisher_cfg, mqtt_v5)
+
+        # optional LatencyTracer, trace holds the timestamps of the message currently being processed
+        self.tracer = None
+        self.trace = None
+
+        # memory is sampled by the scheduler, meta fields only return the cached values
+        self.memory = MemoryMonitor(memory_cfg)
+        self.scheduler.schedule(time.monotonic(), self.memory.sample)
 
         self.metafields = {
-            "sw:ramuse" : lambda self: sum(sys.getsizeof(i) for i in gc.get_objects()),
+            "sw:ramuse" : lambda target: self.memory.get_rss(),
+            "sw:rss" : lambda target: self.memory.get_rss(),
+            "sw:pss" : lambda target: self.memory.get_pss(),
+            "sw:tracemalloc_top" : lambda target: self.memory.get_top_allocations(),
+            "trace:latency" : lambda target: self.tracer.get_stats() if self.tracer is not None else None,
             "sw:pid" : lambda that: os.getpid(),
             "time:now": lambda self: dt_to_iso8601(datetime.now()),
+            "mqtt:queue_depth" : lambda target: self.publisher.queue_depth,
+            "mqtt:queue_dropped" : lambda target: self.publisher.stats_dropped,
+            "mqtt:bytes_sent" : lambda target: sum(self.publisher.stats_bytes.values()),
+            "plugin:workers" : lambda target: { name: plugin.worker.get_stats() for name, plugin in self.plugins.items() if plugin.worker is not None },
         }
 
+        # fields with history, either a list of field ids with the default capacity or capacities by field id
+        if history_cfg is not None:
+            capacity = json_get_or_default(history_cfg, "capacity", 600)
+            history_fields = json_get_or_default(history_cfg, "fields", [])
+            if isinstance(history_fields, list):
+                history_fields = { field_id: capacity for field_id in history_fields }
+            for field_id, field_capacity in history_fields.items():
+                self.track_history(field_id, field_capacity)
+
         for plugin_cfg in plugin_cfgs:
             plugin_name = json_get_or_fail(plugin_cfg, "name")
-            self.plugins[plugin_name] = MqttDispatcherPlugin(self, plugin_cfg)
+            plugin = MqttDispatcherPlugin(self, plugin_cfg)
+            self.plugins[plugin_name] = plugin
+
+            # the fields are stored even if no transfer uses them
+            for sub in plugin.subscriptions:
+                field = self.get_or_add_field(sub)
+                if plugin.push and plugin not in field.plugins:
+                    field.plugins.append(plugin)
 
         self.transfers = []
 
@@ -82,19 +967,35 @@ class MqttDispatcher:
                 subs = transfer.get_field_subscriptions({}) #WAT?
 
                 for sub in subs:
-                    if sub in self.fields:
-                        field = self.fields[sub]
-                    else:
-                        field = MqttDispatcherField()
-                        self.fields[sub] = field
+                    field = self.get_or_add_field(sub)
 
                     if transfer not in field.transfers:
                         field.transfers.append(transfer)
 
-    def update_fields(self, val_dict: dict, timestamp: datetime) -> None:
+        # values of the last run, written periodically and restored once all fields are known
+        self.snapshot_file = None
+        self.snapshot_restored = 0
+        if snapshot_cfg is not None:
+            self.snapshot_file = json_get_or_fail(snapshot_cfg, "file")
+            self.snapshot_interval = json_get_or_default(snapshot_cfg, "interval", 60)
+            self.snapshot_restored = self.restore_snapshot(json_get_or_default(snapshot_cfg, "max_age", 3600))
+            self.scheduler.schedule(time.monotonic() + self.snapshot_interval, self.write_snapshot)
+
+    def update_fields(self, val_dict: dict, timestamp: datetime, trace: tuple = None) -> None:
+        """Updates the fields with the values of a message and triggers the transfers using them
+
+        Args:
+            val_dict (dict): values by field id
+            timestamp (datetime): time the values were received
+            trace (tuple, optional): time.time() of first byte, frame end and decoding of the message, used for tracing. Defaults to None.
+        """
+        if trace is not None and self.tracer is not None:
+            self.trace = trace + (time.time(),)
+
         transfers_updated = []
         transfers_changed = []
         fields_changed = []
+        plugins_updated = {} # plugin -> (updated values, changed values)
 
         for key in val_dict:
             value = val_dict[key]
@@ -110,6 +1011,15 @@ class MqttDispatcher:
 
             fields_changed.append(key)
 
+            for plugin in field.plugins:
+                delta = plugins_updated.get(plugin)
+                if delta is None:
+                    delta = ({}, {})
+                    plugins_updated[plugin] = delta
+                delta[0][key] = value
+                if changed is True:
+                    delta[1][key] = value
+
             for transfer in field.transfers:
                 if not transfer in transfers_updated:
                     transfers_updated.append(transfer)
@@ -117,23 +1027,209 @@ class MqttDispatcher:
                         if not transfer in transfers_changed:
                             transfers_changed.append(transfer)
 
+        # plugins first, transfers triggered by this message already get their new results
+        for plugin, (updated, changed) in plugins_updated.items():
+            plugin.deliver(updated, changed)
+
         for transfer in transfers_updated:
             transfer.updated(fields_changed, timestamp)
 
         for transfer in transfers_changed:
             transfer.changed(fields_changed, timestamp)
 
+        for sink in self.sinks:
+            sink.write(val_dict, timestamp)
 
         for key in self.fields:
             # reset updated and changed flags
             self.fields[key].updated = False
             self.fields[key].changed = False
 
+        self.trace = None
+
+    def stop(self) -> None:
+        """Stops the plugin workers and the sinks, writes the last snapshot"""
+        self.memory.stop()
+        for plugin in self.plugins.values():
+            plugin.stop()
+        for sink in self.sinks:
+            sink.stop()
+        if self.snapshot_file is not None:
+            self.write_snapshot()
+
+    def get_snapshot(self) -> dict:
+        """Values with their timestamps and the aggregate states of all fields that were received"""
+        fields = {}
+        aggregates = {}
+        for key, field in self.fields.items():
+            if field.timestamp is None:
+                continue
+            fields[key] = [field.value, field.timestamp.timestamp()]
+            if field.aggregates:
+                aggregates[key] = [[aggregate.MODE, aggregate.window, aggregate.get_state()] for aggregate in field.aggregates]
+        return { "version": self.SNAPSHOT_VERSION, "time": time.time(), "fields": fields, "aggregates": aggregates }
+
+    def write_snapshot(self, now: float = None) -> Union[None, float]:
+        """Writes the snapshot file, replacing the previous one atomically, called by the scheduler"""
+        tmp_file = self.snapshot_file + ".tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self.get_snapshot(), f, separators=(",", ":"))
+            os.replace(tmp_file, self.snapshot_file)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not write snapshot '{self.snapshot_file}': {e}")
+        if now is None:
+            return None
+        return now + self.snapshot_interval
+
+    def restore_snapshot(self, max_age: float = None) -> int:
+        """Restores the values of known fields from the snapshot file, without triggering transfers
+
+        Values keep their original timestamps, so the max_age of transfer items still applies. Push
+        plugins get the restored values delivered like an update.
+
+        Args:
+            max_age (float, optional): maximum age of restored values in seconds. Defaults to None (any age).
+
+        Returns:
+            int: count of restored fields
+        """
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Could not read snapshot '{self.snapshot_file}': {e}")
+            return 0
+
+        if not isinstance(snapshot, dict) or snapshot.get("version") != self.SNAPSHOT_VERSION or \
+                not isinstance(snapshot.get("fields"), dict) or not isinstance(snapshot.get("aggregates", {}), dict):
+            print(f"Ignoring snapshot '{self.snapshot_file}' with unknown version or format")
+            return 0
+
+        now = time.time()
+        restored = {}
+        plugins_restored = {}
+        for key, entry in snapshot["fields"].items():
+            field = self.fields.get(key)
+            if field is None:
+                continue
+            try:
+                value, timestamp = entry
+                if max_age is not None and now - timestamp > max_age:
+                    continue
+                field_timestamp = datetime.fromtimestamp(timestamp)
+            except (TypeError, ValueError, OverflowError, OSError) as e:
+                print(f"Skipping invalid snapshot entry of field '{key}': {e}")
+                continue
+            field.value = value
+            field.timestamp = field_timestamp
+            restored[key] = value
+            for plugin in field.plugins:
+                plugins_restored.setdefault(plugin, {})[key] = value
+
+        for key, states in snapshot.get("aggregates", {}).items():
+            field = self.fields.get(key)
+            if field is None:
+                continue
+            try:
+                for mode, window, state in states:
+                    for aggregate in field.aggregates:
+                        if aggregate.MODE == mode and aggregate.window == window:
+                            previous = dict(aggregate.__dict__)
+                            try:
+                                aggregate.set_state(state)
+                            except:
+                                # keep the aggregate consistent, it starts empty as without snapshot
+                                aggregate.__dict__.update(previous)
+                                raise
+            except (TypeError, ValueError, KeyError, AttributeError, OverflowError) as e:
+                print(f"Skipping invalid snapshot aggregates of field '{key}': {e}")
+
+        for plugin, values in plugins_restored.items():
+            plugin.deliver(values, values)
+
+        if restored:
+            print(f"Restored {len(restored)} field values from snapshot '{self.snapshot_file}'")
+        return len(restored)
+
     def get_metafield(self, meta_name, target):
         if meta_name in self.metafields:
             return self.metafields[meta_name](target)
         return f"unknown meta field '{meta_name}'"
 
+    def match_fields(self, pattern: str) -> list:
+        """Ids of all fields of the VSF matching a pattern, e.g. 00_0010_7321_10_0100_* for all fields of a packet"""
+        if self.field_index is None:
+            if self.vbus_spec is None:
+                raise Exception(f"field pattern '{pattern}' can't be expanded without VSF file")
+            # built once, all patterns of the config are matched against the same index
+            self.spec_fields = { field.full_id: field for packet in self.vbus_spec.packet_templates for field in packet.fields }
+            self.field_index = MqttDispatcherFieldIndex(self.spec_fields)
+        return self.field_index.match(pattern)
+
+    def get_or_add_field(self, fieldname: str) -> MqttDispatcherField:
+        field = self.fields.get(fieldname)
+        if field is None:
+            field = MqttDispatcherField()
+            self.fields[fieldname] = field
+        return field
+
+    def track_history(self, fieldname: str, capacity: int = 600) -> MqttDispatcherFieldHistory:
+        """Keeps the last values of a field, e.g. called by plugins in their constructor
+
+        Args:
+            fieldname (str): field id
+            capacity (int, optional): count of values kept, the largest requested capacity is used. Defaults to 600.
+
+        Returns:
+            MqttDispatcherFieldHistory: history of the field
+        """
+        field = self.get_or_add_field(fieldname)
+        if field.history is None or field.history.capacity < capacity:
+            history = MqttDispatcherFieldHistory(capacity)
+            if field.history is not None:
+                for timestamp, value in field.history.range():
+                    history.append(value, timestamp)
+            field.history = history
+        return field.history
+
+    def get_field_history(self, fieldname: str, seconds: float = None, since: float = None, until: float = None) -> Union[None, MqttDispatcherHistoryRange]:
+        """Values of a field with history
+
+        Args:
+            fieldname (str): field id
+            seconds (float, optional): only values of the last seconds. Defaults to None.
+            since (float, optional): only values received at or after this time.monotonic(). Defaults to None.
+            until (float, optional): only values received at or before this time.monotonic(). Defaults to None.
+
+        Returns:
+            Union[None, MqttDispatcherHistoryRange]: view of the values, None if the field has no history
+        """
+        field = self.fields.get(fieldname)
+        if field is None or field.history is None:
+            return None
+        if seconds is not None:
+            since = time.monotonic() - seconds
+        return field.history.range(since, until)
+
+    def get_field_rate(self, fieldname: str, seconds: float, fit: bool = False) -> Union[None, float]:
+        """Change per second of a field with history over the last seconds
+
+        Args:
+            fieldname (str): field id
+            seconds (float): time span
+            fit (bool, optional): least squares fit of all values instead of first and last value. Defaults to False.
+
+        Returns:
+            Union[None, float]: rate of change, None if there are less than two values
+        """
+        values = self.get_field_history(fieldname, seconds)
+        if values is None:
+            return None
+        return values.slope() if fit else values.rate()
+
     def get_field(self, fieldname):
         if fieldname in self.fields:
             return self.fields[fieldname]
@@ -153,25 +1249,65 @@ class MqttDispatcher:
             
         return None
 
-    def tick(self) -> float:
-        next_time = None
-        for plugin_name in self.plugins:
-            plugin = self.plugins[plugin_name]
-            plugin_next = plugin.tick()
-            if plugin_next is not None:
-                if next_time is None:
-                    next_time = plugin_next
-                elif plugin_next < next_time:
-                    next_time = plugin_next
+    def notify(self) -> None:
+        """Wakes up the thread waiting in wait(), can be called from any thread"""
+        self.wakeup.set()
+
+    def wait(self, deadline: Union[None, float]) -> None:
+        """Blocks until the deadline is reached or notify() is called
+
+        Args:
+            deadline (Union[None, float]): time.monotonic() based time, None to wait for notify() only
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+        self.wakeup.wait(timeout)
+        # clear before the caller processes pending work, notifications arriving later aren't lost
+        self.wakeup.clear()
+
+    def tick(self) -> Union[None, float]:
+        """Runs plugins and transfers that are due
 
+        Returns:
+            Union[None, float]: time.monotonic() based time of the next tick, None if nothing is scheduled
+        """
+        now = time.monotonic()
+        for plugin in self.plugins.values():
+            # a restarted worker process might subscribe other fields
+            if plugin.worker is not None and plugin.worker.subscriptions is not plugin.subscriptions:
+                self.resubscribe_plugin(plugin)
+        self.publisher.tick(now)
+        return self.scheduler.run_due(now)
+
+    def resubscribe_plugin(self, plugin: MqttDispatcherPlugin) -> None:
+        """Takes over the current subscriptions of a plugin worker and updates the fields of the plugin and the transfers"""
+        old = set(plugin.subscriptions)
+        plugin.subscriptions = plugin.worker.subscriptions
+        new = set(plugin.subscriptions)
+        print(f"Subscriptions of plugin '{plugin.name}' changed")
+
+        for sub in old - new:
+            field = self.fields.get(sub)
+            if field is not None and plugin in field.plugins:
+                field.plugins.remove(plugin)
+        for sub in new - old:
+            field = self.get_or_add_field(sub)
+            if plugin.push and plugin not in field.plugins:
+                field.plugins.append(plugin)
+
+        # transfers with items of the plugin are triggered by its subscriptions
         for transfer in self.transfers:
-            transfer_next = transfer.tick()
-            if transfer_next is not None:
-                if next_time is None:
-                    next_time = transfer_next
-                elif transfer_next < next_time:
-                    next_time = transfer_next
-        return next_time
+            subs = transfer.get_field_subscriptions({})
+            for key, field in self.fields.items():
+                if key not in subs and transfer in field.transfers:
+                    field.transfers.remove(transfer)
+            for sub in subs:
+                field = self.get_or_add_field(sub)
+                if transfer not in field.transfers:
+                    field.transfers.append(transfer)
 
 class TransferTrigger:
     @staticmethod
@@ -181,6 +1317,8 @@ class TransferTrigger:
             return TransferTriggerUpdate(transfer, cfg_trigger)
         if trig_type == "interval":
             return TransferTriggerInterval(transfer, cfg_trigger)
+        if trig_type == "round":
+            return TransferTriggerRound(transfer, cfg_trigger)
 
     def __init__(self, transfer, cfg_trigger) -> None:
         self.transfer = transfer
@@ -206,9 +1344,6 @@ class TransferTriggerUpdate(TransferTrigger):
     def changed(self, fields, timestamp) -> bool:
         return False
 
-    def tick(self) -> Union[None, float]:
-        return None
-
 class TransferTriggerInterval(TransferTrigger):
     def __init__(self, transfer, cfg_trigger) -> None:
         super().__init__(transfer, cfg_trigger)
@@ -216,7 +1351,8 @@ class TransferTriggerInterval(TransferTrigger):
         self.interval = json_get_or_fail(cfg_trigger, "interval")
         self.max_age = json_get_or_default(cfg_trigger, "max_age", None)
 
-        self.next_transfer = time.time()
+        self.next_transfer = time.monotonic()
+        transfer.dispatcher.scheduler.schedule(self.next_transfer, self.tick)
 
     def updated(self, fields, timestamp) -> bool:
         return False
@@ -224,22 +1360,92 @@ class TransferTriggerInterval(TransferTrigger):
     def changed(self, fields, timestamp) -> bool:
         return False
 
-    def tick(self) -> Union[None, float]:
-        now = time.time()
-        #TODO: also consider ticks from plugins
-        if now >= self.next_transfer:
-
-            self.transfer.transmit()
+    def tick(self, now: float) -> Union[None, float]:
+        # only called by the scheduler once the deadline is due
+        self.transfer.transmit()
 
-            self.next_transfer += self.interval
+        self.next_transfer += self.interval
 
-            # if, for some reason, the next transfer is lagging, reschedule the next transfer
-            now = time.time()
-            if self.next_transfer <= now:
-                self.next_transfer = now + self.interval
+        # if, for some reason, the next transfer is lagging, reschedule the next transfer
+        if self.next_transfer <= now:
+            self.next_transfer = now + self.interval
 
         return self.next_transfer
 
+class TransferTriggerRound(TransferTrigger):
+    """Transmits once per round, when every packet the transfer uses was received since the last transmit
+
+    The packets are derived from the field ids of the transfer (e.g. 00_0010_7321_10_0100 of
+    00_0010_7321_10_0100_000_2_0) unless they are configured. If a round isn't complete within
+    the timeout after its first packet, the transfer is transmitted with the values available.
+    """
+    def __init__(self, transfer, cfg_trigger) -> None:
+        super().__init__(transfer, cfg_trigger)
+
+        self.timeout = json_get_or_default(cfg_trigger, "timeout", 60)
+        self.packets = json_get_or_default(cfg_trigger, "packets", None)
+
+        self.field_packets = None # field id -> packet id, built by Transfer.construct() once the fields of the transfer exist
+        self.received = set() # packets received in the current round
+        self.timeout_entry = None
+
+        self.stats_complete = 0
+        self.stats_timeout = 0
+        transfer.metafields["transfer:rounds"] = lambda target: { "complete": self.stats_complete, "timeout": self.stats_timeout }
+
+    def init_packets(self) -> None:
+        self.field_packets = {}
+        for field_id in self.transfer.get_field_subscriptions({}):
+            parts = field_id.split("_")
+            if len(parts) == 8:
+                self.field_packets[field_id] = "_".join(parts[:5])
+        if self.packets is None:
+            self.packets = set(self.field_packets.values())
+        else:
+            self.packets = set(self.packets)
+            # a round could never be completed with a packet that isn't used by any field
+            unused = self.packets - set(self.field_packets.values())
+            if unused:
+                raise Exception(f"packets {sorted(unused)} of the round trigger of transfer '{self.transfer.mqtt_topic}' aren't used by any field")
+            self.field_packets = { field_id: packet_id for field_id, packet_id in self.field_packets.items() if packet_id in self.packets }
+        if not self.packets:
+            raise Exception(f"round trigger of transfer '{self.transfer.mqtt_topic}' has no packets, it needs fields of VBus packets")
+
+    def updated(self, fields, timestamp) -> bool:
+        new_round = not self.received
+        for field_id in fields:
+            packet_id = self.field_packets.get(field_id)
+            if packet_id is not None:
+                self.received.add(packet_id)
+        if not self.received:
+            return False
+
+        if len(self.received) >= len(self.packets):
+            self.stats_complete += 1
+            self._transmit()
+            return True
+
+        if new_round and self.timeout is not None:
+            self.timeout_entry = self.transfer.dispatcher.scheduler.schedule(time.monotonic() + self.timeout, self.tick)
+        return False
+
+    def changed(self, fields, timestamp) -> bool:
+        return False
+
+    def tick(self, now: float) -> Union[None, float]:
+        # the round wasn't complete within the timeout
+        self.timeout_entry = None
+        self.stats_timeout += 1
+        self._transmit()
+        return None
+
+    def _transmit(self) -> None:
+        self.received = set()
+        if self.timeout_entry is not None:
+            self.transfer.dispatcher.scheduler.cancel(self.timeout_entry)
+            self.timeout_entry = None
+        self.transfer.transmit()
+
 class Transfer:
     @staticmethod
     def construct(dispatcher, config) -> "Transfer":
@@ -250,10 +1456,16 @@ class Transfer:
             cls = TransferDirect
         elif type == "json":
             cls = TransferJson
+        elif type == "msgpack":
+            cls = TransferMsgpack
         else:
             raise Exception("unknown type for transfer configuration")
 
-        return cls(dispatcher, config)
+        transfer = cls(dispatcher, config)
+        if isinstance(transfer.trigger, TransferTriggerRound):
+            # the trigger is created before the fields of the transfer
+            transfer.trigger.init_packets()
+        return transfer
 
     @classmethod
     def _cfg_get_fields(cls, transfer, parent, cfg_fields):
@@ -272,6 +1484,10 @@ class Transfer:
     def _cfg_get_field(cls, transfer, parent, field):
         if "group" in field:
             item = TransferGroup(transfer, parent, field)
+        elif "item" in field and MqttDispatcherFieldIndex.is_pattern(field["item"]):
+            item = TransferPatternitem(transfer, parent, field)
+        elif "item" in field and "aggregate" in field:
+            item = TransferAggregateitem(transfer, parent, field)
         elif "item" in field:
             item = TransferValueitem(transfer, parent, field)
         elif "meta" in field:
@@ -286,18 +1502,29 @@ class Transfer:
         self.config = config
 
         self.metafields = {
-            # nothing at all
+            "transfer:bytes_sent" : lambda target: self.dispatcher.publisher.stats_bytes.get(self.full_topic, 0),
         }
 
         self.mqtt_topic = json_get_or_fail(config["mqtt"], "topic", "mqtt")
         self.mqtt_retain = json_get_or_default(config["mqtt"], "retain", False)
         self.mqtt_qos = json_get_or_default(config["mqtt"], "qos", 0)
+        self.mqtt_offline = MqttDispatcherPublisher.check_policy(json_get_or_default(config["mqtt"], "offline", None))
+        self.full_topic = f"{self.dispatcher.mqtt_topic_prefix}{self.mqtt_topic}"
+
+        self.metrics_render = metrics.histogram("vbus2mqtt_render_seconds", "Time to create the content of a transfer", ("transfer",)).labels(self.full_topic)
+        self.metrics_publish = metrics.histogram("vbus2mqtt_publish_seconds", "Time to hand a transfer over to the MQTT client", ("transfer",)).labels(self.full_topic)
 
         self.trigger = TransferTrigger.construct(self, json_get_or_fail(config, "trigger"))
 
+        # message expiry interval (MQTT v5), interval data expires after two missed intervals by default
+        default_expiry = None
+        if isinstance(self.trigger, TransferTriggerInterval):
+            default_expiry = math.ceil(2 * self.trigger.interval)
+        self.mqtt_expiry = json_get_or_default(config["mqtt"], "expiry", default_expiry)
+
     def get_metafield(self, meta_name, target):
         if meta_name in self.metafields:
-            return self.meta_fields[meta_name](target)
+            return self.metafields[meta_name](target)
 
         return self.dispatcher.get_metafield(meta_name, target)
 
@@ -309,17 +1536,29 @@ class Transfer:
         #print(f"transfer {self.mqtt_topic} got a change")
         return self.trigger.changed(fields, timestamp)
 
-    def tick(self):
-        return self.trigger.tick()
-
     def transmit(self):
         #print("transmit", self.mqtt_topic, ": ", self.get_content())
-        topic = f"{self.dispatcher.mqtt_topic_prefix}{self.mqtt_topic}"
+        render_start = time.perf_counter()
         content = self.get_content()
         #print(content)
         if isinstance(content, dict):
             content = json.dumps(content)
-        self.dispatcher.mqtt_client.publish(topic, content, qos = self.mqtt_qos, retain = self.mqtt_retain)
+        publish_start = time.perf_counter()
+        self.metrics_render.observe(publish_start - render_start)
+
+        publisher = self.dispatcher.publisher
+        publisher.publish(self.full_topic, content, self.mqtt_qos, self.mqtt_retain, self.mqtt_offline, self.mqtt_expiry)
+        publish_end = time.perf_counter()
+        self.metrics_publish.observe(publish_end - publish_start)
+
+        trace = self.dispatcher.trace
+        if trace is not None:
+            # convert the perf_counter() stages to the time.time() base of the trace
+            offset = time.time() - publish_end
+            info = publisher.last_info
+            self.dispatcher.tracer.record(self.full_topic,
+                trace + (render_start + offset, publish_start + offset, publish_end + offset),
+                info.mid if info is not None else None)
 
 class TransferDirect(Transfer):
     def __init__(self, dispatcher, config) -> None:
@@ -354,6 +1593,77 @@ class TransferJson(Transfer):
             retval = field.get_field_subscriptions(retval)
         return retval
 
+class TransferMsgpack(TransferJson):
+    """Publishes the same field tree as TransferJson, but encoded with MessagePack
+
+    With the layout "array" (default), only the values are sent as a flat array. The order of the values
+    is described by a schema that is published once with retain. With the layout "map", the nested maps
+    are sent just like the json transfer would do. In both cases, the constant parts of the message
+    (headers, keys) are compiled once and only the values are encoded when transmitting.
+    """
+    def __init__(self, dispatcher, config) -> None:
+        super().__init__(dispatcher, config)
+
+        self.layout = json_get_or_default(config, "layout", "array")
+        self.float32 = json_get_or_default(config, "float32", False)
+        self.schema_topic = json_get_or_default(config, "schema_topic", f"{self.mqtt_topic}/schema")
+        self.schema_published = False
+
+        # list of either constant bytes or items whose content gets encoded
+        self.encoder = []
+        self.schema = []
+        if self.layout == "array":
+            self._compile_array(self.fields, "")
+            self.encoder.insert(0, msgpack_array_header(len(self.schema)))
+        elif self.layout == "map":
+            self._compile_map(self.fields)
+        else:
+            raise Exception(f"unknown layout '{self.layout}' for msgpack transfer")
+
+        # merge adjacent constants
+        encoder = []
+        for op in self.encoder:
+            if isinstance(op, bytes) and encoder and isinstance(encoder[-1], bytes):
+                encoder[-1] += op
+            else:
+                encoder.append(op)
+        self.encoder = encoder
+
+    def _compile_array(self, fields, path):
+        for field in fields:
+            if isinstance(field, TransferGroup):
+                self._compile_array(field.fields, f"{path}{field.name}/")
+            else:
+                self.schema.append(f"{path}{field.name}")
+                self.encoder.append(field)
+
+    def _compile_map(self, fields):
+        self.encoder.append(msgpack_map_header(len(fields)))
+        for field in fields:
+            self.encoder.append(msgpack_str(field.name))
+            if isinstance(field, TransferGroup):
+                self._compile_map(field.fields)
+            else:
+                self.encoder.append(field)
+
+    def get_content(self) -> bytes:
+        out = bytearray()
+        float32 = self.float32
+        for op in self.encoder:
+            if isinstance(op, bytes):
+                out += op
+            else:
+                msgpack_pack(op.get_content(), out, float32)
+        return bytes(out)
+
+    def transmit(self):
+        if not self.schema_published and self.layout == "array":
+            schema = json.dumps({ "encoding": "msgpack", "layout": "array", "fields": self.schema })
+            self.dispatcher.publisher.publish(f"{self.dispatcher.mqtt_topic_prefix}{self.schema_topic}", schema, 1, True, 1)
+            self.schema_published = True
+
+        super().transmit()
+
 class _TransferItem:
     def __init__(self, transfer, parent, config) -> None:
         self.transfer = transfer
@@ -379,6 +1689,58 @@ class TransferGroup(_TransferItem):
             retval = field.get_field_subscriptions(retval)
         return retval
 
+class TransferPatternitem(TransferGroup):
+    """Group of the fields matching the pattern of an item, expanded once against the VSF
+
+    Each matching field gets an item with the remaining options of the config (e.g. max_age or
+    aggregate), so the dispatcher only sees ordinary subscriptions. Fields whose names are the
+    same are keyed by their id instead.
+    """
+    KEYS = ("id", "suffix", "name")
+    LANGUAGES = ("EN", "DE", "FR")
+
+    def __init__(self, transfer, parent, config) -> None:
+        _TransferItem.__init__(self, transfer, parent, config)
+
+        self.name = json_get_or_fail(config, "name")
+        self.pattern = json_get_or_fail(config, "item")
+        self.key = json_get_or_default(config, "key", "id")
+        if self.key not in self.KEYS:
+            raise Exception(f"unknown key '{self.key}' of field pattern '{self.pattern}'")
+        self.lang = json_get_or_default(config, "lang", "EN").upper()
+        if self.lang not in self.LANGUAGES:
+            raise Exception(f"unknown language '{self.lang}' of field pattern '{self.pattern}'")
+
+        dispatcher = transfer.dispatcher
+        field_ids = dispatcher.match_fields(self.pattern)
+        if not field_ids:
+            print(f"Field pattern '{self.pattern}' doesn't match any field")
+
+        prefix = MqttDispatcherFieldIndex.prefix(self.pattern)
+        names = {}
+        for field_id in field_ids:
+            if self.key == "suffix":
+                names[field_id] = field_id[len(prefix):]
+            elif self.key == "name":
+                names[field_id] = dispatcher.spec_fields[field_id].name[self.lang]
+            else:
+                names[field_id] = field_id
+
+        counts = {}
+        for name in names.values():
+            counts[name] = counts.get(name, 0) + 1
+        duplicates = sorted(name for name, count in counts.items() if count > 1)
+        if duplicates:
+            print(f"Field pattern '{self.pattern}': fields named {duplicates} are keyed by their id")
+
+        self.fields = []
+        for field_id in field_ids:
+            name = names[field_id]
+            cfg_item = { key: value for key, value in config.items() if key not in ("key", "lang") }
+            cfg_item["name"] = name if counts[name] == 1 else field_id
+            cfg_item["item"] = field_id
+            self.fields.append(Transfer._cfg_get_field(transfer, parent, cfg_item))
+
 class TransferValueitem(_TransferItem):
     def __init__(self, transfer, parent, config) -> None:
         super().__init__(transfer, parent, config)
@@ -398,6 +1760,33 @@ class TransferValueitem(_TransferItem):
 
         return retval
 
+class TransferAggregateitem(TransferValueitem):
+    """Aggregates of a field over a time window, maintained with each update of the field"""
+    def __init__(self, transfer, parent, config) -> None:
+        super().__init__(transfer, parent, config)
+
+        cfg_aggregate = json_get_or_fail(config, "aggregate")
+        mode = json_get_or_default(cfg_aggregate, "mode", "tumbling")
+        window = json_get_or_fail(cfg_aggregate, "window")
+
+        # a single function publishes a value, a list of functions an object
+        self.function = json_get_or_default(cfg_aggregate, "function", None)
+        self.functions = json_get_or_default(cfg_aggregate, "functions", list(MqttDispatcherAggregate.FUNCTIONS))
+        for function in [self.function] if self.function is not None else self.functions:
+            if function not in MqttDispatcherAggregate.FUNCTIONS:
+                raise Exception(f"unknown aggregate function '{function}'")
+
+        self.aggregate = transfer.dispatcher.get_or_add_field(self.item).get_aggregate(mode, window)
+
+    def get_content(self):
+        if self.max_age is not None and self.transfer.dispatcher.get_field_value(self.item, self.max_age) is None:
+            return None
+
+        values = self.aggregate.get()
+        if self.function is not None:
+            return values[self.function]
+        return { function: values[function] for function in self.functions }
+
 class TransferMetaitem(_TransferItem):
     def __init__(self, transfer, parent, config) -> None:
         super().__init__(transfer, parent, config)
@@ -427,17 +1816,14 @@ class TransferPluginitem(_TransferItem):
 
         self.plugin = transfer.dispatcher.plugins[self.plugin_name]
 
-        func_name = "plugin_" + json_get_or_fail(config, "function")
-        self.plugin_function = getattr(self.plugin.plugin_obj, func_name)
-
-        if not callable(self.plugin_function):
-            raise Exception(f"method '{func_name}' of plugin '{self.plugin_name}' is not callable")
+        self.function_name = json_get_or_fail(config, "function")
+        self.plugin_function = self.plugin.get_function(self.function_name)
 
     def get_content(self):
-        return self.plugin_function()
+        return self.plugin.get_value(self.function_name, self.plugin_function)
 
     def get_field_subscriptions(self, retval = {}):
-        for valref in self.plugin.plugin_obj.subscriptions:
+        for valref in self.plugin.subscriptions:
             if valref in retval:
                 retval[valref].append(self)
             else:
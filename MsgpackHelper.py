@@ -0,0 +1,97 @@
+import struct
+
+# minimal MessagePack encoder, see https://github.com/msgpack/msgpack/blob/master/spec.md
+
+_pack_f32 = struct.Struct(">Bf").pack
+_pack_f64 = struct.Struct(">Bd").pack
+
+def msgpack_array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 0x10000:
+        return struct.pack(">BH", 0xDC, length)
+    return struct.pack(">BI", 0xDD, length)
+
+def msgpack_map_header(length: int) -> bytes:
+    if length < 16:
+        return bytes([0x80 | length])
+    if length < 0x10000:
+        return struct.pack(">BH", 0xDE, length)
+    return struct.pack(">BI", 0xDF, length)
+
+def msgpack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    length = len(data)
+    if length < 32:
+        return bytes([0xA0 | length]) + data
+    if length < 0x100:
+        return bytes([0xD9, length]) + data
+    if length < 0x10000:
+        return struct.pack(">BH", 0xDA, length) + data
+    return struct.pack(">BI", 0xDB, length) + data
+
+def msgpack_int(value: int) -> bytes:
+    if 0 <= value < 0x80:
+        return bytes([value])
+    if -32 <= value < 0:
+        return bytes([value & 0xFF])
+    if value >= 0:
+        if value < 0x100:
+            return bytes([0xCC, value])
+        if value < 0x10000:
+            return struct.pack(">BH", 0xCD, value)
+        if value < 0x100000000:
+            return struct.pack(">BI", 0xCE, value)
+        return struct.pack(">BQ", 0xCF, value)
+    if value >= -0x80:
+        return struct.pack(">Bb", 0xD0, value)
+    if value >= -0x8000:
+        return struct.pack(">Bh", 0xD1, value)
+    if value >= -0x80000000:
+        return struct.pack(">Bi", 0xD2, value)
+    return struct.pack(">Bq", 0xD3, value)
+
+def msgpack_pack(value, out: bytearray, float32: bool = False) -> None:
+    """Appends the MessagePack encoding of a value to a buffer
+
+    Args:
+        value (Any): None, bool, int, float, str, bytes, list, tuple or dict
+        out (bytearray): target buffer
+        float32 (bool, optional): encode floats with single precision. Defaults to False.
+    """
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        out += msgpack_int(value)
+    elif isinstance(value, float):
+        # floats stay floats, even if integral, so the type of a field doesn't change between messages
+        if float32 and (abs(value) <= 3.4028234663852886e38 or value != value):
+            out += _pack_f32(0xCA, value)
+        else:
+            out += _pack_f64(0xCB, value)
+    elif isinstance(value, str):
+        out += msgpack_str(value)
+    elif isinstance(value, (bytes, bytearray)):
+        length = len(value)
+        if length < 0x100:
+            out += bytes([0xC4, length])
+        elif length < 0x10000:
+            out += struct.pack(">BH", 0xC5, length)
+        else:
+            out += struct.pack(">BI", 0xC6, length)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        out += msgpack_array_header(len(value))
+        for item in value:
+            msgpack_pack(item, out, float32)
+    elif isinstance(value, dict):
+        out += msgpack_map_header(len(value))
+        for key in value:
+            msgpack_pack(key, out, float32)
+            msgpack_pack(value[key], out, float32)
+    else:
+        raise Exception(f"type '{type(value).__name__}' can't be encoded with MessagePack")
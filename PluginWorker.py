@@ -0,0 +1,340 @@
+import importlib
+import threading
+import time
+import traceback
+from typing import Union
+from JsonHelper import *
+
+NO_TICK = "no tick" # marker for jobs without a tick
+
+def tick_deadline(deadline: Union[None, float]) -> Union[None, float]:
+    """Converts the time.time() based deadline returned by the tick() of a plugin to time.monotonic()"""
+    if deadline is None:
+        return None
+    return time.monotonic() + (deadline - time.time())
+
+def run_plugin_job(plugin_obj, collected: dict, updated: dict, changed: dict, tick: bool, functions: list) -> tuple:
+    """Runs the callbacks of a plugin and computes the results of its functions
+
+    Args:
+        plugin_obj (Any): plugin object
+        collected (dict): results already stored by the plugin with set_value(), completed by this function
+        updated (dict): values of updated subscribed fields, empty if none
+        changed (dict): values of changed subscribed fields, empty if none
+        tick (bool): call tick() of the plugin
+        functions (list): names of the functions to compute (without prefix plugin_)
+
+    Returns:
+        tuple: results by function name and the next tick deadline (time.time() as returned by the plugin), None or NO_TICK
+    """
+    next_tick = NO_TICK
+    try:
+        on_update = getattr(plugin_obj, "update", None)
+        on_change = getattr(plugin_obj, "change", None)
+        if updated and callable(on_update):
+            on_update(updated)
+        if changed and callable(on_change):
+            on_change(changed)
+        if tick:
+            next_tick = plugin_obj.tick()
+    except:
+        traceback.print_exc()
+
+    for function in functions:
+        if function not in collected:
+            try:
+                collected[function] = getattr(plugin_obj, "plugin_" + function)()
+            except:
+                traceback.print_exc()
+                collected[function] = None
+    return collected, next_tick
+
+class PluginThreadExecutor:
+    """Runs a plugin object, that was created by the dispatcher, in the worker thread"""
+    def __init__(self, plugin) -> None:
+        self.plugin = plugin
+
+    def start(self) -> tuple:
+        """Returns the subscriptions and the first tick deadline of the plugin"""
+        plugin_obj = self.plugin.plugin_obj
+        return getattr(plugin_obj, "subscriptions", []), plugin_obj.tick()
+
+    def run(self, updated: dict, changed: dict, tick: bool, functions: list, timeout: float = None) -> tuple:
+        """Runs a job, returns the results, the next tick deadline and None (the plugin is never restarted)"""
+        # values stored by the plugin with set_value() are collected instead of being cached by the dispatcher
+        collected = {}
+        self.plugin.collect = collected
+        try:
+            return run_plugin_job(self.plugin.plugin_obj, collected, updated, changed, tick, functions) + (None,)
+        finally:
+            self.plugin.collect = None
+
+    def stop(self) -> None:
+        pass
+
+class _PluginProcessParent:
+    """Parent of a plugin object in a worker process, in place of MqttDispatcherPlugin"""
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.dispatcher = None # not available in another process
+        self.collect = {}
+
+    def set_value(self, function: str, value) -> None:
+        self.collect[function] = value
+
+def _plugin_process_main(conn, name: str, module_name: str, class_name: str, plugin_cfg) -> None:
+    """Main function of a plugin worker process, runs jobs received via the pipe"""
+    try:
+        parent = _PluginProcessParent(name)
+        plugin_obj = getattr(importlib.import_module(module_name), class_name)(parent, plugin_cfg)
+        conn.send((list(getattr(plugin_obj, "subscriptions", [])), plugin_obj.tick()))
+    except Exception as e:
+        traceback.print_exc()
+        conn.send(e)
+        return
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        updated, changed, tick, functions = job
+        parent.collect = {}
+        conn.send(run_plugin_job(plugin_obj, parent.collect, updated, changed, tick, functions))
+
+class PluginProcessExecutor:
+    """Runs a plugin in its own process, the plugin object is created there
+
+    The process is started with "spawn", so it doesn't inherit the threads of vbus2mqtt. If a job
+    doesn't finish within the timeout, the process is killed and started again.
+    """
+    def __init__(self, name: str, module_name: str, class_name: str, plugin_cfg, start_timeout: float = 30) -> None:
+        self.name = name
+        self.module_name = module_name
+        self.class_name = class_name
+        self.plugin_cfg = plugin_cfg
+        self.start_timeout = start_timeout
+        self.process = None
+        self.conn = None
+        self.stats_restarts = 0
+
+    def start(self) -> tuple:
+        """Starts the process, returns the subscriptions and the first tick deadline of the plugin"""
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_plugin_process_main, name=f"plugin-{self.name}", daemon=True,
+            args=(child_conn, self.name, self.module_name, self.class_name, self.plugin_cfg))
+        self.process.start()
+        child_conn.close()
+
+        try:
+            if not self.conn.poll(self.start_timeout):
+                self.stop()
+                raise Exception(f"plugin '{self.name}' didn't start within {self.start_timeout} s")
+            reply = self.conn.recv()
+        except EOFError:
+            self.stop()
+            raise Exception(f"plugin '{self.name}' process died while starting")
+        if isinstance(reply, Exception):
+            self.stop()
+            raise Exception(f"plugin '{self.name}' could not be created: {reply}")
+        return reply
+
+    def run(self, updated: dict, changed: dict, tick: bool, functions: list, timeout: float = None) -> tuple:
+        """Runs a job in the process, restarts the process if it died or didn't answer within the timeout
+
+        Returns:
+            tuple: results, next tick deadline and the result of start() if the process was restarted, None otherwise
+
+        Raises:
+            Exception: the process could not be started again
+        """
+        try:
+            self.conn.send((updated, changed, tick, functions))
+            if self.conn.poll(timeout):
+                return self.conn.recv() + (None,)
+            print(f"Plugin '{self.name}' didn't answer within {timeout} s, restarting it")
+        except (EOFError, OSError):
+            print(f"Plugin '{self.name}' process died, restarting it")
+
+        # the plugin state is lost, it starts from scratch with the next job
+        self.stop()
+        self.stats_restarts += 1
+        return None, NO_TICK, self.start()
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+
+class PluginWorker:
+    """Runs the callbacks and functions of a plugin outside of the dispatcher thread
+
+    Field deltas are merged while the worker is busy, so there is at most one pending job. After each
+    job, the results of all functions used by transfers are computed, the dispatcher only reads the
+    latest results. Reading waits up to the time budget for the results of the latest delivered
+    values, afterwards the previous (stale) results are used or None, depending on the policy.
+    Ticks of the plugin are scheduled by the worker itself.
+    """
+    def __init__(self, name: str, executor, config: dict = None) -> None:
+        if config is None:
+            config = {}
+
+        self.name = name
+        self.executor = executor
+        self.budget = json_get_or_default(config, "budget", 0.1)
+        self.timeout = json_get_or_default(config, "timeout", None)
+        self.stale_policy = json_get_or_default(config, "stale", "last")
+        self.max_age = json_get_or_default(config, "max_age", None)
+
+        if self.stale_policy not in ("last", "none"):
+            raise Exception(f"unknown stale policy '{self.stale_policy}' of plugin '{name}'")
+
+        self.functions = []
+
+        self.condition = threading.Condition()
+        self.running = True
+        self.pending_updated = {}
+        self.pending_changed = {}
+        self.submitted_seq = 0
+        self.submitted_at = None
+
+        self.results = {}
+        self.result_seq = 0
+        self.result_time = None
+
+        self.stats_jobs = 0
+        self.stats_merged = 0
+        self.stats_overruns = 0
+        self.stats_stale = 0
+        self.stats_duration = None
+        self.failed = None # error of a plugin that couldn't be restarted, it doesn't run any more
+
+        # the executor runs the first tick of the plugin
+        self.subscriptions, next_tick = self.executor.start()
+        self.next_tick = tick_deadline(next_tick)
+
+        self.thread = threading.Thread(target=self.run, name=f"plugin-{name}", daemon=True)
+        self.thread.start()
+
+    def require(self, function: str) -> None:
+        """Adds a function whose result is computed after each job"""
+        with self.condition:
+            if function not in self.functions:
+                self.functions.append(function)
+                # compute it right away, it might never get a job otherwise
+                self.submitted_seq += 1
+                self.submitted_at = time.monotonic()
+                self.condition.notify()
+
+    def submit(self, updated: dict, changed: dict) -> None:
+        """Queues the values of a message, merged with values that weren't processed yet"""
+        with self.condition:
+            if self.result_seq < self.submitted_seq and (self.pending_updated or self.pending_changed):
+                self.stats_merged += 1
+            self.pending_updated.update(updated)
+            self.pending_changed.update(changed)
+            self.submitted_seq += 1
+            self.submitted_at = time.monotonic()
+            self.condition.notify()
+
+    def get_value(self, function: str):
+        """Latest result of a function, waits up to the time budget for results of the latest values"""
+        with self.condition:
+            if self.failed is not None:
+                return None
+            if self.result_seq < self.submitted_seq and self.budget > 0:
+                deadline = self.submitted_at + self.budget
+                while self.result_seq < self.submitted_seq:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+            stale = self.result_seq < self.submitted_seq or \
+                (self.max_age is not None and self.result_time is not None and time.monotonic() - self.result_time > self.max_age)
+            if stale:
+                self.stats_stale += 1
+                if self.stale_policy == "none":
+                    return None
+            return self.results.get(function)
+
+    def run(self) -> None:
+        seq = 0
+        while True:
+            with self.condition:
+                while self.running:
+                    tick = self.next_tick is not None and time.monotonic() >= self.next_tick
+                    if tick or self.submitted_seq > seq:
+                        break
+                    self.condition.wait(self.next_tick - time.monotonic() if self.next_tick is not None else None)
+                if not self.running:
+                    break
+                updated, self.pending_updated = self.pending_updated, {}
+                changed, self.pending_changed = self.pending_changed, {}
+                seq = self.submitted_seq
+                functions = list(self.functions)
+
+            start = time.monotonic()
+            try:
+                results, next_tick, restart = self.executor.run(updated, changed, tick, functions, self.timeout)
+            except Exception as e:
+                print(f"Plugin '{self.name}' failed: {e}")
+                with self.condition:
+                    self.failed = str(e)
+                    self.running = False
+                    self.condition.notify_all()
+                return
+            duration = time.monotonic() - start
+
+            with self.condition:
+                self.stats_jobs += 1
+                self.stats_duration = duration
+                if duration > self.budget:
+                    self.stats_overruns += 1
+                if results is not None:
+                    self.results = results
+                    self.result_time = time.monotonic()
+                self.result_seq = seq
+                if restart is not None:
+                    # the restarted plugin starts over with its first tick, the dispatcher picks up changed subscriptions
+                    subscriptions, next_tick = restart
+                    self.next_tick = tick_deadline(next_tick)
+                    if list(subscriptions) != list(self.subscriptions):
+                        self.subscriptions = list(subscriptions)
+                elif next_tick != NO_TICK:
+                    self.next_tick = tick_deadline(next_tick)
+                elif tick and results is None:
+                    # the job failed, try the tick again later
+                    self.next_tick = time.monotonic() + 1
+                self.condition.notify_all()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(5)
+        self.executor.stop()
+
+    def get_stats(self) -> dict:
+        return {
+            "jobs": self.stats_jobs,
+            "merged": self.stats_merged,
+            "overruns": self.stats_overruns,
+            "stale": self.stats_stale,
+            "restarts": getattr(self.executor, "stats_restarts", 0),
+            "failed": self.failed,
+            "last_duration": round(self.stats_duration, 6) if self.stats_duration is not None else None,
+        }
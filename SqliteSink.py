@@ -0,0 +1,202 @@
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from JsonHelper import *
+
+class SqliteSink:
+    """Writes received field values to a local SQLite database, e.g. to bridge outages of the broker
+
+    The dispatcher only queues the values of each message, a background thread writes them in batches,
+    each batch in one transaction. Field ids are stored once in the table fields and referenced by an
+    integer. Raw values are rolled up into min/max/mean/count per interval and deleted after their
+    retention time.
+
+    Schema:
+        fields(id INTEGER PRIMARY KEY, name TEXT UNIQUE)
+        samples(ts INTEGER, field INTEGER, value, PRIMARY KEY(ts, field)) -- ts in milliseconds since the epoch
+        rollups(ts INTEGER, field INTEGER, min REAL, max REAL, mean REAL, count INTEGER, PRIMARY KEY(ts, field))
+    """
+    def __init__(self, config: dict, fields: set = None) -> None:
+        """Opens the database and starts the writer thread
+
+        Args:
+            config (dict): config section sqlite
+            fields (set, optional): field ids to store if the config doesn't list them, None for all. Defaults to None.
+        """
+        self.filename = json_get_or_fail(config, "file")
+        self.batch_interval = json_get_or_default(config, "batch_interval", 1.0)
+        self.batch_size = json_get_or_default(config, "batch_size", 500) # messages
+        self.max_pending = json_get_or_default(config, "max_pending", 10000) # messages
+        self.changes_only = json_get_or_default(config, "changes_only", False)
+
+        cfg_fields = json_get_or_default(config, "fields", None)
+        if cfg_fields == "all":
+            self.fields = None
+        elif cfg_fields is not None:
+            self.fields = set(cfg_fields)
+        else:
+            self.fields = fields
+
+        cfg_retention = json_get_or_default(config, "retention", {})
+        self.retention_raw = json_get_or_default(cfg_retention, "raw", 7 * 86400) # seconds
+        self.rollup_interval = json_get_or_default(cfg_retention, "rollup_interval", 300) # seconds, 0 to disable
+        self.retention_rollup = json_get_or_default(cfg_retention, "rollup", 365 * 86400) # seconds
+        self.maintenance_interval = json_get_or_default(cfg_retention, "maintenance_interval", 3600) # seconds
+
+        self.condition = threading.Condition()
+        self.pending = deque() # (timestamp, values by field id)
+        self.running = True
+
+        self.stats_written = 0
+        self.stats_dropped = 0
+        self.stats_batches = 0
+        self.stats_last_batch = None # seconds of the last transaction
+
+        # the connection is created here to fail early, but only used by the writer thread
+        self.db = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+        self._init_db()
+
+        self.thread = threading.Thread(target=self.run, name="sqlite-sink", daemon=True)
+        self.thread.start()
+
+    def _init_db(self) -> None:
+        db = self.db
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS fields (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS samples (ts INTEGER NOT NULL, field INTEGER NOT NULL, value, PRIMARY KEY (ts, field)) WITHOUT ROWID")
+        db.execute("CREATE TABLE IF NOT EXISTS rollups (ts INTEGER NOT NULL, field INTEGER NOT NULL, min REAL, max REAL, mean REAL, count INTEGER, PRIMARY KEY (ts, field)) WITHOUT ROWID")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.field_ids = { name: id for id, name in db.execute("SELECT id, name FROM fields") }
+        self.last_values = {} # field id -> last written value, for changes_only
+
+    def write(self, values: dict, timestamp: datetime = None) -> None:
+        """Queues the values of a message, called by the dispatcher
+
+        Args:
+            values (dict): values by field id, must not be modified afterwards
+            timestamp (datetime, optional): time the values were received. Defaults to None (now).
+        """
+        ts = timestamp.timestamp() if timestamp is not None else time.time()
+        with self.condition:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popleft()
+                self.stats_dropped += 1
+            self.pending.append((ts, values))
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    def _field_id(self, name: str) -> int:
+        field_id = self.field_ids.get(name)
+        if field_id is None:
+            field_id = self.db.execute("INSERT INTO fields (name) VALUES (?)", (name,)).lastrowid
+            self.field_ids[name] = field_id
+        return field_id
+
+    def _write_batch(self, batch: list) -> None:
+        rows = []
+        fields = self.fields
+        # only replaces the written values once the batch is committed
+        last_values = dict(self.last_values) if self.changes_only else self.last_values
+        start = time.perf_counter()
+
+        self.db.execute("BEGIN")
+        try:
+            for ts, values in batch:
+                ts_ms = int(ts * 1000)
+                for name, value in values.items():
+                    if value is None or (fields is not None and name not in fields):
+                        continue
+                    field_id = self._field_id(name)
+                    if self.changes_only:
+                        if last_values.get(field_id) == value:
+                            continue
+                        last_values[field_id] = value
+                    rows.append((ts_ms, field_id, value))
+            self.db.executemany("INSERT OR REPLACE INTO samples (ts, field, value) VALUES (?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+            self.last_values = last_values
+        except:
+            self.db.execute("ROLLBACK")
+            self.field_ids = { name: id for id, name in self.db.execute("SELECT id, name FROM fields") }
+            raise
+
+        self.stats_written += len(rows)
+        self.stats_batches += 1
+        self.stats_last_batch = time.perf_counter() - start
+
+    def maintain(self, now: float = None) -> None:
+        """Rolls up complete intervals of raw values and deletes values older than their retention"""
+        if now is None:
+            now = time.time()
+        db = self.db
+
+        db.execute("BEGIN")
+        try:
+            if self.rollup_interval > 0:
+                interval_ms = int(self.rollup_interval * 1000)
+                row = db.execute("SELECT value FROM meta WHERE key = 'rollup_end'").fetchone()
+                start = row[0] if row is not None else (db.execute("SELECT MIN(ts) FROM samples").fetchone()[0] or 0) // interval_ms * interval_ms
+                # values still queued must not end up behind the rolled up intervals
+                end = int((now - self.batch_interval - 10) * 1000) // interval_ms * interval_ms
+                if end > start:
+                    db.execute("INSERT OR REPLACE INTO rollups (ts, field, min, max, mean, count) " +
+                        "SELECT ts / ? * ?, field, MIN(value), MAX(value), AVG(value), COUNT(value) FROM samples " +
+                        "WHERE ts >= ? AND ts < ? GROUP BY ts / ?, field", (interval_ms, interval_ms, start, end, interval_ms))
+                    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_end', ?)", (end,))
+                db.execute("DELETE FROM rollups WHERE ts < ?", (int((now - self.retention_rollup) * 1000),))
+
+            db.execute("DELETE FROM samples WHERE ts < ?", (int((now - self.retention_raw) * 1000),))
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def run(self) -> None:
+        next_maintenance = time.monotonic()
+        while True:
+            with self.condition:
+                if self.running and len(self.pending) < self.batch_size:
+                    self.condition.wait(self.batch_interval)
+                batch = list(self.pending)
+                self.pending.clear()
+                running = self.running
+
+            try:
+                if batch:
+                    self._write_batch(batch)
+                if time.monotonic() >= next_maintenance:
+                    next_maintenance = time.monotonic() + self.maintenance_interval
+                    self.maintain()
+            except sqlite3.Error as e:
+                print("SQLite sink error:", e)
+
+            if not running:
+                return
+
+    def stop(self) -> None:
+        """Writes the pending values and closes the database"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(10)
+        if self.thread.is_alive():
+            # the connection is still used by the writer, it is closed when the process exits
+            print("SQLite sink: pending values could not be written within 10 s")
+            return
+        self.db.close()
+
+    def get_stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "written": self.stats_written,
+            "dropped": self.stats_dropped,
+            "batches": self.stats_batches,
+            "last_batch": round(self.stats_last_batch, 6) if self.stats_last_batch is not None else None,
+        }
@@ -0,0 +1,120 @@
+import math
+import numpy as np
+from VBusSpecReader import VbusPacketTemplate
+
+class VbusColumnarDecoder:
+    """Decodes many payloads of one packet template at once into one NumPy array per field
+
+    The parts of all fields are compiled into flat tables (offset, mask, bit position, signedness,
+    factor), so decoding gathers the bytes of all parts with one fancy index and sums them per field
+    with np.add.reduceat. The results are the same as VbusPacketField.decode_message(): int64 columns for
+    fields without precision, float64 columns (the integer sum times 10^-precision) otherwise.
+
+    Requires NumPy, which is only needed for this decoder.
+    """
+    def __init__(self, template: VbusPacketTemplate) -> None:
+        self.template = template
+        self.field_ids = [field.full_id for field in template.fields]
+
+        offsets = []
+        masks = []
+        bit_positions = []
+        signed = []
+        factors = []
+        starts = [] # index of the first part of each field with parts
+        self.empty_fields = set() # indices of fields without parts, always 0
+        self.object_fields = set() # indices of fields whose sum could exceed int64
+        self.scales = [] # factor of each field, None if the value stays an integer
+        for i, field in enumerate(template.fields):
+            self.scales.append(math.pow(10, -field.precision) if field.precision != 0 else None)
+            if not field.parts:
+                self.empty_fields.add(i)
+                continue
+            starts.append(len(offsets))
+            if sum(255 * abs(part.factor) for part in field.parts) >= 2**63:
+                self.object_fields.add(i)
+            for part in field.parts:
+                offsets.append(part.offset)
+                masks.append(part.mask)
+                bit_positions.append(part.bit_pos)
+                signed.append(part.is_signed == 1)
+                factors.append(part.factor)
+
+        self.offsets = np.array(offsets, dtype=np.intp)
+        self.masks = np.array(masks, dtype=np.uint8)
+        self.bit_positions = np.array(bit_positions, dtype=np.uint8)
+        self.signed = np.array(signed, dtype=bool)
+        self.factors = np.array(factors, dtype=np.int64)
+        self.starts = np.array(starts, dtype=np.intp)
+        self.min_length = int(self.offsets.max()) + 1 if len(offsets) else 0
+
+    @staticmethod
+    def stack_payloads(payloads) -> np.ndarray:
+        """Payloads as 2D uint8 array (message, byte), all payloads must have the same length"""
+        if isinstance(payloads, np.ndarray):
+            if payloads.ndim != 2 or payloads.dtype != np.uint8:
+                raise Exception("payloads must be a 2D uint8 array")
+            return payloads
+        payloads = list(payloads)
+        if not payloads:
+            return np.zeros((0, 0), dtype=np.uint8)
+        length = len(payloads[0])
+        if any(len(payload) != length for payload in payloads):
+            raise Exception("all payloads must have the same length")
+        return np.frombuffer(b"".join(bytes(payload) for payload in payloads), dtype=np.uint8).reshape(len(payloads), length)
+
+    def decode(self, payloads, timestamps = None) -> dict:
+        """Decodes the payloads of messages of the template
+
+        Args:
+            payloads (Union[Iterable[bytes], np.ndarray]): payloads of the messages (VbusMessage1v0.payload) or a 2D uint8 array
+            timestamps (Iterable[float], optional): time of each message, returned as column "time". Defaults to None.
+
+        Returns:
+            dict: array of values by field id, e.g. to create a pandas DataFrame
+        """
+        data = self.stack_payloads(payloads)
+        count = data.shape[0]
+        if count and data.shape[1] < self.min_length:
+            raise IndexError(f"payloads have {data.shape[1]} bytes, the template needs {self.min_length}")
+
+        columns = {}
+        if timestamps is not None:
+            columns["time"] = np.asarray(timestamps, dtype=np.float64)
+            if len(columns["time"]) != count:
+                raise Exception("count of timestamps and payloads differ")
+
+        if len(self.offsets) and count:
+            values = (data[:, self.offsets] & self.masks) >> self.bit_positions
+            values = values.astype(np.int64)
+            values -= np.where(self.signed & (values >= 128), 256, 0)
+            sums = np.add.reduceat(values * self.factors, self.starts, axis=1)
+        else:
+            sums = np.zeros((count, len(self.starts)), dtype=np.int64)
+
+        column = 0
+        for i, field_id in enumerate(self.field_ids):
+            if i in self.empty_fields:
+                result = np.zeros(count, dtype=np.int64)
+            else:
+                if i in self.object_fields:
+                    result = self._decode_object(data, i)
+                else:
+                    result = sums[:, column]
+                column += 1
+            if self.scales[i] is not None:
+                # same operations as decode_message(): float of the integer sum times 10^-precision
+                result = result.astype(np.float64) * self.scales[i]
+            columns[field_id] = result
+        return columns
+
+    def _decode_object(self, data: np.ndarray, index: int) -> np.ndarray:
+        # Python integers for fields whose sum doesn't fit into int64
+        field = self.template.fields[index]
+        result = np.zeros(data.shape[0], dtype=object)
+        for part in field.parts:
+            values = ((data[:, part.offset] & part.mask) >> part.bit_pos).astype(np.int64)
+            if part.is_signed == 1:
+                values = np.where(values >= 128, values - 256, values)
+            result += values.astype(object) * part.factor
+        return result
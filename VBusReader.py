@@ -1,5 +1,6 @@
 import time
 import logging
+from collections import OrderedDict
 from enum import Enum
 import threading
 from typing import Any, Union
@@ -129,7 +130,7 @@ class VbusDatagram2v0(VbusMessage):
         self.command = VbusDatagram2v0Command(self.command_int)
         checksum_calc = VbusReader.calc_checksum(msg_buff[1:-1])
         self.checksum_ok = checksum_frame == checksum_calc
-        val = VbusReader.septett_deflate(val_sept)
+        val = VbusReader.septett_deflate(bytearray(val_sept))
         self.value = 0
         for i, v in enumerate(val):
             self.value |= v << (i * 8)
@@ -150,9 +151,108 @@ class VbusTelegram3v1(VbusMessage):
     def __init__(self, start_time, end_time, msg_buff) -> None:
         super().__init__(start_time, end_time, msg_buff)
 
+class VbusPacketStats():
+    """Streaming statistics of the messages with the same source, destination, protocol version and command
+
+    Inter-arrival time, message length and checksum failures are estimated with exponentially weighted
+    moving averages, so the memory doesn't grow with the count of messages.
+    """
+    __slots__ = ("alpha", "count", "checksum_errors", "garbage_bytes", "first_seen", "last_seen", "last_error",
+        "interval_mean", "interval_var", "length_mean", "error_rate")
+
+    def __init__(self, alpha: float = 0.1) -> None:
+        self.alpha = alpha
+        self.count = 0
+        self.checksum_errors = 0
+        self.garbage_bytes = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.last_error = None
+        self.interval_mean = None
+        self.interval_var = 0.0
+        self.length_mean = None
+        self.error_rate = 0.0
+
+    def add_message(self, timestamp: float, length: int, checksum_ok: bool = True) -> None:
+        """Adds a received message
+
+        Args:
+            timestamp (float): time.time() of the start of the message
+            length (int): length of the message in bytes
+            checksum_ok (bool, optional): False if a checksum of the message failed. Defaults to True.
+        """
+        alpha = self.alpha
+        self.error_rate += alpha * ((0.0 if checksum_ok else 1.0) - self.error_rate)
+        if not checksum_ok:
+            self.checksum_errors += 1
+            self.last_error = timestamp
+            return
+
+        if self.last_seen is not None:
+            interval = timestamp - self.last_seen
+            if self.interval_mean is None:
+                self.interval_mean = interval
+            else:
+                diff = interval - self.interval_mean
+                incr = alpha * diff
+                self.interval_mean += incr
+                self.interval_var = (1 - alpha) * (self.interval_var + diff * incr)
+
+        if self.length_mean is None:
+            self.length_mean = float(length)
+        else:
+            self.length_mean += alpha * (length - self.length_mean)
+
+        if self.first_seen is None:
+            self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.count += 1
+
+    def add_garbage(self, timestamp: float, length: int) -> None:
+        """Adds bytes of an incomplete or corrupted message with this header"""
+        self.garbage_bytes += length
+        self.last_error = timestamp
+
+    def get_stats(self, now: float = None, baudrate: int = None) -> dict:
+        """Current estimates
+
+        Args:
+            now (float, optional): time.time(), the rate decreases if no message was received for longer than usual. Defaults to None.
+            baudrate (int, optional): baudrate of the bus to calculate the share of the bus used by these messages. Defaults to None.
+
+        Returns:
+            dict: statistics, times in seconds
+        """
+        if now is None:
+            now = time.time()
+
+        rate = None
+        if self.interval_mean is not None:
+            interval = max(self.interval_mean, now - self.last_seen)
+            rate = 1 / interval if interval > 0 else None
+
+        retval = {
+            "count": self.count,
+            "rate": rate,
+            "interval_mean": self.interval_mean,
+            "interval_jitter": self.interval_var ** 0.5 if self.interval_mean is not None else None,
+            "length_mean": self.length_mean,
+            "last_seen": self.last_seen,
+            "checksum_errors": self.checksum_errors,
+            "checksum_error_rate": self.error_rate,
+            "garbage_bytes": self.garbage_bytes,
+            "last_error": self.last_error,
+        }
+        if baudrate:
+            # 8N1, 10 bits per byte
+            retval["bus_load"] = rate * self.length_mean * 10 / baudrate if rate is not None and self.length_mean is not None else None
+        return retval
+
 class VbusReader():
     SOF = 0xAA
     BASE_HEADER_LEN = 6
+    PACKET_STATS_MAX = 256 # corrupted headers can create any key, the least recently seen one is evicted
+    PACKET_STATS_ALPHA = 0.1
 
     @staticmethod
     def calc_checksum(data: list) -> int:
@@ -221,6 +321,12 @@ class VbusReader():
 
         self.on_message = on_message
 
+        # statistics, keyed by protocol version
+        self.stats_frames = {}
+        self.stats_checksum_errors = {}
+        self.stats_garbage_bytes = 0
+        self.packet_stats = OrderedDict() # (src, dst, protocol version, command) -> VbusPacketStats, least recently seen first
+
     def msg_received(self, msg):
         if callable(self.on_message):
             try:
@@ -298,7 +404,10 @@ class VbusReader():
                     
                     if checksum_msg != checksum_calc:
                         logger.warning("checksum error")
-                        self.receiving = False
+                        self.stats_checksum_errors[self.msg_protver] = self.stats_checksum_errors.get(self.msg_protver, 0) + 1
+                        self._get_packet_stats(self.msg_buff).add_message(self.msg_start, len(self.msg_buff), False)
+                        # accounted as checksum failure, the header must not be reported as garbage by the next SOF
+                        self._wait_next_message()
                     else:
                         self.msg_bytes_to_receive = VbusMessage1v0.HEADER_LEN + payload_frames * VbusMessage1v0.FRAME_LEN
                 elif len(self.msg_buff) == self.msg_bytes_to_receive:
@@ -329,10 +438,115 @@ class VbusReader():
                     self._wait_next_message()
 
         if retval is not None:
+            self._update_stats(retval)
             self.msg_received(retval)
 
         return retval
 
+    def _update_stats(self, msg) -> None:
+        buff = msg.msg_buff
+        if isinstance(msg, VbusMessageGarbage):
+            self.stats_garbage_bytes += len(buff)
+            # garbage can only be assigned to a packet if at least the addresses were received
+            if len(buff) >= self.BASE_HEADER_LEN and buff[0] == self.SOF:
+                self._get_packet_stats(buff).add_garbage(msg.start_time, len(buff))
+            return
+
+        protver = self.msg_protver
+        self.stats_frames[protver] = self.stats_frames.get(protver, 0) + 1
+        if not msg.checksum_ok:
+            self.stats_checksum_errors[protver] = self.stats_checksum_errors.get(protver, 0) + 1
+        self._get_packet_stats(buff).add_message(msg.start_time, len(buff), msg.checksum_ok)
+
+    def _get_packet_stats(self, buff: bytearray) -> VbusPacketStats:
+        protver = self.buff_get_prot_ver(buff)
+        command = None
+        if protver in (VbusMessage1v0.HEADER_ID, VbusDatagram2v0.HEADER_ID) and len(buff) >= 8:
+            command = VbusMessage1v0.buff_get_cmd(buff)
+        key = (self.buff_get_src_addr(buff), self.buff_get_dst_addr(buff), protver, command)
+
+        stats = self.packet_stats.get(key)
+        if stats is None:
+            if len(self.packet_stats) >= self.PACKET_STATS_MAX:
+                self.packet_stats.popitem(last=False)
+            stats = VbusPacketStats(self.PACKET_STATS_ALPHA)
+            self.packet_stats[key] = stats
+        else:
+            self.packet_stats.move_to_end(key)
+        return stats
+
+    def get_packet_stats(self, baudrate: int = None) -> list:
+        """Statistics of each source, destination, protocol version and command, can be called from any thread
+
+        Args:
+            baudrate (int, optional): baudrate of the bus to calculate the bus load. Defaults to None.
+
+        Returns:
+            list: list of dicts with the addresses as hex strings, the protocol version (e.g. "1.0") and the statistics
+        """
+        now = time.time()
+        retval = []
+        for (src, dst, protver, command), stats in sorted(list(self.packet_stats.items()), key=lambda item: item[0][:3] + (item[0][3] or 0,)):
+            retval.append({
+                "src": f"0x{src:04X}",
+                "dst": f"0x{dst:04X}",
+                "protocol": f"{protver >> 4}.{protver & 0xF}",
+                "command": f"0x{command:04X}" if command is not None else None,
+                **stats.get_stats(now, baudrate),
+            })
+        return retval
+
+
+class VbusMailbox():
+    """Bounded hand-off of decoded messages from the reader thread to a consumer thread.
+
+    Entries are keyed (e.g. by source, destination and command), a newer entry replaces an older
+    one with the same key that hasn't been taken yet. If the mailbox is full, the oldest entry is dropped.
+    """
+    def __init__(self, capacity: int = 64, on_put = None) -> None:
+        self.capacity = capacity
+        self.on_put = on_put
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        self.stats_coalesced = 0
+        self.stats_dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def put(self, key, item) -> None:
+        """Stores an item, replaces a pending item with the same key
+
+        Args:
+            key (Hashable): key of the item, e.g. (src, dst, cmd)
+            item (Any): item to be handed over
+        """
+        with self.lock:
+            entries = self.entries
+            if key in entries:
+                # keeps the position of the pending entry, so busy keys can't starve others
+                self.stats_coalesced += 1
+            elif len(entries) >= self.capacity:
+                del entries[next(iter(entries))]
+                self.stats_dropped += 1
+            entries[key] = item
+
+        if callable(self.on_put):
+            self.on_put()
+
+    def take_all(self) -> list:
+        """Removes and returns all pending items in order of their first arrival
+
+        Returns:
+            list: pending items
+        """
+        with self.lock:
+            entries = self.entries
+            if not entries:
+                return []
+            self.entries = {}
+        return list(entries.values())
 
 class VbusSerialReader(VbusReader):
     def __init__(self, serialport, on_message = None) -> None:
@@ -340,8 +554,9 @@ class VbusSerialReader(VbusReader):
         
         self.ser = serialport
         self.ser.timeout = 5
+        self.stats_bytes_read = 0
         self.readerrunning = True
-        self.thread_serial = threading.Thread(target=self.serialreader_run, args=())
+        self.thread_serial = threading.Thread(target=self.serialreader_run, args=(), name="vbus-serial-reader")
         self.thread_serial.daemon = True
         self.thread_serial.start()
 
@@ -374,6 +589,7 @@ class VbusSerialReader(VbusReader):
             except:
                 pass
 
+            self.stats_bytes_read += len(bytes)
             self.write_bytes(bytes)
 
     def stop(self) -> None:
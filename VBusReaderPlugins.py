@@ -11,9 +11,7 @@ class VrpSolarPower():
         self.cfg_pump_flow = json_get_or_fail(config, "pump_flow")
         self.cfg_medium = json_get_or_fail(config, "medium")
 
-        # subscribe to field updates
-        # currently, this data is not "pushed" to the plugin on an update or change #TODO
-        # but the subscriptions are still needed as the dispatcher otherwise will not store the values
+        # subscribe to field updates, the values are pushed to update()
         self.subscriptions = [
             self.cfg_field_tin, # heat exchanger input
             self.cfg_field_tout, # heat exchanger output
@@ -56,14 +54,24 @@ class VrpSolarPower():
         if len(self.cfg_pump_flow) != 11:
             raise Exception("Field 'pump_flow' must have 11 elements")
 
-# not supported yet
-#    def update(self, data):
-#        print("plugin data update")
-#        pass
-#
-#    def change(self, data):
-#        print("plugin data change")
-#        pass
+        self.tin = None
+        self.tout = None
+        self.pump = None
+        self.power = None
+
+    def update(self, data):
+        # all three fields are sent in the same packet, the power is calculated once per packet
+        self.tin = data.get(self.cfg_field_tin, self.tin)
+        self.tout = data.get(self.cfg_field_tout, self.tout)
+        self.pump = data.get(self.cfg_field_pump, self.pump)
+
+        self.power = None
+        if self.tin is not None and self.tout is not None and self.pump is not None:
+            try:
+                self.power = self.calc_solar_power(self.tin, self.tout, self.pump)
+            except:
+                pass
+        self.parent.set_value("power", self.power)
 
     def tick(self):
         return None
@@ -85,18 +93,4 @@ class VrpSolarPower():
         return c * rho * flowrate / 60 * t_diff
     
     def plugin_power(self):
-        dispatcher = self.parent.dispatcher
-
-        tin = dispatcher.get_field_value(self.cfg_field_tin)
-        tout = dispatcher.get_field_value(self.cfg_field_tout)
-        pump = dispatcher.get_field_value(self.cfg_field_pump)
-
-        if tin is None or tout is None or pump is None:
-            return None
-        
-        try:
-            return self.calc_solar_power(tin, tout, pump)
-        except:
-            pass
-
-        return None
\ No newline at end of file
+        return self.power
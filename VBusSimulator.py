@@ -0,0 +1,443 @@
+import random
+import threading
+import time
+import struct
+from VBusReader import VbusReader, VbusMessage1v0, VbusDatagram2v0
+
+def build_message1v0(dst: int, src: int, command: int, payload: bytes) -> bytearray:
+    """Builds a complete VBus v1.0 message including SOF, header and frames
+
+    Args:
+        dst (int): destination address
+        src (int): source address
+        command (int): command
+        payload (bytes): payload, padded with zeros to a multiple of 4 bytes
+
+    Returns:
+        bytearray: message as it appears on the bus
+    """
+    payload = bytes(payload)
+    if len(payload) % 4:
+        payload += bytes(4 - len(payload) % 4)
+    frames = len(payload) // 4
+
+    header = bytearray(struct.pack("<HHBHB", dst, src, VbusMessage1v0.HEADER_ID, command, frames))
+    header.append(VbusReader.calc_checksum(header))
+
+    msg = bytearray([VbusReader.SOF])
+    msg.extend(header)
+    for i in range(frames):
+        frame = VbusReader.septett_inflate(bytearray(payload[i * 4 : i * 4 + 4]))
+        frame.append(VbusReader.calc_checksum(frame))
+        msg.extend(frame)
+    return msg
+
+def build_datagram2v0(dst: int, src: int, command: int, id: int, value: int) -> bytearray:
+    """Builds a complete VBus v2.0 datagram including SOF
+
+    Args:
+        dst (int): destination address
+        src (int): source address
+        command (int): command
+        id (int): value id, each byte must be < 0x80
+        value (int): 32 bit value
+
+    Returns:
+        bytearray: datagram as it appears on the bus
+    """
+    msg = bytearray([VbusReader.SOF])
+    msg.extend(struct.pack("<HHBHH", dst, src, VbusDatagram2v0.HEADER_ID, command, id))
+    msg.extend(VbusReader.septett_inflate(bytearray(struct.pack("<I", value & 0xFFFFFFFF))))
+    msg.append(VbusReader.calc_checksum(msg[1:]))
+    return msg
+
+class SyntheticPacket:
+    """A v1.0 packet with fields laid out like typical controller data
+
+    Fields are alternately 2 byte temperatures (signed, 0.1 °C) and 1 byte pump speeds (%).
+    """
+    def __init__(self, dst: int, src: int, command: int, field_count: int) -> None:
+        self.dst = dst
+        self.src = src
+        self.command = command
+
+        # (offset, size) of each field
+        self.fields = []
+        offset = 0
+        for i in range(field_count):
+            size = 2 if i % 2 == 0 else 1
+            self.fields.append((offset, size))
+            offset += size
+        self.payload_len = offset + (-offset % 4)
+
+        self.values = [200 if size == 2 else 0 for _, size in self.fields]
+
+    @property
+    def packet_id(self) -> str:
+        return f"00_{self.dst:04X}_{self.src:04X}_10_{self.command:04X}"
+
+    def field_id(self, index: int) -> str:
+        offset, size = self.fields[index]
+        return f"{self.packet_id}_{offset:03d}_{size}_0"
+
+    def next_payload(self, rng: random.Random) -> bytes:
+        """Payload with slowly changing values (random walk)"""
+        payload = bytearray(self.payload_len)
+        for i, (offset, size) in enumerate(self.fields):
+            if size == 2:
+                self.values[i] = max(-300, min(1500, self.values[i] + rng.randint(-3, 3)))
+                payload[offset : offset + 2] = struct.pack("<h", self.values[i])
+            else:
+                if rng.random() < 0.05:
+                    self.values[i] = rng.choice((0, 30, 50, 70, 100))
+                payload[offset] = self.values[i]
+        return bytes(payload)
+
+    def next_message(self, rng: random.Random) -> bytearray:
+        return build_message1v0(self.dst, self.src, self.command, self.next_payload(rng))
+
+class TemplatePacket:
+    """A v1.0 packet generated from a packet template of a VBus specification file
+
+    The payload starts random and changes a few bytes with every message.
+    """
+    def __init__(self, template, seed: int = 0) -> None:
+        self.dst = template.destination_address
+        self.src = template.source_address
+        self.command = template.command
+        self.packet_id = template.packet_id
+
+        size = 0
+        for field in template.fields:
+            for part in field.parts:
+                size = max(size, part.offset + 1)
+        self.payload_len = size + (-size % 4)
+
+        rng = random.Random(seed)
+        self.payload = bytearray(rng.randrange(0x100) for _ in range(self.payload_len))
+
+    def next_payload(self, rng: random.Random) -> bytes:
+        for _ in range(max(1, self.payload_len // 20)):
+            self.payload[rng.randrange(self.payload_len)] = rng.randrange(0x100)
+        return bytes(self.payload)
+
+    def next_message(self, rng: random.Random) -> bytearray:
+        return build_message1v0(self.dst, self.src, self.command, self.next_payload(rng))
+
+def packets_from_spec(spec, packet_ids: set = None) -> list:
+    """Packets of a specification that can be simulated, i.e. with fixed addresses and at least one field
+
+    Args:
+        spec (VbusSpec): loaded specification
+        packet_ids (set, optional): only packets with these ids, e.g. 00_0010_7321_10_0100. Defaults to None.
+
+    Returns:
+        list: list of TemplatePacket
+    """
+    packets = []
+    for template in spec.packet_templates:
+        if template.destination_mask != 0xFFFF or template.source_mask != 0xFFFF or len(template.fields) == 0:
+            continue
+        # address bytes are sent without septett, so they must not have the MSB set
+        if (template.destination_address | template.source_address) & 0x8080:
+            continue
+        if packet_ids is not None and template.packet_id not in packet_ids:
+            continue
+        packets.append(TemplatePacket(template, len(packets)))
+    return packets
+
+def synthetic_packets(packet_count: int = 1, field_count: int = 32) -> list:
+    """Packets of different controllers (source 0x7321 and following) to the DFA (0x0010)"""
+    packets = []
+    address = 0x7321
+    while len(packets) < packet_count:
+        # address bytes are sent without septett, so they must not have the MSB set
+        if address & 0x8080 == 0:
+            packets.append(SyntheticPacket(0x0010, address, 0x0100, field_count))
+        address += 1
+    return packets
+
+def build_vsf(packets: list) -> bytes:
+    """Builds a VBus specification file (*.vsf) describing the given synthetic packets
+
+    Args:
+        packets (list): list of SyntheticPacket
+
+    Returns:
+        bytes: content of the file, readable with VbusSpec.load_vsf()
+    """
+    texts = [""]
+    text_index = {}
+    def text(value):
+        if value not in text_index:
+            text_index[value] = len(texts)
+            texts.append(value)
+        return text_index[value]
+
+    localized = []
+    def loc_text(value):
+        localized.append((text(value), text(value), text(value)))
+        return len(localized) - 1
+
+    units = [(0, 0, text(""), text("")), (62, 1, text("°C"), text(" °C")), (61, 2, text("%"), text(" %"))]
+
+    devices = [(0x0010, 0xFFFF, 0x0000, 0x0000, loc_text("DFA"))]
+    for packet in packets:
+        devices.append((packet.src, 0xFFFF, 0x0000, 0x0000, loc_text(f"Synthetic controller 0x{packet.src:04X}")))
+
+    packet_fields = []
+    for packet in packets:
+        fields = []
+        for i, (offset, size) in enumerate(packet.fields):
+            if size == 2:
+                parts = [(offset, 0, 0xFF, 0, 1), (offset + 1, 0, 0xFF, 1, 256)]
+                fields.append((text(f"{offset:03d}_2_0"), loc_text(f"Temperature sensor {i // 2 + 1}"), 62, 1, 1, parts))
+            else:
+                parts = [(offset, 0, 0xFF, 0, 1)]
+                fields.append((text(f"{offset:03d}_1_0"), loc_text(f"Pump speed relay {i // 2 + 1}"), 61, 0, 1, parts))
+        packet_fields.append(fields)
+
+    # layout: header, spec block, tables, strings
+    HEADER_LEN = 16
+    SPECBLOCK_LEN = 4 + 5 * 8
+    out = bytearray(HEADER_LEN + SPECBLOCK_LEN)
+
+    def table(data: bytes) -> int:
+        offset = len(out)
+        out.extend(data)
+        return offset
+
+    text_table_offset = table(bytes(4 * len(texts)))
+    loc_offset = table(b"".join(struct.pack("<iii", *item) for item in localized))
+    unit_offset = table(b"".join(struct.pack("<iiii", *item) for item in units))
+    device_offset = table(b"".join(struct.pack("<HHHHi", *item) for item in devices))
+    packet_offset = table(bytes(20 * len(packets)))
+
+    packet_data = bytearray()
+    for packet, fields in zip(packets, packet_fields):
+        field_offset = table(bytes(28 * len(fields)))
+        field_data = bytearray()
+        for id_text, name, unit, precision, type_id, parts in fields:
+            part_offset = table(b"".join(struct.pack("<iBBBBq", p_offset, bit, mask, signed, 0, factor)
+                for p_offset, bit, mask, signed, factor in parts))
+            field_data += struct.pack("<iiiiiii", id_text, name, unit, precision, type_id, len(parts), part_offset)
+        out[field_offset : field_offset + len(field_data)] = field_data
+        packet_data += struct.pack("<HHHHHHii", packet.dst, 0xFFFF, packet.src, 0xFFFF, packet.command, 0, len(fields), field_offset)
+    out[packet_offset : packet_offset + len(packet_data)] = packet_data
+
+    text_addresses = bytearray()
+    for value in texts:
+        text_addresses += struct.pack("<i", table(value.encode("utf-8") + b"\0"))
+    out[text_table_offset : text_table_offset + len(text_addresses)] = text_addresses
+    out.extend(bytes(16)) # the reader reads strings in chunks of 16 bytes
+
+    out[0:HEADER_LEN] = struct.pack("<HHiii", 0, 0, len(out), 1, HEADER_LEN)
+    out[HEADER_LEN : HEADER_LEN + SPECBLOCK_LEN] = struct.pack("<i10i", 20240101,
+        len(texts), text_table_offset, len(localized), loc_offset, len(units), unit_offset,
+        len(devices), device_offset, len(packets), packet_offset)
+    return bytes(out)
+
+def build_stream(packets: list, message_count: int, seed: int = 0, garbage_rate: float = 0.0) -> bytearray:
+    """Concatenates messages of the packets in round robin order, like a controller sending its data
+
+    Args:
+        packets (list): list of SyntheticPacket
+        message_count (int): count of messages
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        garbage_rate (float, optional): probability of a message being corrupted by a flipped bit. Defaults to 0.0.
+
+    Returns:
+        bytearray: bytes as they appear on the bus
+    """
+    rng = random.Random(seed)
+    stream = bytearray()
+    for i in range(message_count):
+        msg = packets[i % len(packets)].next_message(rng)
+        if garbage_rate and rng.random() < garbage_rate:
+            pos = rng.randrange(1, len(msg))
+            msg[pos] ^= 1 << rng.randrange(7)
+        stream.extend(msg)
+    return stream
+
+class SimulatedSerialPort:
+    """In-process stand-in for serial.Serial, reads the bytes fed by a SimulatedBus
+
+    Only the parts of the port used by VbusSerialReader are provided.
+    """
+    def __init__(self) -> None:
+        self.timeout = None
+        self.is_open = True
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+
+    def feed(self, data: bytes) -> None:
+        with self.condition:
+            self.buffer.extend(data)
+            self.condition.notify()
+
+    def read(self, size: int = 1) -> bytes:
+        with self.condition:
+            if not self.buffer and self.is_open:
+                self.condition.wait(self.timeout)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+    @property
+    def in_waiting(self) -> int:
+        return len(self.buffer)
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+class SimulatedBus:
+    """Sends messages of packets in rounds, paced like a VBus at a given baudrate and speed factor
+
+    Each round sends every packet once. A new round starts after the period (in bus time) or as soon
+    as the previous round is on the bus if the bus is too slow for the period. The messages are
+    written as a whole once their last byte would have been received.
+    """
+    def __init__(self, packets: list, write, baudrate: int = 9600, speed: float = 1.0, period: float = 1.0,
+            garbage_rate: float = 0.0, seed: int = 0) -> None:
+        """Initializes the bus
+
+        Args:
+            packets (list): list of SyntheticPacket or TemplatePacket
+            write (Callable[[bytes], Any]): called with each message
+            baudrate (int, optional): baudrate of the simulated bus, 8N1. Defaults to 9600.
+            speed (float, optional): factor of the bus speed. Defaults to 1.0.
+            period (float, optional): time between the start of rounds in seconds of bus time. Defaults to 1.0.
+            garbage_rate (float, optional): probability of a message being corrupted by a flipped bit. Defaults to 0.0.
+            seed (int, optional): seed of the random generator. Defaults to 0.
+        """
+        self.packets = packets
+        self.write = write
+        self.byte_time = 10 / baudrate
+        self.speed = speed
+        self.period = period
+        self.garbage_rate = garbage_rate
+        self.rng = random.Random(seed)
+
+        self.stats_messages = 0
+        self.stats_corrupted = 0
+        self.stats_bytes = 0
+        self.stats_late = 0.0 # maximum delay of a write in wall clock seconds
+        self.stats_cpu = 0.0 # CPU time used by the bus thread
+
+        self.running = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Bytes per wall clock second if the bus is fully used"""
+        return self.speed / self.byte_time
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self) -> None:
+        start = time.monotonic()
+        bus_time = 0.0
+        while self.running:
+            round_start = bus_time
+            for packet in self.packets:
+                msg = packet.next_message(self.rng)
+                if self.garbage_rate and self.rng.random() < self.garbage_rate:
+                    pos = self.rng.randrange(1, len(msg))
+                    msg[pos] ^= 1 << self.rng.randrange(7)
+                    self.stats_corrupted += 1
+
+                bus_time += len(msg) * self.byte_time
+                delay = start + bus_time / self.speed - time.monotonic()
+                if delay > 0:
+                    if self.stopped.wait(delay):
+                        break
+                else:
+                    self.stats_late = max(self.stats_late, -delay)
+
+                self.write(msg)
+                self.stats_messages += 1
+                self.stats_bytes += len(msg)
+            bus_time = max(bus_time, round_start + self.period)
+            self.stats_cpu = time.thread_time()
+        self.stats_cpu = time.thread_time()
+
+class RecordedMessageInfo:
+    def __init__(self, mid: int, rc: int = 0) -> None:
+        self.mid = mid
+        self.rc = rc
+
+class RecordingMqttClient:
+    """In-process stand-in for paho's mqtt.Client, records what was published and when
+
+    Only the parts of the client used by vbus2mqtt are provided. The on_publish callback is called
+    synchronously, like a broker that acknowledges immediately.
+    """
+    def __init__(self, record: bool = True) -> None:
+        self.record = record
+        self.messages = [] # (time.monotonic(), topic, payload, qos, retain)
+        self.publish_count = 0
+        self.publish_bytes = 0
+        self.topic_stats = {} # topic -> [count, bytes]
+        self.connected = True
+        self.mid = 0
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+
+    def publish(self, topic, payload = None, qos = 0, retain = False, properties = None) -> RecordedMessageInfo:
+        if not self.connected:
+            return RecordedMessageInfo(0, 4) # MQTT_ERR_NO_CONN
+
+        self.mid += 1
+        self.publish_count += 1
+        size = 0
+        if payload is not None:
+            size = len(payload) if isinstance(payload, (bytes, bytearray)) else len(str(payload))
+            self.publish_bytes += size
+        stats = self.topic_stats.get(topic)
+        if stats is None:
+            stats = [0, 0]
+            self.topic_stats[topic] = stats
+        stats[0] += 1
+        stats[1] += size
+        if self.record:
+            self.messages.append((time.monotonic(), topic, payload, qos, retain))
+        if self.on_publish is not None:
+            self.on_publish(self, None, self.mid)
+        return RecordedMessageInfo(self.mid)
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def set_connected(self, connected: bool) -> None:
+        """Simulates a connection loss or reconnect to the broker"""
+        self.connected = connected
+        if connected and self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        elif not connected and self.on_disconnect is not None:
+            self.on_disconnect(self, None, 1)
+
+    def disconnect(self) -> None:
+        self.connected = False
+
+    def loop_start(self) -> None:
+        pass
+
+    def loop_stop(self) -> None:
+        pass
@@ -0,0 +1,74 @@
+import json
+import time
+import unittest
+
+from MqttDispatcher import MqttDispatcherAggregate, MqttDispatcherAggregateSliding, MqttDispatcherAggregateTumbling
+
+class TestMqttDispatcherAggregate(unittest.TestCase):
+    def test_construct(self):
+        self.assertIsInstance(MqttDispatcherAggregate.construct("tumbling", 60), MqttDispatcherAggregateTumbling)
+        self.assertIsInstance(MqttDispatcherAggregate.construct("sliding", 60), MqttDispatcherAggregateSliding)
+        with self.assertRaises(Exception):
+            MqttDispatcherAggregate.construct("hopping", 60)
+        with self.assertRaises(Exception):
+            MqttDispatcherAggregate.construct("sliding", 0)
+
+    def test_tumbling(self):
+        aggregate = MqttDispatcherAggregateTumbling(10)
+        self.assertEqual(aggregate.get(5.0)["count"], 0)
+        aggregate.add(1.0, 100.0)
+        aggregate.add(3.0, 105.0)
+        # the window 100..110 isn't completed yet
+        self.assertIsNone(aggregate.get(109.0)["mean"])
+
+        result = aggregate.get(110.0)
+        self.assertEqual(result, { "min": 1.0, "max": 3.0, "mean": 2.0, "count": 2, "integral": 1.0 * 5 + 3.0 * 5 })
+
+    def test_tumbling_empty_window_holds_value(self):
+        aggregate = MqttDispatcherAggregateTumbling(10)
+        aggregate.add(2.0, 100.0)
+        result = aggregate.get(125.0)
+        # the last completed window 110..120 had no samples, the value 2 was held
+        self.assertEqual(result, { "min": None, "max": None, "mean": None, "count": 0, "integral": 20.0 })
+
+    def test_sliding(self):
+        aggregate = MqttDispatcherAggregateSliding(10)
+        for now, value in ((100.0, 5.0), (102.0, 1.0), (104.0, 3.0), (108.0, 2.0)):
+            aggregate.add(value, now)
+
+        result = aggregate.get(110.0)
+        self.assertEqual((result["min"], result["max"], result["count"]), (1.0, 5.0, 4))
+        self.assertAlmostEqual(result["mean"], 2.75)
+        self.assertAlmostEqual(result["integral"], 5.0 * 2 + 1.0 * 2 + 3.0 * 4 + 2.0 * 2)
+
+        # 100 and 102 dropped out of the window 103..113, 1.0 is held from 102 until 104
+        result = aggregate.get(113.0)
+        self.assertEqual((result["min"], result["max"], result["count"]), (2.0, 3.0, 2))
+        self.assertAlmostEqual(result["integral"], 1.0 * 1 + 3.0 * 4 + 2.0 * 5)
+
+    def test_sliding_expired(self):
+        aggregate = MqttDispatcherAggregateSliding(10)
+        aggregate.add(4.0, 100.0)
+        result = aggregate.get(200.0)
+        self.assertEqual((result["min"], result["max"], result["mean"], result["count"]), (None, None, None, 0))
+        self.assertAlmostEqual(result["integral"], 40.0)
+
+    def test_state(self):
+        for mode in ("tumbling", "sliding"):
+            with self.subTest(mode=mode):
+                # set_state() expires the samples of a sliding window at the current time
+                base = time.time() - 12
+                aggregate = MqttDispatcherAggregate.construct(mode, 10)
+                for now, value in ((base, 5.0), (base + 3, 1.0), (base + 11, 3.0)):
+                    aggregate.add(value, now)
+                # the state survives a round trip through JSON, e.g. a snapshot
+                state = json.loads(json.dumps(aggregate.get_state()))
+
+                restored = MqttDispatcherAggregate.construct(mode, 10)
+                restored.set_state(state)
+                restored.add(2.0, base + 15)
+                aggregate.add(2.0, base + 15)
+                self.assertEqual(restored.get(base + 20), aggregate.get(base + 20))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import copy
+import os
+import random
+import tempfile
+import unittest
+
+from VBusSimulator import build_vsf, synthetic_packets
+from VBusSpecReader import VbusSpec
+
+try:
+    import numpy as np
+    from VBusColumnarDecoder import VbusColumnarDecoder
+except ImportError:
+    np = None
+
+def load_template(field_count: int):
+    with tempfile.NamedTemporaryFile(suffix=".vsf", delete=False) as f:
+        f.write(build_vsf(synthetic_packets(1, field_count)))
+    try:
+        spec = VbusSpec()
+        spec.load_vsf(f.name)
+        spec.file.close()
+    finally:
+        os.unlink(f.name)
+    return spec.packet_templates[0]
+
+def random_payloads(template, count: int, seed: int = 0) -> list:
+    # random bytes instead of plausible values to cover signed parts and all bits
+    rng = random.Random(seed)
+    length = max(part.offset for field in template.fields for part in field.parts) + 1
+    return [bytes(rng.randrange(256) for _ in range(length)) for _ in range(count)]
+
+@unittest.skipIf(np is None, "VbusColumnarDecoder requires NumPy")
+class TestVbusColumnarDecoder(unittest.TestCase):
+    def assertMatchesDecodeMessage(self, template, payloads):
+        columns = VbusColumnarDecoder(template).decode(payloads)
+        self.assertEqual(list(columns), [field.full_id for field in template.fields])
+        for field in template.fields:
+            expected = [field.decode_message(payload) for payload in payloads]
+            self.assertEqual(columns[field.full_id].tolist(), expected, field.full_id)
+            self.assertEqual(columns[field.full_id].dtype, np.float64 if field.precision != 0 else np.int64)
+
+    def test_matches_decode_message(self):
+        template = load_template(12)
+        self.assertMatchesDecodeMessage(template, random_payloads(template, 500))
+
+    def test_bit_fields(self):
+        template = load_template(4)
+        # upper nibble of a signed byte and a bit of a 1 byte field
+        template.fields[0].parts[1].mask = 0xF0
+        template.fields[0].parts[1].bit_pos = 4
+        template.fields[1].parts[0].mask = 0x08
+        template.fields[1].parts[0].bit_pos = 3
+        self.assertMatchesDecodeMessage(template, random_payloads(template, 200, 1))
+
+    def test_empty_and_large_fields(self):
+        template = load_template(4)
+        template.fields[1].parts = []
+        # the sum doesn't fit into int64, Python integers are used
+        part = copy.copy(template.fields[2].parts[0])
+        part.factor = 2**62
+        template.fields[2].parts = [template.fields[2].parts[0], part]
+        decoder = VbusColumnarDecoder(template)
+        self.assertEqual(decoder.empty_fields, { 1 })
+        self.assertEqual(decoder.object_fields, { 2 })
+        self.assertMatchesDecodeMessage(template, random_payloads(template, 200, 2))
+
+    def test_stacked_payloads_and_timestamps(self):
+        template = load_template(6)
+        payloads = random_payloads(template, 10, 3)
+        decoder = VbusColumnarDecoder(template)
+        columns = decoder.decode(VbusColumnarDecoder.stack_payloads(payloads), [float(i) for i in range(10)])
+        self.assertEqual(columns["time"].tolist(), [float(i) for i in range(10)])
+        self.assertEqual(columns[decoder.field_ids[0]].tolist(), decoder.decode(payloads)[decoder.field_ids[0]].tolist())
+
+        with self.assertRaises(Exception):
+            decoder.decode(payloads, [0.0])
+        with self.assertRaises(Exception):
+            decoder.decode(payloads[:2] + [payloads[2][:-1]])
+        with self.assertRaises(IndexError):
+            decoder.decode([payload[:2] for payload in payloads])
+
+    def test_no_payloads(self):
+        template = load_template(4)
+        columns = VbusColumnarDecoder(template).decode([])
+        self.assertTrue(all(len(column) == 0 for column in columns.values()))
+
+if __name__ == "__main__":
+    unittest.main()
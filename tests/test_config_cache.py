@@ -0,0 +1,98 @@
+import json
+import os
+import stat
+import tempfile
+import unittest
+
+from ConfigCache import CACHE_VERSION, load_config
+
+CONFIG = """{
+    // comments and trailing commas are json5
+    vbus: { serialport: "/dev/ttyUSB0", baudrate: 9600, vsf: "vbus_specification.vsf" },
+    mqtt: { host: "localhost", port: 1883, user: "user", pass: "secret", topic_prefix: "vbus/" },
+    plugins: [],
+    transfers: [ { mqtt: "temperatures", trigger: { type: "update" }, type: "json" }, ],
+}
+"""
+
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "vbus2mqtt.json")
+        self.cache_file = os.path.join(self.tmp.name, ".vbus2mqtt.json.cache")
+        with open(self.filename, "w") as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read_cache(self):
+        with open(self.cache_file) as f:
+            return json.load(f)
+
+    def write_cache(self, cache):
+        with open(self.cache_file, "w") as f:
+            json.dump(cache, f)
+
+    def test_parse_and_cache(self):
+        config = load_config(self.filename)
+        self.assertEqual(config["mqtt"]["pass"], "secret")
+        cache = self.read_cache()
+        self.assertEqual(cache["version"], CACHE_VERSION)
+        self.assertEqual(cache["config"], config)
+
+    def test_cache_hit(self):
+        load_config(self.filename)
+        # the cached config is used as long as modification time and size are unchanged
+        cache = self.read_cache()
+        cache["config"]["mqtt"]["host"] = "cached"
+        self.write_cache(cache)
+        self.assertEqual(load_config(self.filename)["mqtt"]["host"], "cached")
+
+    def test_content_decides_if_mtime_changed(self):
+        load_config(self.filename)
+        cache = self.read_cache()
+        cache["config"]["mqtt"]["host"] = "cached"
+        self.write_cache(cache)
+
+        os.utime(self.filename, ns=(0, 0))
+        self.assertEqual(load_config(self.filename)["mqtt"]["host"], "cached")
+
+        with open(self.filename, "w") as f:
+            f.write(CONFIG.replace("localhost", "broker"))
+        self.assertEqual(load_config(self.filename)["mqtt"]["host"], "broker")
+
+    def test_malformed_cache_is_a_miss(self):
+        for content in ("", "not json", "[]", "\"cache\"", json.dumps({ "version": CACHE_VERSION }),
+                json.dumps({ "version": CACHE_VERSION, "mtime_ns": 0, "config": [] }), json.dumps({ "version": -1 })):
+            with self.subTest(content=content):
+                with open(self.cache_file, "w") as f:
+                    f.write(content)
+                self.assertEqual(load_config(self.filename)["mqtt"]["host"], "localhost")
+                self.assertEqual(self.read_cache()["version"], CACHE_VERSION)
+
+    def test_cache_permissions(self):
+        os.chmod(self.filename, 0o600)
+        load_config(self.filename)
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_file).st_mode), 0o600)
+
+        # a cache readable by others is corrected on a cache hit
+        os.chmod(self.cache_file, 0o644)
+        load_config(self.filename)
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_file).st_mode), 0o600)
+
+    def test_custom_cache_file(self):
+        cache_file = os.path.join(self.tmp.name, "cache.json")
+        load_config(self.filename, cache_file)
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_invalid_config(self):
+        with open(self.filename, "w") as f:
+            f.write("{ vbus: {}, mqtt: {}, plugins: [], transfers: [] }")
+        with self.assertRaises(Exception):
+            load_config(self.filename)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import fnmatch
+import unittest
+
+from MqttDispatcher import MqttDispatcherFieldIndex
+
+FIELD_IDS = [
+    "00_0010_7321_10_0100_000_2_0", "00_0010_7321_10_0100_002_2_0", "00_0010_7321_10_0100_004_2_0",
+    "00_0010_7321_10_0100_040_4_0", "00_0010_7322_10_0100_000_2_0", "00_0010_7E11_10_0100_000_2_0",
+    "01_0010_7321_10_0100_000_2_0",
+]
+
+class TestMqttDispatcherFieldIndex(unittest.TestCase):
+    def setUp(self):
+        # duplicates and the order of the ids don't matter
+        self.index = MqttDispatcherFieldIndex(list(reversed(FIELD_IDS)) + FIELD_IDS[:2])
+
+    def test_is_pattern(self):
+        self.assertTrue(MqttDispatcherFieldIndex.is_pattern("00_0010_7321_*"))
+        self.assertTrue(MqttDispatcherFieldIndex.is_pattern("00_0010_732?_10"))
+        self.assertTrue(MqttDispatcherFieldIndex.is_pattern("00_0010_732[12]_10"))
+        self.assertFalse(MqttDispatcherFieldIndex.is_pattern(FIELD_IDS[0]))
+        self.assertFalse(MqttDispatcherFieldIndex.is_pattern(None))
+
+    def test_prefix(self):
+        self.assertEqual(MqttDispatcherFieldIndex.prefix("00_0010_7321_*"), "00_0010_7321_")
+        self.assertEqual(MqttDispatcherFieldIndex.prefix("00_0010_73?1_*"), "00_0010_73")
+        self.assertEqual(MqttDispatcherFieldIndex.prefix("00_[0]010_*"), "00_")
+        self.assertEqual(MqttDispatcherFieldIndex.prefix("*"), "")
+
+    def test_match_prefix(self):
+        self.assertEqual(self.index.match("00_0010_7321_10_0100_*"), FIELD_IDS[:4])
+        self.assertEqual(self.index.match("*"), FIELD_IDS)
+
+    def test_match_wildcards(self):
+        self.assertEqual(self.index.match("00_0010_732?_10_0100_000_*"), [FIELD_IDS[0], FIELD_IDS[4]])
+        self.assertEqual(self.index.match("00_0010_7321_10_0100_00[24]_2_0"), FIELD_IDS[1:3])
+        self.assertEqual(self.index.match("*_000_2_0"), [FIELD_IDS[0], FIELD_IDS[4], FIELD_IDS[5], FIELD_IDS[6]])
+
+    def test_no_match(self):
+        self.assertEqual(self.index.match("00_0010_7999_*"), [])
+        self.assertEqual(self.index.match("02_*"), [])
+        self.assertEqual(self.index.match("00_0010_7321_10_0100_0?0_4_1"), [])
+
+    def test_matches_fnmatch(self):
+        for pattern in ("00_*", "0?_0010_7321_*", "*_4_0", "00_0010_7[3E]*", "00_0010_7321_10_0100_00?_2_0"):
+            with self.subTest(pattern=pattern):
+                self.assertEqual(self.index.match(pattern), [field_id for field_id in FIELD_IDS if fnmatch.fnmatchcase(field_id, pattern)])
+
+if __name__ == "__main__":
+    unittest.main()
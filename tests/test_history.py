@@ -0,0 +1,64 @@
+import random
+import unittest
+
+from MqttDispatcher import MqttDispatcherFieldHistory
+
+class TestMqttDispatcherFieldHistory(unittest.TestCase):
+    def filled(self, capacity, times):
+        history = MqttDispatcherFieldHistory(capacity)
+        for i, timestamp in enumerate(times):
+            history.append(i, timestamp)
+        return history
+
+    def test_ring_buffer(self):
+        history = self.filled(3, [1.0, 2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(len(history), 3)
+        self.assertEqual(list(history.range()), [(3.0, 2.0), (4.0, 3.0), (5.0, 4.0)])
+
+    def test_range_bounds_are_inclusive(self):
+        history = self.filled(4, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        self.assertEqual([t for t, _ in history.range(4.0, 5.0)], [4.0, 5.0])
+        self.assertEqual([t for t, _ in history.range(3.5, 5.5)], [4.0, 5.0])
+        self.assertEqual([t for t, _ in history.range(since=5.0)], [5.0, 6.0])
+        self.assertEqual([t for t, _ in history.range(until=3.0)], [3.0])
+        self.assertEqual(len(history.range(0.0, 2.0)), 0)
+        self.assertEqual(len(history.range(7.0)), 0)
+        self.assertEqual(len(history.range(5.0, 4.0)), 0)
+
+    def test_range_equal_timestamps(self):
+        # large time.time() like timestamps, no epsilon is needed for the inclusive end
+        base = 1.7e9
+        history = self.filled(4, [base, base + 1, base + 1, base + 1, base + 2])
+        self.assertEqual(list(history.range(base + 1, base + 1)), [(base + 1, 1.0), (base + 1, 2.0), (base + 1, 3.0)])
+
+    def test_range_matches_linear_search(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            capacity = rng.randint(1, 8)
+            now = 1.7e9
+            entries = []
+            history = MqttDispatcherFieldHistory(capacity)
+            for i in range(rng.randint(0, 20)):
+                now += rng.choice((0.0, 0.25, 1.0))
+                history.append(i, now)
+                entries.append((now, float(i)))
+            entries = entries[-capacity:]
+
+            candidates = [t for t, _ in entries] + [1.7e9 - 1, now + 1]
+            since, until = rng.choice(candidates), rng.choice(candidates)
+            self.assertEqual(list(history.range(since, until)), [e for e in entries if since <= e[0] <= until])
+
+    def test_segments(self):
+        history = self.filled(4, [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        segments = history.range().segments()
+        self.assertEqual([list(times) for times, _ in segments], [[3.0, 4.0], [5.0, 6.0]])
+        self.assertEqual([list(values) for _, values in segments], [[2.0, 3.0], [4.0, 5.0]])
+
+    def test_rate_and_slope(self):
+        history = self.filled(10, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(history.range().rate(), 1.0)
+        self.assertAlmostEqual(history.range().slope(), 1.0)
+        self.assertIsNone(history.range(until=0.0).rate())
+
+if __name__ == "__main__":
+    unittest.main()
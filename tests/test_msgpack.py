@@ -0,0 +1,71 @@
+import struct
+import unittest
+
+from MsgpackHelper import msgpack_array_header, msgpack_map_header, msgpack_pack, msgpack_str
+
+def pack(value, float32=False) -> bytes:
+    out = bytearray()
+    msgpack_pack(value, out, float32)
+    return bytes(out)
+
+class TestMsgpackHelper(unittest.TestCase):
+    def test_constants(self):
+        self.assertEqual(pack(None), b"\xc0")
+        self.assertEqual(pack(True), b"\xc3")
+        self.assertEqual(pack(False), b"\xc2")
+
+    def test_int_boundaries(self):
+        cases = [
+            (0, b"\x00"), (0x7F, b"\x7f"), (0x80, b"\xcc\x80"), (0xFF, b"\xcc\xff"),
+            (0x100, b"\xcd\x01\x00"), (0xFFFF, b"\xcd\xff\xff"), (0x10000, b"\xce\x00\x01\x00\x00"),
+            (0xFFFFFFFF, b"\xce\xff\xff\xff\xff"), (0x100000000, b"\xcf\x00\x00\x00\x01\x00\x00\x00\x00"),
+            (-1, b"\xff"), (-32, b"\xe0"), (-33, b"\xd0\xdf"), (-0x80, b"\xd0\x80"),
+            (-0x81, b"\xd1\xff\x7f"), (-0x8000, b"\xd1\x80\x00"), (-0x8001, b"\xd2\xff\xff\x7f\xff"),
+            (-0x80000000, b"\xd2\x80\x00\x00\x00"), (-0x80000001, b"\xd3\xff\xff\xff\xff\x7f\xff\xff\xff"),
+        ]
+        for value, expected in cases:
+            with self.subTest(value=value):
+                self.assertEqual(pack(value), expected)
+
+    def test_floats_stay_floats(self):
+        self.assertEqual(pack(34.0), struct.pack(">Bd", 0xCB, 34.0))
+        self.assertEqual(pack(14.3), struct.pack(">Bd", 0xCB, 14.3))
+        self.assertEqual(pack(34.0, float32=True), struct.pack(">Bf", 0xCA, 34.0))
+
+    def test_float32_overflow(self):
+        # values out of the single precision range are encoded with double precision
+        self.assertEqual(pack(1e39, float32=True), struct.pack(">Bd", 0xCB, 1e39))
+        self.assertEqual(pack(float("inf"), float32=True), struct.pack(">Bd", 0xCB, float("inf")))
+        self.assertEqual(pack(float("nan"), float32=True)[0], 0xCA)
+
+    def test_str(self):
+        self.assertEqual(msgpack_str(""), b"\xa0")
+        self.assertEqual(msgpack_str("a" * 31), b"\xbf" + b"a" * 31)
+        self.assertEqual(msgpack_str("a" * 32), b"\xd9\x20" + b"a" * 32)
+        self.assertEqual(msgpack_str("a" * 0x100), b"\xda\x01\x00" + b"a" * 0x100)
+        self.assertEqual(msgpack_str("a" * 0x10000), b"\xdb\x00\x01\x00\x00" + b"a" * 0x10000)
+        # the length is counted in bytes of the UTF-8 encoding
+        self.assertEqual(msgpack_str("°C"), b"\xa3\xc2\xb0C")
+
+    def test_bin(self):
+        self.assertEqual(pack(b"\x01\x02"), b"\xc4\x02\x01\x02")
+        self.assertEqual(pack(bytes(0x100))[:3], b"\xc5\x01\x00")
+        self.assertEqual(pack(bytes(0x10000))[:5], b"\xc6\x00\x01\x00\x00")
+
+    def test_array_and_map_headers(self):
+        self.assertEqual(msgpack_array_header(15), b"\x9f")
+        self.assertEqual(msgpack_array_header(16), b"\xdc\x00\x10")
+        self.assertEqual(msgpack_array_header(0x10000), b"\xdd\x00\x01\x00\x00")
+        self.assertEqual(msgpack_map_header(15), b"\x8f")
+        self.assertEqual(msgpack_map_header(16), b"\xde\x00\x10")
+        self.assertEqual(msgpack_map_header(0x10000), b"\xdf\x00\x01\x00\x00")
+
+    def test_nested(self):
+        self.assertEqual(pack({ "a": [1, None], "b": (True,) }), b"\x82\xa1a\x92\x01\xc0\xa1b\x91\xc3")
+
+    def test_unsupported_type(self):
+        with self.assertRaises(Exception):
+            pack(object())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from MqttDispatcher import MqttDispatcherScheduler
+
+class TestMqttDispatcherScheduler(unittest.TestCase):
+    def test_order(self):
+        scheduler = MqttDispatcherScheduler()
+        calls = []
+        scheduler.schedule(3.0, lambda now: calls.append("c"))
+        scheduler.schedule(1.0, lambda now: calls.append("a"))
+        scheduler.schedule(2.0, lambda now: calls.append("b"))
+        scheduler.schedule(2.0, lambda now: calls.append("b2"))
+
+        self.assertEqual(scheduler.run_due(2.0), 3.0)
+        self.assertEqual(calls, ["a", "b", "b2"])
+        self.assertIsNone(scheduler.run_due(3.0))
+        self.assertEqual(calls, ["a", "b", "b2", "c"])
+
+    def test_reschedule(self):
+        scheduler = MqttDispatcherScheduler()
+        calls = []
+        def callback(now):
+            calls.append(now)
+            return now + 5.0
+        scheduler.schedule(1.0, callback)
+
+        self.assertEqual(scheduler.run_due(1.0), 6.0)
+        self.assertEqual(scheduler.run_due(4.0), 6.0)
+        self.assertEqual(scheduler.run_due(6.5), 11.5)
+        self.assertEqual(calls, [1.0, 6.5])
+
+    def test_due_deadline_is_postponed(self):
+        # a callback returning a deadline that is already due runs once per run_due()
+        scheduler = MqttDispatcherScheduler()
+        calls = []
+        def callback(now):
+            calls.append(now)
+            return now - 1.0
+        scheduler.schedule(1.0, callback)
+
+        self.assertEqual(scheduler.run_due(1.0), 1.0 + MqttDispatcherScheduler.MIN_STEP)
+        self.assertEqual(calls, [1.0])
+
+    def test_cancel(self):
+        scheduler = MqttDispatcherScheduler()
+        calls = []
+        entry = scheduler.schedule(1.0, lambda now: calls.append("a"))
+        scheduler.schedule(2.0, lambda now: calls.append("b"))
+        scheduler.cancel(entry)
+
+        self.assertEqual(scheduler.next_deadline(), 2.0)
+        self.assertIsNone(scheduler.run_due(2.0))
+        self.assertEqual(calls, ["b"])
+
+    def test_cancel_from_callback(self):
+        scheduler = MqttDispatcherScheduler()
+        entries = []
+        def callback(now):
+            scheduler.cancel(entries[0])
+            return now + 1.0
+        entries.append(scheduler.schedule(1.0, callback))
+
+        self.assertIsNone(scheduler.run_due(1.0))
+        self.assertEqual(scheduler.queue, [])
+
+if __name__ == "__main__":
+    unittest.main()
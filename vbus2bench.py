@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+import argparse
+import atexit
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from VBusSimulator import synthetic_packets, build_vsf, build_stream, RecordingMqttClient
+from VBusSpecReader import VbusSpec
+from VBusReader import VbusReader, VbusMessage1v0
+from MqttDispatcher import MqttDispatcher
+
+class Benchmark:
+    def __init__(self, name: str, param, setup, ops: int = 1) -> None:
+        """A benchmark case
+
+        Args:
+            name (str): name of the benchmark
+            param (Any): size parameter of the case, e.g. count of fields
+            setup (Callable[[], Callable[[], None]]): prepares the case and returns the function to measure
+            ops (int, optional): operations done by one call of the function. Defaults to 1.
+        """
+        self.name = name
+        self.param = param
+        self.setup = setup
+        self.ops = ops
+
+    @property
+    def id(self) -> str:
+        return f"{self.name}[{self.param}]"
+
+def measure(func, ops: int, min_time: float, repeat: int) -> dict:
+    # calibrate the count of calls per repetition
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 4:
+            break
+        number *= 4
+    number = max(1, math.ceil(number * min_time / max(elapsed, 1e-9)))
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / (number * ops))
+
+    # memory allocated during one call, measured separately as tracing slows down the function
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = min(timings)
+    return {
+        "ns_per_op": best * 1e9,
+        "ns_per_op_median": statistics.median(timings) * 1e9,
+        "ops_per_s": 1 / best if best > 0 else None,
+        "peak_alloc_bytes_per_op": (peak - base) / ops,
+        "calls": number * repeat,
+    }
+
+def write_vsf(packets) -> str:
+    f = tempfile.NamedTemporaryFile(prefix="vbus2bench_", suffix=".vsf", delete=False)
+    f.write(build_vsf(packets))
+    f.close()
+    return f.name
+
+def load_spec(packets) -> VbusSpec:
+    filename = write_vsf(packets)
+    spec = VbusSpec()
+    spec.load_vsf(filename)
+    os.unlink(filename)
+    return spec
+
+def transfer_configs(field_ids, transfer_count, fields_per_transfer, trigger) -> list:
+    transfers = []
+    for t in range(transfer_count):
+        items = [{ "name": f"f{i}", "item": field_ids[(t * fields_per_transfer + i) % len(field_ids)] } for i in range(fields_per_transfer)]
+        transfers.append({
+            "mqtt": { "topic": f"bench/{t}" },
+            "trigger": trigger,
+            "type": "json",
+            "fields": items,
+        })
+    return transfers
+
+def bench_reader_write_bytes(field_count):
+    messages = 100
+    stream = build_stream(synthetic_packets(4, field_count), messages)
+    def run():
+        VbusReader().write_bytes(stream)
+    return run
+
+def bench_message1v0(field_count):
+    stream = build_stream(synthetic_packets(1, field_count), 1)
+    def run():
+        VbusMessage1v0(0, 0, stream)
+    return run
+
+def bench_decode_message(field_count):
+    packets = synthetic_packets(1, field_count)
+    spec = load_spec(packets)
+    template = spec.packet_templates[0]
+    payload = bytearray(packets[0].next_payload(random.Random(0)))
+    def run():
+        template.decode_message(payload)
+    return run
+
+def bench_decode_columnar(field_count):
+    # numpy is optional, it's only imported if this benchmark is run
+    from VBusColumnarDecoder import VbusColumnarDecoder
+    packets = synthetic_packets(1, field_count)
+    spec = load_spec(packets)
+    decoder = VbusColumnarDecoder(spec.packet_templates[0])
+    rng = random.Random(0)
+    payloads = VbusColumnarDecoder.stack_payloads([packets[0].next_payload(rng) for _ in range(1000)])
+    def run():
+        decoder.decode(payloads)
+    return run
+
+def bench_load_vsf(packet_count):
+    filename = write_vsf(synthetic_packets(packet_count, 32))
+    atexit.register(os.unlink, filename)
+    def run():
+        spec = VbusSpec()
+        spec.load_vsf(filename)
+        spec.file.close()
+    return run
+
+def _dispatcher(transfer_count, trigger):
+    packets = synthetic_packets(4, 32)
+    field_ids = [packet.field_id(i) for packet in packets for i in range(len(packet.fields))]
+    transfers = transfer_configs(field_ids, transfer_count, 8, trigger)
+    dispatcher = MqttDispatcher(RecordingMqttClient(record=False), [], transfers, "bench/")
+    dispatcher.publisher.set_connected(True)
+    return packets, dispatcher
+
+def bench_update_fields(transfer_count):
+    # interval triggers, so only the update itself is measured
+    packets, dispatcher = _dispatcher(transfer_count, { "type": "interval", "interval": 3600 })
+    values = { packets[0].field_id(i): float(i) for i in range(len(packets[0].fields)) }
+    def run():
+        dispatcher.update_fields(values, None)
+    return run
+
+def bench_update_fields_transmit(transfer_count):
+    packets, dispatcher = _dispatcher(transfer_count, { "type": "update" })
+    values = { packets[0].field_id(i): float(i) for i in range(len(packets[0].fields)) }
+    def run():
+        dispatcher.update_fields(values, None)
+    return run
+
+def _bench_get_content(field_count, transfer_type):
+    packets = synthetic_packets(1, 32)
+    field_ids = [packets[0].field_id(i) for i in range(32)]
+    transfers = transfer_configs(field_ids, 1, field_count, { "type": "interval", "interval": 3600 })
+    transfers[0]["type"] = transfer_type
+    dispatcher = MqttDispatcher(RecordingMqttClient(record=False), [], transfers, "bench/")
+    dispatcher.update_fields({ field_id: 12.3 for field_id in field_ids }, None)
+    transfer = dispatcher.transfers[0]
+    if transfer_type == "json":
+        def run():
+            json.dumps(transfer.get_content())
+    else:
+        run = transfer.get_content
+    return run
+
+BENCHMARKS = \
+    [Benchmark("VbusReader.write_bytes", n, lambda n=n: bench_reader_write_bytes(n), ops = 100) for n in (8, 32, 128)] + \
+    [Benchmark("VbusMessage1v0", n, lambda n=n: bench_message1v0(n)) for n in (8, 32, 128)] + \
+    [Benchmark("VbusPacketTemplate.decode_message", n, lambda n=n: bench_decode_message(n)) for n in (8, 32, 128)] + \
+    [Benchmark("VbusColumnarDecoder.decode", n, lambda n=n: bench_decode_columnar(n), ops = 1000) for n in (8, 32, 128)] + \
+    [Benchmark("VbusSpec.load_vsf", n, lambda n=n: bench_load_vsf(n)) for n in (1, 10, 100)] + \
+    [Benchmark("MqttDispatcher.update_fields", n, lambda n=n: bench_update_fields(n)) for n in (10, 100, 1000)] + \
+    [Benchmark("MqttDispatcher.update_fields+transmit", n, lambda n=n: bench_update_fields_transmit(n)) for n in (10, 100, 1000)] + \
+    [Benchmark("TransferJson.get_content", n, lambda n=n: _bench_get_content(n, "json")) for n in (10, 100, 1000)] + \
+    [Benchmark("TransferMsgpack.get_content", n, lambda n=n: _bench_get_content(n, "msgpack")) for n in (10, 100, 1000)]
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def format_ns(ns: float) -> str:
+    if ns >= 1e9:
+        return f"{ns / 1e9:.2f} s"
+    if ns >= 1e6:
+        return f"{ns / 1e6:.2f} ms"
+    if ns >= 1e3:
+        return f"{ns / 1e3:.2f} µs"
+    return f"{ns:.0f} ns"
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the VBus reader, decoder, spec loader and dispatcher")
+    parser.add_argument("-f", "--filter", required=False, default=None, help="only run benchmarks containing this text")
+    parser.add_argument("-j", "--json", required=False, default=None, help="write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", required=False, default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument("-t", "--min-time", required=False, type=float, default=0.2, help="minimum time per repetition in seconds")
+    parser.add_argument("-r", "--repeat", required=False, type=int, default=5, help="count of repetitions, the best one is reported")
+    parser.add_argument("-l", "--list", action="store_true", help="list the benchmarks and exit")
+
+    args = parser.parse_args()
+
+    benchmarks = [b for b in BENCHMARKS if args.filter is None or args.filter in b.id]
+    if args.list:
+        for benchmark in benchmarks:
+            print(benchmark.id)
+        return
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = { result["id"]: result for result in json.load(f)["results"] }
+
+    results = []
+    for benchmark in benchmarks:
+        try:
+            func = benchmark.setup()
+        except ImportError as e:
+            # optional dependencies like numpy
+            print(f"{benchmark.id:<45} skipped: {e}", flush=True)
+            continue
+        result = measure(func, benchmark.ops, args.min_time, args.repeat)
+        result = { "id": benchmark.id, "name": benchmark.name, "param": benchmark.param, **result }
+        results.append(result)
+
+        line = f"{benchmark.id:<45} {format_ns(result['ns_per_op']):>10}/op {result['ops_per_s']:>14,.0f} op/s {result['peak_alloc_bytes_per_op']:>12,.0f} B/op"
+        if benchmark.id in baseline:
+            change = result["ns_per_op"] / baseline[benchmark.id]["ns_per_op"] - 1
+            line += f" {change:>+8.1%}"
+        print(line, flush=True)
+
+    if args.json is not None:
+        output = {
+            "meta": {
+                "revision": git_revision(),
+                "python": sys.version.split()[0],
+                "implementation": platform.python_implementation(),
+                "machine": platform.machine(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "min_time": args.min_time,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(output, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,124 @@
 #!/usr/bin/python3
 
-from VBusSpecReader import VbusSpec
-from VBusReader import VbusReader, VbusSerialReader, VbusMessage1v0, VbusDatagram2v0, VbusTelegram3v0, VbusTelegram3v1
+from VBusSpecReader import VbusSpec, VbusFieldType
+from VBusReader import VbusReader, VbusSerialReader, VbusMessage1v0, VbusDatagram2v0, VbusTelegram3v0, VbusTelegram3v1, VbusMessageGarbage
 import serial
+import sys
+import json
+import threading
 import time
 import argparse
 
 vbs = None
 lang = "EN"
+packets = {} # (src, dst, cmd) -> packet template of the spec or None
+devices = {} # addr -> device name
 
 def dev_name(addr, lang = "EN"):
-    if vbs is None:
-        return "<unknown>"
-    
-    dev = vbs.get_device(addr)
-    if dev is not None:
-        return dev.name[lang]
-
-    return "<unknown>"
+    name = devices.get(addr)
+    if name is not None:
+        return name
+
+    name = "<unknown>"
+    if vbs is not None:
+        dev = vbs.get_device(addr)
+        if dev is not None:
+            name = dev.name[lang]
+    devices[addr] = name
+    return name
+
+def get_packet(src, dst, cmd):
+    key = (src, dst, cmd)
+    if key in packets:
+        return packets[key]
+    packet = vbs.get_packet(src, dst, cmd) if vbs is not None else None
+    packets[key] = packet
+    return packet
+
+class MessageFilter:
+    """Filter on the header of messages, evaluated before anything is decoded
+
+    Each criterion is a set of accepted values, None accepts all values.
+    """
+    def __init__(self, src = None, dst = None, cmd = None, protocol = None) -> None:
+        self.src = set(src) if src else None
+        self.dst = set(dst) if dst else None
+        self.cmd = set(cmd) if cmd else None
+        self.protocol = set(protocol) if protocol else None
+
+    def accepts(self, msg) -> bool:
+        if isinstance(msg, VbusMessageGarbage):
+            return False
+        if self.src is not None and msg.addr_src not in self.src:
+            return False
+        if self.dst is not None and msg.addr_dst not in self.dst:
+            return False
+        if self.protocol is not None and VbusReader.buff_get_prot_ver(msg.msg_buff) not in self.protocol:
+            return False
+        if self.cmd is not None:
+            cmd = msg.command_int if isinstance(msg, VbusDatagram2v0) else msg.command
+            if cmd not in self.cmd:
+                return False
+        return True
+
+class NdjsonWriter:
+    """Writes one JSON record per message into a buffered file, flushed every flush_interval seconds
+
+    Records are written by the reader thread, flush() is also called by the main loop, so records
+    don't stay in the buffer while the bus is quiet.
+    """
+    def __init__(self, file, flush_interval: float = 1.0) -> None:
+        self.file = file
+        self.flush_interval = flush_interval
+        self.next_flush = time.monotonic() + flush_interval
+        self.lock = threading.Lock()
+        self.encoder = json.JSONEncoder(separators=(",", ":"), default=str)
+        self.records = 0
+
+    def on_message(self, reader, msg):
+        protver = VbusReader.buff_get_prot_ver(msg.msg_buff)
+        record = {
+            "time": round(msg.start_time, 3),
+            "src": f"0x{msg.addr_src:04X}",
+            "dst": f"0x{msg.addr_dst:04X}",
+            "protocol": f"{protver >> 4}.{protver & 0xF}",
+            "checksum_ok": msg.checksum_ok,
+            "raw": msg.msg_buff.hex(),
+        }
+
+        if isinstance(msg, VbusMessage1v0):
+            record["cmd"] = f"0x{msg.command:04X}"
+            packet = get_packet(msg.addr_src, msg.addr_dst, msg.command) if msg.checksum_ok else None
+            if packet is not None:
+                fields = {}
+                for field in packet.fields:
+                    value = field.decode_message(msg.payload)
+                    if field.type_id == VbusFieldType.Number:
+                        value = round(value, field.precision)
+                    fields[field.full_id] = value
+                record["fields"] = fields
+        elif isinstance(msg, VbusDatagram2v0):
+            record["cmd"] = f"0x{msg.command_int:04X}"
+            record["id"] = msg.id
+            record["value"] = msg.value
+
+        self.write(record)
+
+    def write(self, record: dict) -> None:
+        line = self.encoder.encode(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.records += 1
+        self.flush(False)
+
+    def flush(self, force: bool = True) -> None:
+        """Flushes the buffer if the flush interval elapsed or if forced"""
+        now = time.monotonic()
+        if not force and now < self.next_flush:
+            return
+        with self.lock:
+            self.file.flush()
+            self.next_flush = now + self.flush_interval
 
 def on_message(reader, msg):
     print("-----------------")
@@ -39,8 +140,8 @@ def on_message(reader, msg):
         print(f"  CMD: 0x{msg.command:04X}")
         print("  Fields:")
 
-        if vbs:
-            packet = vbs.get_packet(msg.addr_src, msg.addr_dst, msg.command)
+        packet = get_packet(msg.addr_src, msg.addr_dst, msg.command)
+        if packet is not None:
             decoded = packet.decode_message(msg.payload)
             for item in decoded:
                 val = item[1]
@@ -58,15 +159,44 @@ def on_message(reader, msg):
     elif isinstance(msg, VbusTelegram3v1):
         print("  VER: v3.1 Telegram")
 
+def print_packet_stats(reader, baudrate, file = None):
+    print("=================", file=file)
+    print(f"  {'SRC':<6} {'DST':<6} {'VER':<3} {'CMD':<6} {'COUNT':>7} {'RATE/s':>7} {'INTERVAL':>9} {'JITTER':>8} {'LOAD':>6} {'CHKERR':>6} {'ERR%':>6} {'GARBAGE':>8}  LAST SEEN", file=file)
+    now = time.time()
+    for stats in reader.get_packet_stats(baudrate):
+        def fmt(value, format):
+            return format.format(value) if value is not None else "-"
+        last_seen = f"{now - stats['last_seen']:.1f} s ago" if stats["last_seen"] is not None else "-"
+        print(f"  {stats['src']:<6} {stats['dst']:<6} {stats['protocol']:<3} {stats['command'] or '-':<6} {stats['count']:>7} " +
+            f"{fmt(stats['rate'], '{:.2f}'):>7} {fmt(stats['interval_mean'], '{:.3f} s'):>9} {fmt(stats['interval_jitter'], '{:.3f} s'):>8} " +
+            f"{fmt(stats['bus_load'], '{:.1%}'):>6} {stats['checksum_errors']:>6} {stats['checksum_error_rate']:>6.1%} {stats['garbage_bytes']:>8}  {last_seen}", file=file)
+    print(f"  total garbage: {reader.stats_garbage_bytes} bytes", file=file)
+
 def main():
     parser = argparse.ArgumentParser(description="Reads and interpretes VBus data from a serial port")
     parser.add_argument("-p", "--port", required=True, help="serial port")
     parser.add_argument("-b", "--baudrate", required=False, default="9600", help="baud rate")
     parser.add_argument("-v", "--vsf", required=False, default="vbus_specification.vsf", help="VBus specification file, used to decode data")
     parser.add_argument("-l", "--lang", required=False, default="EN", choices=["EN", "DE", "FR"], help="Language for text fields and descriptions")
+    parser.add_argument("-s", "--stats", required=False, type=float, default=None, help="print statistics per packet every STATS seconds")
+    parser.add_argument("-f", "--format", required=False, default="text", choices=["text", "ndjson"], help="output format, ndjson writes one JSON record per message")
+    parser.add_argument("-o", "--output", required=False, default=None, help="write the records to this file instead of stdout (ndjson only)")
+    parser.add_argument("--src", required=False, action="append", type=lambda x: int(x, 0), help="only messages from this source address, e.g. 0x7321 (repeatable)")
+    parser.add_argument("--dst", required=False, action="append", type=lambda x: int(x, 0), help="only messages to this destination address (repeatable)")
+    parser.add_argument("--cmd", required=False, action="append", type=lambda x: int(x, 0), help="only messages with this command (repeatable)")
+    parser.add_argument("--protocol", required=False, action="append", choices=["1.0", "2.0", "3.0", "3.1"], help="only messages of this protocol version (repeatable)")
 
     args = parser.parse_args()
 
+    output = None
+    if args.format == "ndjson":
+        if args.output is not None:
+            output = open(args.output, "a", buffering=1024 * 1024)
+        else:
+            # the records get stdout for themselves, any other output goes to stderr
+            output = open(sys.stdout.fileno(), "w", buffering=1024 * 1024, closefd=False)
+            sys.stdout = sys.stderr
+
     global vbs
     global lang
 
@@ -90,14 +220,32 @@ def main():
         print("Serial port could not be opened. Is it used by another application?")
         return
 
-    vsr = VbusSerialReader(serialport, on_message)
+    msg_filter = MessageFilter(args.src, args.dst, args.cmd,
+        [int(ver[0]) << 4 | int(ver[2]) for ver in args.protocol] if args.protocol else None)
+    writer = NdjsonWriter(output) if output is not None else None
+    handler = writer.on_message if writer is not None else on_message
+
+    def on_filtered_message(reader, msg):
+        if msg_filter.accepts(msg):
+            handler(reader, msg)
+
+    vsr = VbusSerialReader(serialport, on_filtered_message)
 
+    next_stats = time.monotonic() + args.stats if args.stats else None
     while True:
         try:
             time.sleep(1)
+            if writer is not None:
+                writer.flush(False)
+            if next_stats is not None and time.monotonic() >= next_stats:
+                print_packet_stats(vsr, int(args.baudrate), sys.stderr if output is not None else None)
+                next_stats += args.stats
         except KeyboardInterrupt:
             vsr.stop()
             serialport.close()
+            if output is not None:
+                vsr.thread_serial.join(10)
+                output.close()
             exit()
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from VBusSpecReader import VbusSpec, VbusFieldType
+from VBusReader import VbusReader, VbusMessage1v0, VbusDatagram2v0, VbusMessageGarbage
+
+SOF = VbusReader.SOF
+
+# spec of the worker processes, inherited from the parent if the processes are forked
+spec = None
+packets = {} # (src, dst, cmd) -> list of (field, field id, precision to round to or None), None if unknown
+
+def init_worker(vsf: str) -> None:
+    global spec
+    if spec is None:
+        spec = VbusSpec()
+        spec.load_vsf(vsf)
+
+def get_packet_fields(src, dst, cmd):
+    key = (src, dst, cmd)
+    if key in packets:
+        return packets[key]
+    packet = spec.get_packet(src, dst, cmd)
+    fields = None
+    if packet is not None:
+        # the field ids are formatted on each access, so they are looked up once
+        fields = [(field, field.full_id, field.precision if field.type_id == VbusFieldType.Number else None) for field in packet.fields]
+    packets[key] = fields
+    return fields
+
+def split_chunks(filename: str, chunk_size: int) -> list:
+    """Splits a capture into (offset, length) chunks starting at a SOF byte
+
+    Data bytes of VBus messages are septets, so 0xAA only appears at the start of a message and no message
+    is cut by a chunk boundary. Only the bytes around each boundary are read.
+    """
+    size = os.path.getsize(filename)
+    chunks = []
+    start = 0
+    with open(filename, "rb") as f:
+        while start < size:
+            end = start + chunk_size
+            while end < size:
+                f.seek(end)
+                block = f.read(4096)
+                pos = block.find(SOF)
+                if pos >= 0:
+                    end += pos
+                    break
+                end += len(block)
+            end = min(end, size)
+            chunks.append((start, end - start))
+            start = end
+    return chunks
+
+def decode_chunk(job: tuple) -> tuple:
+    """Decodes the messages of a chunk, runs in a worker process
+
+    Args:
+        job (tuple): file name, offset and length of the chunk and the output format
+
+    Returns:
+        tuple: formatted output of the chunk and counts of messages, checksum errors and garbage bytes
+    """
+    filename, offset, length, output_format = job
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n") if output_format == "csv" else None
+    encoder = json.JSONEncoder(separators=(",", ":"), default=str)
+    stats = { "messages": 0, "checksum_errors": 0, "garbage_bytes": 0 }
+    msg_offset = offset
+
+    def on_message(reader, msg):
+        if isinstance(msg, VbusMessageGarbage):
+            stats["garbage_bytes"] += len(msg.msg_buff)
+            return
+        stats["messages"] += 1
+        if not msg.checksum_ok:
+            stats["checksum_errors"] += 1
+            return
+
+        protver = VbusReader.buff_get_prot_ver(msg.msg_buff)
+        src = f"0x{msg.addr_src:04X}"
+        dst = f"0x{msg.addr_dst:04X}"
+        protocol = f"{protver >> 4}.{protver & 0xF}"
+
+        if isinstance(msg, VbusMessage1v0):
+            cmd = f"0x{msg.command:04X}"
+            fields = {}
+            packet_fields = get_packet_fields(msg.addr_src, msg.addr_dst, msg.command)
+            if packet_fields is not None:
+                payload = msg.payload
+                for field, field_id, precision in packet_fields:
+                    value = field.decode_message(payload)
+                    if precision is not None:
+                        value = round(value, precision)
+                    fields[field_id] = value
+            if writer is not None:
+                for field_id, value in fields.items():
+                    writer.writerow((msg_offset, src, dst, protocol, cmd, field_id, value))
+            else:
+                out.write(encoder.encode({ "offset": msg_offset, "src": src, "dst": dst, "protocol": protocol, "cmd": cmd, "fields": fields }))
+                out.write("\n")
+        elif isinstance(msg, VbusDatagram2v0):
+            cmd = f"0x{msg.command_int:04X}"
+            if writer is not None:
+                writer.writerow((msg_offset, src, dst, protocol, cmd, msg.id, msg.value))
+            else:
+                out.write(encoder.encode({ "offset": msg_offset, "src": src, "dst": dst, "protocol": protocol, "cmd": cmd, "id": msg.id, "value": msg.value }))
+                out.write("\n")
+
+    # fed message by message, so each complete message is reported while its own bytes are written
+    reader = VbusReader(on_message)
+    start = data.find(SOF)
+    # only the first chunk can start with bytes outside of a message, the reader ignores or reports them
+    # the same way as in a single pass
+    reader.write_bytes(data[:start] if start >= 0 else data)
+    while start >= 0:
+        end = data.find(SOF, start + 1)
+        msg_offset = offset + start
+        reader.write_bytes(data[start:end if end >= 0 else len(data)])
+        start = end
+    # an incomplete message or a header with a checksum error at the end of the chunk, the reader
+    # reports them as garbage once it receives the next SOF, which is the start of the next chunk
+    stats["garbage_bytes"] += len(reader.msg_buff)
+
+    return out.getvalue(), stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Decodes raw VBus capture files in parallel")
+    parser.add_argument("capture", help="file with the raw bytes received from the bus")
+    parser.add_argument("-v", "--vsf", required=False, default="vbus_specification.vsf", help="VBus specification file")
+    parser.add_argument("-f", "--format", required=False, default="ndjson", choices=["csv", "ndjson"],
+        help="output format, csv has one row per field value")
+    parser.add_argument("-o", "--output", required=False, default=None, help="output file, defaults to stdout")
+    parser.add_argument("-j", "--jobs", required=False, type=int, default=os.cpu_count(), help="count of worker processes")
+    parser.add_argument("-c", "--chunk-size", required=False, type=float, default=1.0, help="size of the chunks in MiB")
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.vsf):
+        print("VSF file could not be found.", file=sys.stderr)
+        return 1
+
+    start_time = time.monotonic()
+    # loaded once before the workers are started, forked workers share it
+    init_worker(args.vsf)
+    chunks = split_chunks(args.capture, max(1, int(args.chunk_size * 1024 * 1024)))
+    jobs = [(args.capture, offset, length, args.format) for offset, length in chunks]
+
+    output = open(args.output, "w", newline="") if args.output is not None else sys.stdout
+    if args.format == "csv":
+        output.write("offset,src,dst,protocol,cmd,field,value\n")
+
+    totals = { "messages": 0, "checksum_errors": 0, "garbage_bytes": 0 }
+    with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args.vsf,)) as pool:
+        # results are returned in the order of the chunks while later chunks are still being decoded
+        for text, stats in pool.imap(decode_chunk, jobs):
+            output.write(text)
+            for key, value in stats.items():
+                totals[key] += value
+
+    if output is not sys.stdout:
+        output.close()
+    else:
+        output.flush()
+
+    duration = time.monotonic() - start_time
+    size = sum(length for _, length in chunks)
+    print(f"{totals['messages']} messages, {totals['checksum_errors']} checksum errors, {totals['garbage_bytes']} garbage bytes, " +
+        f"{size / 1024 / 1024:.1f} MiB in {len(chunks)} chunks, {duration:.1f} s ({size / 1024 / 1024 / max(duration, 1e-9):.2f} MiB/s)", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+import json5
+from VBusSimulator import synthetic_packets, packets_from_spec, build_vsf, SimulatedSerialPort, SimulatedBus, RecordingMqttClient
+from VBusReader import VbusSerialReader
+from JsonHelper import json_get_or_default
+from vbus2mqtt import Vbus2Mqtt
+
+class LoadTestVbus2Mqtt(Vbus2Mqtt):
+    """Vbus2Mqtt publishing to a RecordingMqttClient instead of a broker
+
+    The serial port given in the config is used (e.g. the slave of a pseudo-terminal), unless a
+    SimulatedSerialPort is passed.
+    """
+    def __init__(self, config, serialport = None, record: bool = False) -> None:
+        self.serialport = serialport
+        self.record = record
+        super().__init__(config)
+
+    def init_mqtt(self):
+        cfg_mqtt = self.config["mqtt"]
+        self.mqtt_topic_prefix = cfg_mqtt["topic_prefix"]
+        self.mqtt_v5 = json_get_or_default(cfg_mqtt, "protocol", 3) == 5
+        self.mqtt_topic_alias_max = 0
+
+        self.mqtt_client = RecordingMqttClient(self.record)
+        self.mqtt_client.on_connect = self.mqtt_connect
+        self.mqtt_client.on_disconnect = self.mqtt_disconnect
+        self.mqtt_client.set_connected(True)
+
+    def init_vbus(self) -> None:
+        if self.serialport is None:
+            super().init_vbus()
+            return
+
+        self.vbus_ser = self.serialport
+        self.vbus_reader = VbusSerialReader(self.vbus_ser, self.vbus_on_message)
+
+def synthetic_config(vsf: str, packets: list, transfer_count: int) -> dict:
+    """Config with transfers of 8 fields each, alternately triggered by updates and every 5 seconds"""
+    field_ids = [packet.field_id(i) for packet in packets for i in range(len(packet.fields))]
+    transfers = []
+    for t in range(transfer_count):
+        transfers.append({
+            "mqtt": { "topic": f"load/{t}" },
+            "trigger": { "type": "update" } if t % 2 == 0 else { "type": "interval", "interval": 5 },
+            "type": "json",
+            "fields": [{ "name": f"f{i}", "item": field_ids[(t * 8 + i) % len(field_ids)] } for i in range(8)],
+        })
+    return {
+        "vbus": { "serialport": None, "baudrate": 9600, "vsf": vsf },
+        "mqtt": { "topic_prefix": "vbus2loadtest/" },
+        "plugins": [],
+        "transfers": transfers,
+    }
+
+def referenced_packet_ids(value, packet_ids: set) -> set:
+    """Collects the packet ids of all field ids used in a config, e.g. 00_0010_7321_10_0100 of 00_0010_7321_10_0100_000_2_0"""
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        for item in value:
+            referenced_packet_ids(item, packet_ids)
+    elif isinstance(value, str) and value.count("_") >= 7:
+        packet_ids.add("_".join(value.split("_")[:5]))
+    return packet_ids
+
+def write_all(fd: int, data: bytes) -> None:
+    while data:
+        data = data[os.write(fd, data):]
+
+def percentile_max(tracer_stats: dict, key: str, p: str):
+    """Worst percentile over all transfers"""
+    values = [stats[key][p] for stats in tracer_stats.values() if stats.get(key) is not None]
+    return max(values) if values else None
+
+def run_level(options, speed: float) -> dict:
+    """Runs the pipeline at one speed, meant to be run in its own process"""
+    with tempfile.TemporaryDirectory(prefix="vbus2loadtest_") as tmpdir:
+        packets = None
+        if options.config is not None:
+            with open(options.config) as f:
+                config = json5.load(f)
+        else:
+            packets = synthetic_packets(options.packets, options.fields)
+            vsf = os.path.join(tmpdir, "synthetic.vsf")
+            with open(vsf, "wb") as f:
+                f.write(build_vsf(packets))
+            config = synthetic_config(vsf, packets, options.transfers)
+
+        # no metrics server, but the latency of the messages is traced
+        config["monitoring"] = dict(json_get_or_default(config, "monitoring", {}))
+        config["monitoring"].pop("metrics", None)
+        config["monitoring"]["trace"] = json_get_or_default(config["monitoring"], "trace", {})
+
+        master = slave = None
+        serialport = None
+        if options.source == "pty":
+            master, slave = os.openpty()
+            config["vbus"]["serialport"] = os.ttyname(slave)
+            write = lambda data: write_all(master, data)
+        else:
+            serialport = SimulatedSerialPort()
+            write = serialport.feed
+
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output) if not options.verbose else contextlib.nullcontext():
+                ctrl = LoadTestVbus2Mqtt(config, serialport, record = options.record is not None)
+                if ctrl.vbus_reader is None:
+                    raise Exception("serial port could not be opened")
+
+                if packets is None:
+                    packets = packets_from_spec(ctrl.vbus_spec, referenced_packet_ids(config["transfers"] + config["plugins"], set()))
+                    if len(packets) == 0:
+                        packets = packets_from_spec(ctrl.vbus_spec)[:options.packets]
+                    if len(packets) == 0:
+                        raise Exception("the VSF file has no packets that can be simulated")
+
+                baudrate = int(json_get_or_default(config["vbus"], "baudrate", 9600))
+                bus = SimulatedBus(packets, write, baudrate, speed, options.period, options.garbage_rate)
+                client = ctrl.mqtt_client
+                reader = ctrl.vbus_reader
+
+                ctrl_thread = threading.Thread(target=ctrl.run, daemon=True)
+                ctrl_thread.start()
+
+                published_start = client.publish_count
+                usage_start = resource.getrusage(resource.RUSAGE_SELF)
+                wall_start = time.monotonic()
+                bus.start()
+                time.sleep(options.duration)
+
+                # everything is sampled before stopping, what isn't processed by now is the backlog
+                elapsed = time.monotonic() - wall_start
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                bytes_sent = bus.stats_bytes
+                messages_sent = bus.stats_messages
+                bytes_read = reader.stats_bytes_read
+                rx_messages = ctrl.stats_rxmsg_cnt
+                rx_errors = ctrl.stats_rxerr_cnt
+                garbage_bytes = reader.stats_garbage_bytes
+                coalesced = ctrl.rx_mailbox.stats_coalesced
+                dropped = ctrl.rx_mailbox.stats_dropped
+                published = client.publish_count - published_start
+                published_bytes = client.publish_bytes
+                ctrl.dispatcher.memory.sample()
+                rss = ctrl.dispatcher.memory.rss
+                latency = ctrl.dispatcher.tracer.get_stats()
+
+                bus.stop()
+                ctrl.stop()
+                ctrl_thread.join(10)
+                reader.thread_serial.join(10)
+        finally:
+            if master is not None:
+                os.close(master)
+                os.close(slave)
+
+        if options.record is not None:
+            with open(options.record, "a") as f:
+                for timestamp, topic, payload, qos, retain in client.messages:
+                    if isinstance(payload, (bytes, bytearray)):
+                        payload = payload.hex()
+                    f.write(json.dumps({ "speed": speed, "time": round(timestamp - wall_start, 6), "topic": topic,
+                        "payload": payload, "qos": qos, "retain": retain }) + "\n")
+
+    cpu = usage.ru_utime + usage.ru_stime - usage_start.ru_utime - usage_start.ru_stime - bus.stats_cpu
+    byte_rate = bytes_sent / elapsed
+    backlog = max(0, bytes_sent - bytes_read)
+    lag = backlog / byte_rate if byte_rate > 0 else 0.0
+    loss = (coalesced + dropped) / rx_messages if rx_messages > 0 else 0.0
+
+    result = {
+        "speed": speed,
+        "duration": round(elapsed, 3),
+        "offered_msgs_per_s": messages_sent / elapsed,
+        "offered_bytes_per_s": byte_rate,
+        "rx_msgs_per_s": rx_messages / elapsed,
+        "published_per_s": published / elapsed,
+        "published_bytes": published_bytes,
+        "backlog_bytes": backlog,
+        "lag_s": lag,
+        "bus_late_s": bus.stats_late,
+        "corrupted_rate": bus.stats_corrupted / messages_sent if messages_sent > 0 else 0.0,
+        "error_rate": rx_errors / (rx_messages + rx_errors) if rx_messages + rx_errors > 0 else 0.0,
+        "garbage_rate": garbage_bytes / bytes_read if bytes_read > 0 else 0.0,
+        "coalesced": coalesced,
+        "dropped": dropped,
+        "loss_rate": loss,
+        "cpu": cpu / elapsed,
+        "rss_bytes": rss,
+        "max_rss_bytes": usage.ru_maxrss * 1024,
+        "latency_p50_s": percentile_max(latency, "total", "p50"),
+        "latency_p99_s": percentile_max(latency, "total", "p99"),
+        "latency": latency,
+    }
+    # the pipeline can't keep up if data piles up in front of the reader, in the mailbox or the bus can't write it
+    result["saturated"] = lag > options.max_lag or bus.stats_late > options.max_lag or loss > options.max_loss
+    return result
+
+def _run_level_process(options, speed: float, queue) -> None:
+    try:
+        queue.put(run_level(options, speed))
+    except Exception as e:
+        queue.put({ "speed": speed, "error": str(e) })
+
+def run_isolated(options, speed: float) -> dict:
+    """Runs a level in a new process, so CPU time and memory of levels don't add up"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_level_process, args=(options, speed, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+HEADER = f"{'speed':>8} {'offered/s':>10} {'rx/s':>10} {'pub/s':>10} {'lag':>8} {'errors':>7} {'garbage':>7} {'loss':>7} {'cpu':>6} {'rss':>8} {'p99':>9}"
+
+def format_result(result: dict) -> str:
+    if "error" in result:
+        return f"{result['speed']:>7g}x error: {result['error']}"
+    p99 = f"{result['latency_p99_s'] * 1000:.1f} ms" if result["latency_p99_s"] is not None else "-"
+    rss = f"{result['rss_bytes'] / 1048576:.1f} MiB" if result["rss_bytes"] is not None else "-"
+    return f"{result['speed']:>7g}x {result['offered_msgs_per_s']:>10.1f} {result['rx_msgs_per_s']:>10.1f} " + \
+        f"{result['published_per_s']:>10.1f} {result['lag_s']:>7.2f}s {result['error_rate']:>7.2%} " + \
+        f"{result['garbage_rate']:>7.2%} {result['loss_rate']:>7.2%} {result['cpu']:>6.0%} {rss:>8} {p99:>9}" + \
+        ("  saturated" if result["saturated"] else "")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the vbus2mqtt pipeline with a simulated VBus and MQTT broker")
+    parser.add_argument("-c", "--config", required=False, default=None, help="vbus2mqtt config to test, a synthetic one is used if not given")
+    parser.add_argument("-s", "--speeds", required=False, default="1,2,5,10,20,50,100", help="comma separated factors of the bus speed")
+    parser.add_argument("-d", "--duration", required=False, type=float, default=10, help="duration of each level in seconds")
+    parser.add_argument("--source", required=False, choices=("memory", "pty"), default="pty", help="pseudo-terminal read with pyserial or in-process port")
+    parser.add_argument("--period", required=False, type=float, default=1.0, help="seconds of bus time between rounds of packets")
+    parser.add_argument("--packets", required=False, type=int, default=4, help="count of synthetic packets")
+    parser.add_argument("--fields", required=False, type=int, default=32, help="count of fields per synthetic packet")
+    parser.add_argument("--transfers", required=False, type=int, default=10, help="count of synthetic transfers")
+    parser.add_argument("--garbage-rate", required=False, type=float, default=0.0, help="probability of a message being corrupted")
+    parser.add_argument("--max-lag", required=False, type=float, default=0.5, help="seconds of backlog considered as saturated")
+    parser.add_argument("--max-loss", required=False, type=float, default=0.01, help="rate of coalesced or dropped messages considered as saturated")
+    parser.add_argument("--refine", required=False, type=int, default=2, help="bisection steps between the last good and the first saturated speed")
+    parser.add_argument("--all", action="store_true", help="run all speeds, even after saturation")
+    parser.add_argument("-j", "--json", required=False, default=None, help="write the results as JSON to this file")
+    parser.add_argument("--record", required=False, default=None, help="write the published messages as NDJSON to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of vbus2mqtt")
+
+    args = parser.parse_args()
+    speeds = sorted(float(speed) for speed in args.speeds.split(","))
+
+    if args.record is not None:
+        open(args.record, "w").close()
+
+    print(HEADER)
+    results = []
+    good = None
+    saturated = None
+    for speed in speeds:
+        result = run_isolated(args, speed)
+        results.append(result)
+        print(format_result(result), flush=True)
+        if "error" in result:
+            return
+        if result["saturated"]:
+            saturated = result
+            if not args.all:
+                break
+        elif saturated is None:
+            good = result
+
+    if saturated is not None and good is not None:
+        for _ in range(args.refine):
+            speed = round(math.sqrt(good["speed"] * saturated["speed"]), 2)
+            if speed in (good["speed"], saturated["speed"]):
+                break
+            result = run_isolated(args, speed)
+            results.append(result)
+            print(format_result(result), flush=True)
+            if "error" in result:
+                break
+            if result["saturated"]:
+                saturated = result
+            else:
+                good = result
+
+    print()
+    if saturated is None:
+        print(f"not saturated up to {speeds[-1]:g}x")
+    elif good is None:
+        print(f"saturated already at {saturated['speed']:g}x ({saturated['offered_msgs_per_s']:.1f} messages/s offered)")
+    else:
+        print(f"saturation point between {good['speed']:g}x and {saturated['speed']:g}x, " +
+            f"sustained {good['rx_msgs_per_s']:.1f} messages/s and {good['published_per_s']:.1f} publishes/s")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({
+                "config": args.config,
+                "source": args.source,
+                "duration": args.duration,
+                "saturation": {
+                    "good": good["speed"] if good is not None else None,
+                    "saturated": saturated["speed"] if saturated is not None else None,
+                },
+                "results": results,
+            }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
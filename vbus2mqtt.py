@@ -2,13 +2,15 @@
 
 import time
 from datetime import datetime
+from typing import Union
 import os
-import paho.mqtt.client as mqtt
-import json5 as json
-import serial
+import signal
 from VBusSpecReader import VbusFieldType, VbusSpec
-from VBusReader import VbusSerialReader, VbusMessage1v0, VbusMessageGarbage
+from VBusReader import VbusSerialReader, VbusMessage1v0, VbusMessageGarbage, VbusMailbox
 from MqttDispatcher import MqttDispatcher
+from JsonHelper import json_get_or_default
+from ConfigCache import load_config
+from Monitoring import metrics
 
 def dt_to_iso8601(timestamp: datetime):
     if timestamp is None:
@@ -16,9 +18,16 @@ def dt_to_iso8601(timestamp: datetime):
     return timestamp.replace(microsecond=0).astimezone().isoformat()
 
 class Vbus2Mqtt():
-    def __init__(self, config) -> None:
+    def __init__(self, config, startup_time: float = None) -> None:
+        """Starts the bridge
+
+        Args:
+            config (dict): config
+            startup_time (float, optional): time.monotonic() of the process start, e.g. before loading the config. Defaults to None (now).
+        """
         self.config = config
         #TODO: check config
+        self.cfg_monitoring = json_get_or_default(config, "monitoring", {})
 
         self.stats_startup = time.time()
         self.stats_rxmsg_cnt = 0
@@ -26,36 +35,124 @@ class Vbus2Mqtt():
         self.stats_rxerr_cnt = 0
         self.stats_rxerr_last = None
         self.vbus_spec = None
+        self.vbus_reader = None
+        self.dispatcher = None
+        self.metrics_server = None
+        self.profiler = None
+        self.sqlite_sink = None
+        self.running = False
+
+        # seconds from the start until each startup phase was completed
+        self.startup_time = startup_time if startup_time is not None else time.monotonic()
+        self.startup_phases = {}
+        if startup_time is not None:
+            self.startup_phase("config")
+        self.startup_reported = False
+        self.first_message_time = None
+
+        self.metrics_decode = metrics.histogram("vbus2mqtt_decode_seconds", "Time to decode a message", ("packet",))
+        self.metrics_decode_packets = {} # packet id -> histogram child
+        self.metrics_update_fields = metrics.histogram("vbus2mqtt_update_fields_seconds", "Time to update the dispatcher fields with a message").labels()
+        metrics.add_collector(self.collect_metrics)
 
         if self.load_vsf() == False:
             raise Exception("Could not load VSF file and therefore initialize VBus")
+        self.startup_phase("vsf")
 
-        self.init_mqtt()
+        # decoded messages are handed over from the reader thread to the dispatcher thread,
+        # only the latest message per source, destination and command is kept
+        mailbox_size = json_get_or_default(config["vbus"], "mailbox_size", 64)
+        self.rx_mailbox = VbusMailbox(mailbox_size, self.notify_dispatcher)
+
+        # the reader starts receiving right away, messages wait in the mailbox while the
+        # client connects in the background and the dispatcher is being built
         self.init_vbus()
+        self.startup_phase("vbus")
+        self.init_mqtt()
 
-        self.dispatcher = MqttDispatcher(self.mqtt_client, config["plugins"], config["transfers"], self.mqtt_topic_prefix)
+        self.dispatcher = MqttDispatcher(self.mqtt_client, config["plugins"], config["transfers"], self.mqtt_topic_prefix,
+            publisher_cfg = json_get_or_default(config["mqtt"], "offline_buffer"), mqtt_v5 = self.mqtt_v5,
+            memory_cfg = json_get_or_default(self.cfg_monitoring, "memory"), history_cfg = json_get_or_default(config, "history"),
+            snapshot_cfg = json_get_or_default(config, "snapshot"), vbus_spec = self.vbus_spec)
+        self.startup_phase("dispatcher")
+        # the client might have connected already
+        self.dispatcher.publisher.set_connected(self.mqtt_client.is_connected(), self.mqtt_topic_alias_max)
+
+        # values are written to SQLite by a background thread, by default those of the fields used by the dispatcher
+        cfg_sqlite = json_get_or_default(config, "sqlite")
+        if cfg_sqlite is not None and json_get_or_default(cfg_sqlite, "enabled", True):
+            from SqliteSink import SqliteSink
+            self.sqlite_sink = SqliteSink(cfg_sqlite, set(self.dispatcher.fields))
+            self.dispatcher.sinks.append(self.sqlite_sink)
+
+        cfg_trace = json_get_or_default(self.cfg_monitoring, "trace")
+        if cfg_trace is not None and json_get_or_default(cfg_trace, "enabled", True):
+            from Monitoring import LatencyTracer
+            self.dispatcher.tracer = LatencyTracer(cfg_trace)
+            self.mqtt_client.on_publish = self.mqtt_publish
+
+        cfg_metrics = json_get_or_default(self.cfg_monitoring, "metrics")
+        if cfg_metrics is not None:
+            from Monitoring import MetricsServer
+            self.metrics_server = MetricsServer(metrics, cfg_metrics)
+
+        # the profiler is idle until it receives its signal
+        cfg_profiler = json_get_or_default(self.cfg_monitoring, "profiler", {})
+        if json_get_or_default(cfg_profiler, "enabled", False):
+            from Monitoring import SamplingProfiler
+            self.profiler = SamplingProfiler(cfg_profiler)
 
         self.dispatcher.metafields.update({
             "sw:uptime" : lambda target: round(time.time() - self.stats_startup),
+            "sw:startup" : lambda target: self.startup_phases,
             "comm:rxmsg_cnt" : lambda target: self.stats_rxmsg_cnt,
             "comm:rxmsg_last" : lambda target: dt_to_iso8601(self.stats_rxmsg_last),
             "comm:rxerr_cnt" : lambda target: self.stats_rxerr_cnt,
             "comm:rxerr_last" : lambda target: dt_to_iso8601(self.stats_rxerr_last),
+            "comm:rx_coalesced" : lambda target: self.rx_mailbox.stats_coalesced,
+            "comm:rx_dropped" : lambda target: self.rx_mailbox.stats_dropped,
+            "comm:packets" : lambda target: self.get_packet_stats(),
+            "comm:checksum_errors" : lambda target: sum(list(self.vbus_reader.stats_checksum_errors.values())) if self.vbus_reader is not None else None,
+            "comm:garbage_bytes" : lambda target: self.vbus_reader.stats_garbage_bytes if self.vbus_reader is not None else None,
+            "comm:bus_load" : lambda target: self.get_bus_load(),
+            "sqlite:stats" : lambda target: self.sqlite_sink.get_stats() if self.sqlite_sink is not None else None,
         })
 
     def init_mqtt(self):
-        cfg_mqtt = config["mqtt"]
+        import paho.mqtt.client as mqtt
+        cfg_mqtt = self.config["mqtt"]
         self.mqtt_topic_prefix = cfg_mqtt["topic_prefix"] # shortcut, I'm lazy
 
-        self.mqtt_client = mqtt.Client()
+        self.mqtt_v5 = json_get_or_default(cfg_mqtt, "protocol", 3) == 5
+        self.mqtt_topic_alias_max = 0
+
+        if self.mqtt_v5:
+            self.mqtt_client = mqtt.Client(protocol=mqtt.MQTTv5)
+        else:
+            self.mqtt_client = mqtt.Client()
         self.mqtt_client.on_connect = self.mqtt_connect
+        self.mqtt_client.on_disconnect = self.mqtt_disconnect
 
         if "last_will" in cfg_mqtt:
             lw = cfg_mqtt["last_will"]
             self.mqtt_client.will_set(f"{self.mqtt_topic_prefix}{lw['topic']}", payload = lw["offline"], qos = 0, retain = True)
 
         self.mqtt_client.username_pw_set(cfg_mqtt["user"], cfg_mqtt["pass"])
-        self.mqtt_client.connect(cfg_mqtt["host"], cfg_mqtt["port"], 60)
+        if self.mqtt_v5:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+
+            properties = None
+            session_expiry = json_get_or_default(cfg_mqtt, "session_expiry", None)
+            if session_expiry is not None:
+                properties = Properties(PacketTypes.CONNECT)
+                properties.SessionExpiryInterval = session_expiry
+
+            self.mqtt_client.connect_async(cfg_mqtt["host"], cfg_mqtt["port"], 60,
+                clean_start = json_get_or_default(cfg_mqtt, "clean_start", True), properties = properties)
+        else:
+            self.mqtt_client.connect_async(cfg_mqtt["host"], cfg_mqtt["port"], 60)
+        # connects in the network thread, messages are buffered by the dispatcher until then
         self.mqtt_client.loop_start()
 
     def load_vsf(self) -> bool:
@@ -74,6 +171,7 @@ class Vbus2Mqtt():
         return True
 
     def init_vbus(self) -> None:
+        import serial
         cfg_vbus = self.config["vbus"]
 
         self.vbus_ser = None
@@ -94,6 +192,7 @@ class Vbus2Mqtt():
             self.stats_rxmsg_last = datetime.now()
             self.stats_rxmsg_cnt += 1
             
+            decode_start = time.perf_counter()
             decoded = msg.decode(self.vbus_spec)
             data = {}
             for item in decoded:
@@ -105,28 +204,174 @@ class Vbus2Mqtt():
                     value = round(item[1], item[0].precision)
 
                 data[fid] = value
-            self.dispatcher.update_fields(data, datetime.now())
+
+            packet_id = msg.full_id
+            histogram = self.metrics_decode_packets.get(packet_id)
+            if histogram is None:
+                histogram = self.metrics_decode.labels(packet_id)
+                self.metrics_decode_packets[packet_id] = histogram
+            histogram.observe(time.perf_counter() - decode_start)
+
+            trace = None
+            if self.dispatcher is not None and self.dispatcher.tracer is not None:
+                trace = (msg.start_time, msg.end_time, time.time())
+
+            self.rx_mailbox.put((msg.addr_src, msg.addr_dst, msg.command), (data, datetime.now(), trace))
+
+    def notify_dispatcher(self) -> None:
+        # messages can arrive before the dispatcher exists, they are processed by its first tick
+        if self.dispatcher is not None:
+            self.dispatcher.notify()
+
+    def startup_phase(self, name: str) -> None:
+        self.startup_phases[name] = round(time.monotonic() - self.startup_time, 3)
+
+    def report_startup(self) -> None:
+        """Reports the startup phases once the first value received (or restored) was published"""
+        first_sent = self.dispatcher.publisher.stats_first_sent
+        if first_sent is None:
+            return
+        if self.first_message_time is None and not self.dispatcher.snapshot_restored:
+            return
+        self.startup_phases["first_publish"] = round(first_sent - self.startup_time, 3)
+        self.startup_reported = True
+        print("Startup:", ", ".join(f"{name} {seconds:.3f} s" for name, seconds in self.startup_phases.items()))
+
+    def process_rx(self) -> None:
+        for data, timestamp, trace in self.rx_mailbox.take_all():
+            if self.first_message_time is None:
+                self.first_message_time = time.monotonic()
+                self.startup_phase("first_message")
+                # messages sent before, e.g. status messages, don't count unless restored values were published
+                publisher = self.dispatcher.publisher
+                if not self.dispatcher.snapshot_restored or publisher.stats_first_sent is None:
+                    publisher.reset_first_sent()
+            update_start = time.perf_counter()
+            self.dispatcher.update_fields(data, timestamp, trace)
+            self.metrics_update_fields.observe(time.perf_counter() - update_start)
+
+    def get_packet_stats(self) -> Union[None, list]:
+        """Statistics of the reader per source, destination, protocol version and command, rounded and with ISO8601 timestamps"""
+        if self.vbus_reader is None:
+            return None
+
+        retval = []
+        for stats in self.vbus_reader.get_packet_stats(int(self.config["vbus"]["baudrate"])):
+            for key, value in stats.items():
+                if key in ("last_seen", "last_error"):
+                    stats[key] = dt_to_iso8601(datetime.fromtimestamp(value)) if value is not None else None
+                elif isinstance(value, float):
+                    stats[key] = round(value, 4)
+            retval.append(stats)
+        return retval
+
+    def get_bus_load(self) -> Union[None, float]:
+        """Share of the bus time used by all received messages"""
+        if self.vbus_reader is None:
+            return None
+        loads = [stats["bus_load"] for stats in self.vbus_reader.get_packet_stats(int(self.config["vbus"]["baudrate"])) if stats["bus_load"] is not None]
+        return round(sum(loads), 4)
+
+    def collect_metrics(self) -> list:
+        """Collector for the metrics registry, exports the counters of the reader and the mailbox"""
+        retval = [
+            ("vbus2mqtt_rx_messages_total", "counter", "Received messages with valid checksum", [({}, self.stats_rxmsg_cnt)]),
+            ("vbus2mqtt_rx_errors_total", "counter", "Received garbage or messages with invalid checksum", [({}, self.stats_rxerr_cnt)]),
+            ("vbus2mqtt_mailbox_coalesced_total", "counter", "Messages replaced by a newer one before being processed", [({}, self.rx_mailbox.stats_coalesced)]),
+            ("vbus2mqtt_mailbox_dropped_total", "counter", "Messages dropped because the mailbox was full", [({}, self.rx_mailbox.stats_dropped)]),
+            ("vbus2mqtt_mqtt_queue_depth", "gauge", "Messages buffered while the broker is unreachable", [({}, self.dispatcher.publisher.queue_depth)]),
+            ("vbus2mqtt_rss_bytes", "gauge", "Resident set size of the process", [({}, self.dispatcher.memory.rss)]),
+        ]
+
+        reader = self.vbus_reader
+        if reader is not None:
+            retval += [
+                ("vbus2mqtt_bytes_read_total", "counter", "Bytes read from the serial port", [({}, reader.stats_bytes_read)]),
+                ("vbus2mqtt_frames_total", "counter", "Complete frames by protocol version",
+                    [({ "protocol": f"{ver >> 4}.{ver & 0xF}" }, cnt) for ver, cnt in list(reader.stats_frames.items())]),
+                ("vbus2mqtt_checksum_errors_total", "counter", "Checksum failures by protocol version",
+                    [({ "protocol": f"{ver >> 4}.{ver & 0xF}" }, cnt) for ver, cnt in list(reader.stats_checksum_errors.items())]),
+                ("vbus2mqtt_garbage_bytes_total", "counter", "Bytes not belonging to a complete frame", [({}, reader.stats_garbage_bytes)]),
+            ]
+        return retval
 
     def tick(self) -> float:
-        return self.dispatcher.tick()
+        self.process_rx()
+        next_time = self.dispatcher.tick()
+        if not self.startup_reported:
+            self.report_startup()
+        return next_time
+
+    def run(self) -> None:
+        """Main loop, processes received data and scheduled transfers until stop() is called"""
+        self.running = True
+        while self.running:
+            next_time = self.tick()
+            # sleeps until the next scheduled tick, received data or stop() wake it up earlier
+            self.dispatcher.wait(next_time)
+        self.shutdown()
+
+    def stop(self, signum = None, frame = None) -> None:
+        self.running = False
+        self.dispatcher.notify()
+
+    def shutdown(self) -> None:
+        if self.vbus_reader is not None:
+            self.vbus_reader.stop()
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        if self.profiler is not None:
+            self.profiler.stop()
+
+        self.dispatcher.stop()
+
+        cfg_mqtt = self.config["mqtt"]
+        if "last_will" in cfg_mqtt:
+            # a clean disconnect doesn't trigger the last will
+            lw = cfg_mqtt["last_will"]
+            self.mqtt_client.publish(f"{self.mqtt_topic_prefix}{lw['topic']}", payload = lw["offline"], qos = 0, retain = True)
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+
+    def mqtt_connect(self, client, userdata, flags, rc, properties = None):
+        # with MQTT v5, the broker tells how many topic aliases it accepts
+        self.mqtt_topic_alias_max = getattr(properties, "TopicAliasMaximum", 0)
 
-    def mqtt_connect(self, client, userdata, flags, rc):
         cfg_mqtt = self.config["mqtt"]
         print("MQTT connected, config:", cfg_mqtt)
+        if "mqtt_connected" not in self.startup_phases:
+            self.startup_phase("mqtt_connected")
         if "last_will" in cfg_mqtt:
             print("setting last will (online)")
             lw = cfg_mqtt["last_will"]
             client.publish(f"{self.mqtt_topic_prefix}{lw['topic']}", payload = lw["online"], qos = 0, retain = True)
 
+        if self.dispatcher is not None and rc == 0:
+            # messages buffered while being offline are flushed by the dispatcher thread
+            self.dispatcher.publisher.set_connected(True, self.mqtt_topic_alias_max)
+
+    def mqtt_publish(self, client, userdata, mid):
+        self.dispatcher.tracer.published(mid)
+
+    def mqtt_disconnect(self, client, userdata, rc, properties = None):
+        print("MQTT disconnected, rc:", rc)
+        if self.dispatcher is not None:
+            self.dispatcher.publisher.set_connected(False)
+
+def main():
+    startup_time = time.monotonic()
+    config = load_config('vbus2mqtt.json')
 
-with open('vbus2mqtt.json') as f:
-    config = json.load(f)
+    ctrl = Vbus2Mqtt(config, startup_time)
 
-ctrl = Vbus2Mqtt(config)
+    signal.signal(signal.SIGTERM, ctrl.stop)
+    signal.signal(signal.SIGINT, ctrl.stop)
+    if ctrl.profiler is not None:
+        signal.signal(ctrl.profiler.signum, ctrl.profiler.toggle)
 
+    ctrl.run()
 
-while True:
-    next = ctrl.tick()
-    sleeptime = next - time.time()
-    if sleeptime > 0:
-        time.sleep(sleeptime)
\ No newline at end of file
+if __name__ == "__main__":
+    main()